@@ -18,11 +18,23 @@
 #include <assert.h>
 #include <inttypes.h>
 #include <math.h>
+#include <stdarg.h>
 #include <stdbool.h>
+#include <stddef.h>
 #include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#ifdef _WIN32
+#include <fcntl.h>
+#include <io.h>
+#endif
 
 #if defined _MSC_VER && _MSC_VER >= 1900
 #define restrict __restrict
@@ -30,12 +42,137 @@
 #define restrict
 #endif
 
+/*
+ * For float computations shared by fights and resumed snapshots: with -ffast-math, copies inlined in different callers
+ * may round differently, and a resumed snapshot would not continue the fight it was made of exactly.
+ */
+#if defined _MSC_VER
+#define NOINLINE __declspec(noinline)
+#elif defined __GNUC__
+#define NOINLINE __attribute__((noinline))
+#else
+#define NOINLINE
+#endif
+
 /* Lehmer RNG. */
 #define RANDOM_MULTIPLIER 48271UL
 #define RANDOM_MODULUS 2147483647UL
 #define RANDOM_MAX (RANDOM_MODULUS - 1)
 #define RANDOM_NEXT(r) ((uint32_t)((uint64_t)(r)*RANDOM_MULTIPLIER % RANDOM_MODULUS))
 
+/*
+ * Derives the initial Lehmer state of the n-th simulation from the seed (SplitMix64 finalizer). Every simulation has
+ * its own stream, so simulations can be run in any order and on any number of threads with the same results.
+ */
+static uint32_t simulation_seed(uint32_t seed, uint32_t n) {
+  uint64_t z = ((uint64_t)seed << 32 | n) + UINT64_C(0x9e3779b97f4a7c15);
+  z = (z ^ (z >> 30)) * UINT64_C(0xbf58476d1ce4e5b9);
+  z = (z ^ (z >> 27)) * UINT64_C(0x94d049bb133111eb);
+  z ^= z >> 31;
+  return (uint32_t)(z % (RANDOM_MODULUS - 1)) + 1;
+}
+
+static uint64_t splitmix64_next(uint64_t *state) {
+  uint64_t z = (*state += UINT64_C(0x9e3779b97f4a7c15));
+  z = (z ^ (z >> 30)) * UINT64_C(0xbf58476d1ce4e5b9);
+  z = (z ^ (z >> 27)) * UINT64_C(0x94d049bb133111eb);
+  return z ^ (z >> 31);
+}
+
+enum rng_kind { RNG_LEHMER, RNG_XOSHIRO };
+
+/*
+ * The random number generator of a simulation. Lehmer is the original generator. xoshiro128++ is faster and draws
+ * bounded numbers with Lemire's method instead of a modulo. The generators give different results for the same seed.
+ */
+struct rng {
+  enum rng_kind kind;
+  uint32_t lehmer;
+  uint32_t xoshiro[4];
+};
+
+static void init_rng(struct rng *rng, enum rng_kind kind, uint32_t seed, uint32_t n) {
+  rng->kind = kind;
+  rng->lehmer = simulation_seed(seed, n);
+
+  uint64_t state = (uint64_t)seed << 32 | n;
+  uint64_t a = splitmix64_next(&state);
+  uint64_t b = splitmix64_next(&state);
+  rng->xoshiro[0] = (uint32_t)a;
+  rng->xoshiro[1] = (uint32_t)(a >> 32);
+  rng->xoshiro[2] = (uint32_t)b;
+  rng->xoshiro[3] = (uint32_t)(b >> 32);
+  if ((a | b) == 0) {
+    rng->xoshiro[0] = 1;
+  }
+}
+
+static inline uint32_t rotl32(uint32_t x, int k) { return (x << k) | (x >> (32 - k)); }
+
+static inline uint32_t xoshiro_next(uint32_t *s) {
+  uint32_t result = rotl32(s[0] + s[3], 7) + s[0];
+  uint32_t t = s[1] << 9;
+  s[2] ^= s[0];
+  s[3] ^= s[1];
+  s[1] ^= s[2];
+  s[0] ^= s[3];
+  s[2] ^= t;
+  s[3] = rotl32(s[3], 11);
+  return result;
+}
+
+/* Returns a uniform number in [0, n) for 0 < n <= 2^32 with Lemire's nearly divisionless method. */
+static inline uint32_t xoshiro_below(uint32_t *s, uint64_t n) {
+  uint64_t m = (uint64_t)xoshiro_next(s) * n;
+  if ((uint32_t)m < n) {
+    uint32_t threshold = (uint32_t)((UINT64_C(0x100000000) - n) % n);
+    while ((uint32_t)m < threshold) {
+      m = (uint64_t)xoshiro_next(s) * n;
+    }
+  }
+  return (uint32_t)(m >> 32);
+}
+
+/*
+ * Returns a number in [0, n), n > 0. The kind is passed separately so that callers specialized for one generator do
+ * not test it for every number.
+ */
+static inline uint64_t rng_below(struct rng *rng, enum rng_kind kind, uint64_t n) {
+  if (kind == RNG_LEHMER) {
+    rng->lehmer = RANDOM_NEXT(rng->lehmer);
+    if (n <= RANDOM_MAX) {
+      return rng->lehmer % n;
+    }
+    /* One number is at most RANDOM_MAX, a larger bound takes a second one as the low digit. */
+    uint64_t high = rng->lehmer - 1;
+    rng->lehmer = RANDOM_NEXT(rng->lehmer);
+    return (high * RANDOM_MAX + (rng->lehmer - 1)) % n;
+  }
+  if (n <= UINT64_C(0x100000000)) {
+    return xoshiro_below(rng->xoshiro, n);
+  }
+  uint64_t x = (uint64_t)xoshiro_next(rng->xoshiro) << 32;
+  return (x | xoshiro_next(rng->xoshiro)) % n;
+}
+
+/* Same as rng_below() for a 32 bits bound, which avoids a 64 bits division. */
+static inline uint32_t rng_below32(struct rng *rng, enum rng_kind kind, uint32_t n) {
+  if (kind == RNG_LEHMER) {
+    rng->lehmer = RANDOM_NEXT(rng->lehmer);
+    return rng->lehmer % n;
+  }
+  return xoshiro_below(rng->xoshiro, n);
+}
+
+/* Returns a number in [0, 1]. */
+static inline float rng_unit(struct rng *rng, enum rng_kind kind) {
+  if (kind == RNG_LEHMER) {
+    rng->lehmer = RANDOM_NEXT(rng->lehmer);
+    return (1.0f / (float)RANDOM_MAX) * (float)rng->lehmer;
+  }
+  return (1.0f / 16777216.0f) * (float)(xoshiro_next(rng->xoshiro) >> 8);
+}
+
 #define MAX_ROUNDS 6
 
 struct unit_attributes {
@@ -62,6 +199,38 @@ struct unit_group_stats {
   uint64_t num_remaining_units;
 };
 
+#define NUM_STATS_FIELDS 7
+#define ALL_STATS_FIELDS 0x7f
+
+/* Offsets of unit_group_stats fields in the output order, a field mask bit i selects the field i. */
+static const size_t STATS_FIELD_OFFSETS[NUM_STATS_FIELDS] = {
+    offsetof(struct unit_group_stats, times_fired),         offsetof(struct unit_group_stats, times_was_shot),
+    offsetof(struct unit_group_stats, shield_damage_dealt), offsetof(struct unit_group_stats, hull_damage_dealt),
+    offsetof(struct unit_group_stats, shield_damage_taken), offsetof(struct unit_group_stats, hull_damage_taken),
+    offsetof(struct unit_group_stats, num_remaining_units),
+};
+
+/*
+ * Output projection: only the last round, only the fields of the mask and only the kinds that a combatant has at the
+ * start of the battle (other kinds have all stats zeroed). Both sides know the projected layout from the request.
+ */
+struct projection {
+  bool last_round;
+  bool sparse;
+  uint8_t fields;
+};
+
+/* Profile of one round summed over simulations, see the --profile option. */
+struct round_profile {
+  /* The number of simulations that fought the round. */
+  uint64_t num_fights;
+  uint64_t time_ns;
+  /* Every shooter starts a chain of shots that goes on while rapid fire rolls succeed. */
+  uint64_t num_chains;
+  uint64_t num_shots;
+  uint64_t max_chain;
+};
+
 struct combatant {
   struct unit_group_stats *stats;
   uint8_t weapons_technology;
@@ -70,61 +239,271 @@ struct combatant {
   uint64_t *unit_groups;
 };
 
+/* A unit stored one by one: a unit with a damaged hull, or an undamaged unit that has been hit in this round. */
 struct unit {
   float shield;
   float hull;
+};
+
+/*
+ * Units of one kind of one combatant. Units with a damaged hull are stored one by one, undamaged units only as a
+ * count. An undamaged unit is materialized when it is hit for the first time in a round. As undamaged units are
+ * indistinguishable, the j-th undamaged unit is hit[j] if j < num_hit, and an untouched unit otherwise; the first hit
+ * unit always gets the next free index.
+ */
+struct block {
+  struct unit *damaged;
+  uint64_t num_damaged;
+  uint64_t damaged_capacity;
+  uint64_t num_undamaged;
+  struct unit *hit;
+  uint64_t num_hit;
+  uint64_t hit_capacity;
+  float max_shield;
+  float max_hull;
   uint8_t kind;
   uint8_t combatant_id;
 };
 
+/*
+ * Units of a party are indexed block by block, and within a block damaged units go first. Memory is needed only for
+ * damaged units and units hit in the current round, not for the whole party.
+ */
 struct party {
   struct combatant *combatants;
-  struct unit *units;
+  struct block *blocks;
+  /* offsets[b] is the index of the first unit of the block b, offsets[num_blocks] is the number of alive units. */
+  uint64_t *offsets;
+  uint32_t num_blocks;
   uint64_t num_alive;
 };
 
 const uint64_t MAX_UNITS = UINT64_MAX / sizeof(struct unit);
 
-static struct units_attributes *load_units_attributes(FILE *file) {
-  int n;
+/* Maximum length of a uint64_t written in decimal, including a separator. */
+#define MAX_U64_TEXT_SIZE 21
 
-  uint8_t num_kinds;
-  n = fscanf(file, "%" SCNu8, &num_kinds);
-  if (n != 1) {
-    fputs("Parsing units attributes failed, cannot scan num_kinds\n", stderr);
-    goto fail;
+/*
+ * The last error message. In the serve mode, errors are sent back in a response frame instead of stderr. The library
+ * never writes to stderr, and calls from several threads of the caller get their own messages.
+ */
+#if !defined BATTLE_ENGINE_LIBRARY
+static char error_message[256];
+static bool capture_errors = false;
+#elif defined _MSC_VER
+static __declspec(thread) char error_message[256];
+static bool capture_errors = true;
+#else
+static __thread char error_message[256];
+static bool capture_errors = true;
+#endif
+
+static void report_error(const char *format, ...) {
+  va_list args;
+  va_start(args, format);
+  if (capture_errors) {
+    vsnprintf(error_message, sizeof(error_message), format, args);
+  } else {
+    vfprintf(stderr, format, args);
   }
+  va_end(args);
+}
 
-  if (num_kinds == 0) {
-    fputs("Parsing units attributes failed, num_kinds must be greater than 0\n", stderr);
-    goto fail;
+/* Monotonic time in nanoseconds. */
+static uint64_t now_ns(void) {
+  struct timespec ts;
+#ifdef _WIN32
+  timespec_get(&ts, TIME_UTC);
+#else
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+#endif
+  return (uint64_t)ts.tv_sec * UINT64_C(1000000000) + (uint64_t)ts.tv_nsec;
+}
+
+/* Growable output buffer. */
+struct buffer {
+  char *data;
+  size_t size;
+  size_t capacity;
+};
+
+static bool buffer_reserve(struct buffer *buffer, size_t size) {
+  if (size <= buffer->capacity - buffer->size) {
+    return true;
+  }
+
+  size_t capacity = buffer->capacity != 0 ? buffer->capacity : 4096;
+  while (capacity - buffer->size < size) {
+    if (capacity > SIZE_MAX / 2) {
+      report_error("Allocating output buffer failed\n");
+      return false;
+    }
+    capacity *= 2;
+  }
+
+  char *data = realloc(buffer->data, capacity);
+  if (data == NULL) {
+    report_error("Allocating output buffer failed\n");
+    return false;
+  }
+
+  buffer->data = data;
+  buffer->capacity = capacity;
+  return true;
+}
+
+/* Writes the value in decimal followed by the separator, at least MAX_U64_TEXT_SIZE bytes must be reserved. */
+static void buffer_put_u64(struct buffer *buffer, uint64_t value, char separator) {
+  char digits[20];
+  int n = 0;
+  do {
+    digits[n++] = (char)('0' + value % 10);
+    value /= 10;
+  } while (value != 0);
+
+  char *p = buffer->data + buffer->size;
+  while (n > 0) {
+    *p++ = digits[--n];
+  }
+  *p++ = separator;
+  buffer->size = (size_t)(p - buffer->data);
+}
+
+/* Writes the value as little-endian, at least 8 bytes must be reserved. */
+static void buffer_put_le64(struct buffer *buffer, uint64_t value) {
+  unsigned char *p = (unsigned char *)buffer->data + buffer->size;
+  for (int i = 0; i < 8; i++) {
+    p[i] = (unsigned char)(value >> (8 * i));
+  }
+  buffer->size += 8;
+}
+
+static void buffer_put_le32(struct buffer *buffer, uint32_t value) {
+  unsigned char *p = (unsigned char *)buffer->data + buffer->size;
+  for (int i = 0; i < 4; i++) {
+    p[i] = (unsigned char)(value >> (8 * i));
+  }
+  buffer->size += 4;
+}
+
+static void buffer_put_le16(struct buffer *buffer, uint16_t value) {
+  unsigned char *p = (unsigned char *)buffer->data + buffer->size;
+  p[0] = (unsigned char)value;
+  p[1] = (unsigned char)(value >> 8);
+  buffer->size += 2;
+}
+
+#ifndef BATTLE_ENGINE_LIBRARY
+static bool buffer_append(struct buffer *restrict buffer, const void *restrict data, size_t size) {
+  if (!buffer_reserve(buffer, size)) {
+    return false;
   }
+  memcpy(buffer->data + buffer->size, data, size);
+  buffer->size += size;
+  return true;
+}
+
+static void buffer_put_le_double(struct buffer *buffer, double value) {
+  uint64_t bits;
+  memcpy(&bits, &value, sizeof(bits));
+  buffer_put_le64(buffer, bits);
+}
+
+static void buffer_cleanup(struct buffer *buffer) {
+  free(buffer->data);
+  buffer->data = NULL;
+  buffer->size = 0;
+  buffer->capacity = 0;
+}
+#endif
 
+/* Allocates units attributes without any rapid fire. */
+static struct units_attributes *create_units_attributes(uint8_t num_kinds) {
   struct units_attributes *units_attributes =
       malloc(sizeof(*units_attributes) + num_kinds * sizeof(*units_attributes->attributes));
   if (units_attributes == NULL) {
-    fputs("Parsing units attributes failed, allocation of attributes failed\n", stderr);
+    report_error("Parsing units attributes failed, allocation of attributes failed\n");
     goto fail;
   }
 
   uint32_t *rapid_fire = calloc((size_t)num_kinds * (size_t)num_kinds, sizeof(*rapid_fire));
   if (rapid_fire == NULL) {
-    fputs("Parsing units attributes failed, allocation of rapid fire failed\n", stderr);
+    report_error("Parsing units attributes failed, allocation of rapid fire failed\n");
     goto fail_units_attributes;
   }
 
   units_attributes->num_kinds = num_kinds;
   units_attributes->rapid_fire = rapid_fire;
+  for (uint8_t kind = 0; kind < num_kinds; kind++) {
+    units_attributes->attributes[kind].rapid_fire = rapid_fire + (size_t)kind * (size_t)num_kinds;
+  }
+
+  return units_attributes;
+
+fail_units_attributes:
+  free(units_attributes);
+fail:
+  return NULL;
+}
+
+static void cleanup_units_attributes(struct units_attributes *units_attributes) {
+  free(units_attributes->rapid_fire);
+  free(units_attributes);
+}
+
+static size_t calc_combatants_alloc_size(const struct units_attributes *restrict units_attributes,
+                                         uint32_t num_combatants) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+  return num_combatants * sizeof(struct combatant) + num_combatants * num_kinds * sizeof(uint64_t) +
+         num_combatants * MAX_ROUNDS * num_kinds * sizeof(struct unit_group_stats);
+}
+
+/* Points unit groups and stats of the combatants into their allocation, see calc_combatants_alloc_size(). */
+static void init_combatants_layout(struct combatant *combatants, uint32_t num_combatants, uint8_t num_kinds) {
+  uint64_t *unit_groups = (uint64_t *)&combatants[num_combatants];
+  struct unit_group_stats *stats = (struct unit_group_stats *)&unit_groups[num_combatants * num_kinds];
+
+  for (uint32_t i = 0; i < num_combatants; i++, unit_groups += num_kinds, stats += MAX_ROUNDS * num_kinds) {
+    combatants[i].unit_groups = unit_groups;
+    combatants[i].stats = stats;
+  }
+}
+
+static void copy_combatants(struct combatant *restrict dst, const struct combatant *restrict src, size_t size,
+                            uint32_t num_combatants, uint8_t num_kinds) {
+  memcpy(dst, src, size);
+  init_combatants_layout(dst, num_combatants, num_kinds);
+}
+
+#ifndef BATTLE_ENGINE_LIBRARY
+static struct units_attributes *load_units_attributes(FILE *file) {
+  int n;
+
+  uint8_t num_kinds;
+  n = fscanf(file, "%" SCNu8, &num_kinds);
+  if (n != 1) {
+    report_error("Parsing units attributes failed, cannot scan num_kinds\n");
+    goto fail;
+  }
+
+  if (num_kinds == 0) {
+    report_error("Parsing units attributes failed, num_kinds must be greater than 0\n");
+    goto fail;
+  }
+
+  struct units_attributes *units_attributes = create_units_attributes(num_kinds);
+  if (units_attributes == NULL) {
+    goto fail;
+  }
 
   for (uint8_t kind = 0; kind < num_kinds; kind++) {
     struct unit_attributes *attr = &units_attributes->attributes[kind];
-    attr->rapid_fire = rapid_fire + (size_t)kind * (size_t)num_kinds;
 
     uint8_t num_rapid_fire;
     n = fscanf(file, "%f%f%f%" SCNu8, &attr->weapons, &attr->shield, &attr->armor, &num_rapid_fire);
     if (n != 4) {
-      fprintf(stderr, "Parsing units attributes failed, cannot scan kind #%" PRIu8 "\n", kind);
-      goto fail_rapid_fire;
+      report_error("Parsing units attributes failed, cannot scan kind #%" PRIu8 "\n", kind);
+      goto fail_units_attributes;
     }
 
     for (uint32_t i = 0; i < num_rapid_fire; i++) {
@@ -132,19 +511,17 @@ static struct units_attributes *load_units_attributes(FILE *file) {
       uint32_t rf;
       n = fscanf(file, "%" SCNu8 "%" SCNu32, &target_kind, &rf);
       if (n != 2) {
-        fprintf(stderr,
-                "Parsing units attributes failed, cannot scan rapid fire "
-                "#%" PRIu32 " for kind #%" PRIu8 "\n",
-                i, kind);
-        goto fail_rapid_fire;
+        report_error("Parsing units attributes failed, cannot scan rapid fire "
+                     "#%" PRIu32 " for kind #%" PRIu8 "\n",
+                     i, kind);
+        goto fail_units_attributes;
       }
 
       if (target_kind >= num_kinds) {
-        fprintf(stderr,
-                "Parsing units attributes failed, rapid fire #%" PRIu32 " is "
-                "invalid for kind #%" PRIu8 "\n",
-                i, kind);
-        goto fail_rapid_fire;
+        report_error("Parsing units attributes failed, rapid fire #%" PRIu32 " is "
+                     "invalid for kind #%" PRIu8 "\n",
+                     i, kind);
+        goto fail_units_attributes;
       }
 
       attr->rapid_fire[target_kind] = rf;
@@ -153,26 +530,12 @@ static struct units_attributes *load_units_attributes(FILE *file) {
 
   return units_attributes;
 
-fail_rapid_fire:
-  free(rapid_fire);
 fail_units_attributes:
-  free(units_attributes);
+  cleanup_units_attributes(units_attributes);
 fail:
   return NULL;
 }
 
-static void cleanup_units_attributes(struct units_attributes *units_attributes) {
-  free(units_attributes->rapid_fire);
-  free(units_attributes);
-}
-
-static size_t calc_combatants_alloc_size(const struct units_attributes *restrict units_attributes,
-                                         uint32_t num_combatants) {
-  const uint8_t num_kinds = units_attributes->num_kinds;
-  return num_combatants * sizeof(struct combatant) + num_combatants * num_kinds * sizeof(uint64_t) +
-         num_combatants * MAX_ROUNDS * num_kinds * sizeof(struct unit_group_stats);
-}
-
 static struct combatant *load_combatants(FILE *restrict file, const struct units_attributes *restrict units_attributes,
                                          uint32_t num_combatants) {
   const uint8_t num_kinds = units_attributes->num_kinds;
@@ -184,23 +547,21 @@ static struct combatant *load_combatants(FILE *restrict file, const struct units
   size_t total_size = calc_combatants_alloc_size(units_attributes, num_combatants);
   struct combatant *combatants = calloc(total_size, 1);
   if (combatants == NULL) {
-    fputs("Loading combatants failed, allocation of combatants failed\n", stderr);
+    report_error("Loading combatants failed, allocation of combatants failed\n");
     goto fail;
   }
 
-  uint64_t *unit_groups = (uint64_t *)&combatants[num_combatants];
-  struct unit_group_stats *stats = (struct unit_group_stats *)&unit_groups[num_combatants * num_kinds];
+  init_combatants_layout(combatants, num_combatants, num_kinds);
 
-  for (uint32_t i = 0; i < num_combatants; i++, unit_groups += num_kinds, stats += MAX_ROUNDS * num_kinds) {
+  for (uint32_t i = 0; i < num_combatants; i++) {
     struct combatant *c = &combatants[i];
-    c->unit_groups = unit_groups;
-    c->stats = stats;
+    uint64_t *unit_groups = c->unit_groups;
 
     uint8_t num_unit_groups;
     n = fscanf(file, "%" SCNu8 "%" SCNu8 "%" SCNu8 "%" SCNu8, &c->weapons_technology, &c->shielding_technology,
                &c->armor_technology, &num_unit_groups);
     if (n != 4) {
-      fprintf(stderr, "Loading combatants failed, cannot scan combatant #%" PRIu32 "\n", i);
+      report_error("Loading combatants failed, cannot scan combatant #%" PRIu32 "\n", i);
       goto fail_combatants;
     }
 
@@ -209,18 +570,16 @@ static struct combatant *load_combatants(FILE *restrict file, const struct units
       uint64_t num_units;
       n = fscanf(file, "%" SCNu8 "%" SCNu64, &kind, &num_units);
       if (n != 2) {
-        fprintf(stderr,
-                "Loading combatants failed, cannot scan unit group #%" PRIu8 " "
-                "for combatant #%" PRIu32 "\n",
-                j, i);
+        report_error("Loading combatants failed, cannot scan unit group #%" PRIu8 " "
+                     "for combatant #%" PRIu32 "\n",
+                     j, i);
         goto fail_combatants;
       }
 
       if (kind >= num_kinds) {
-        fprintf(stderr,
-                "Loading combatants failed, unit group #%" PRIu8 " is invalid "
-                "for combatant #%" PRIu32 "\n",
-                j, i);
+        report_error("Loading combatants failed, unit group #%" PRIu8 " is invalid "
+                     "for combatant #%" PRIu32 "\n",
+                     j, i);
         goto fail_combatants;
       }
 
@@ -235,6 +594,64 @@ fail_combatants:
 fail:
   return NULL;
 }
+#endif
+
+static bool reserve_units(struct unit **restrict units, uint64_t *restrict capacity, uint64_t size) {
+  if (size <= *capacity) {
+    return true;
+  }
+
+  uint64_t new_capacity = *capacity != 0 ? *capacity : 16;
+  while (new_capacity < size) {
+    new_capacity = new_capacity <= MAX_UNITS / 2 ? 2 * new_capacity : MAX_UNITS;
+  }
+
+  if (new_capacity > SIZE_MAX / sizeof(struct unit)) {
+    report_error("Allocating memory for party units failed\n");
+    return false;
+  }
+
+  struct unit *new_units = realloc(*units, (size_t)new_capacity * sizeof(**units));
+  if (new_units == NULL) {
+    report_error("Allocating memory for party units failed\n");
+    return false;
+  }
+
+  *units = new_units;
+  *capacity = new_capacity;
+  return true;
+}
+
+static void update_offsets(struct party *party) {
+  uint64_t offset = 0;
+  for (uint32_t b = 0; b < party->num_blocks; b++) {
+    party->offsets[b] = offset;
+    offset += party->blocks[b].num_damaged + party->blocks[b].num_undamaged;
+  }
+  party->offsets[party->num_blocks] = offset;
+  party->num_alive = offset;
+}
+
+static void cleanup_party(struct party *party) {
+  if (party->blocks != NULL) {
+    for (uint32_t b = 0; b < party->num_blocks; b++) {
+      free(party->blocks[b].damaged);
+      free(party->blocks[b].hit);
+    }
+  }
+  free(party->offsets);
+  free(party->blocks);
+  free(party);
+}
+
+static NOINLINE void init_block(struct block *restrict block, const struct units_attributes *restrict units_attributes,
+                                const struct combatant *restrict combatant, uint8_t kind, uint8_t combatant_id) {
+  const struct unit_attributes *attrs = &units_attributes->attributes[kind];
+  block->max_shield = attrs->shield * (1.0f + 0.1f * combatant->shielding_technology);
+  block->max_hull = 0.1f * attrs->armor * (1.0f + 0.1f * combatant->armor_technology);
+  block->kind = kind;
+  block->combatant_id = combatant_id;
+}
 
 static struct party *create_party(const struct units_attributes *restrict units_attributes,
                                   struct combatant *combatants, uint32_t num_combatants) {
@@ -242,172 +659,295 @@ static struct party *create_party(const struct units_attributes *restrict units_
 
   assert(num_combatants <= 256);
 
-  struct party *party = malloc(sizeof(*party));
+  struct party *party = calloc(1, sizeof(*party));
   if (party == NULL) {
-    fputs("Allocating memory for a party failed\n", stderr);
+    report_error("Allocating memory for a party failed\n");
     goto fail;
   }
 
   uint64_t total_units = 0;
+  uint32_t num_blocks = 0;
   for (uint32_t i = 0; i < num_combatants; i++) {
     for (uint8_t kind = 0; kind < num_kinds; kind++) {
       uint64_t num_units = combatants[i].unit_groups[kind];
 
       if (num_units > MAX_UNITS - total_units) {
-        fputs("Too many units\n", stderr);
+        report_error("Too many units\n");
         goto fail_party;
       }
 
       total_units += num_units;
+      num_blocks += num_units != 0;
     }
   }
 
-  assert(total_units <= SIZE_MAX / sizeof(struct unit));
-  struct unit *units = malloc(total_units * sizeof(*units));
-  if (units == NULL) {
-    fputs("Allocating memory for party units failed\n", stderr);
+  party->combatants = combatants;
+  party->blocks = calloc(num_blocks != 0 ? num_blocks : 1, sizeof(*party->blocks));
+  party->offsets = malloc((num_blocks + 1) * sizeof(*party->offsets));
+  if (party->blocks == NULL || party->offsets == NULL) {
+    report_error("Allocating memory for party units failed\n");
     goto fail_party;
   }
 
-  party->combatants = combatants;
-  party->units = units;
-  party->num_alive = total_units;
-
+  /* Blocks are in the order of combatants and kinds, the order in which units fire. */
   for (uint32_t i = 0; i < num_combatants; i++) {
     const struct combatant *combatant = &combatants[i];
     for (uint8_t kind = 0; kind < num_kinds; kind++) {
-      float max_hull = 0.1f * units_attributes->attributes[kind].armor * (1.0f + 0.1f * combatant->armor_technology);
-      for (uint32_t j = 0; j < combatant->unit_groups[kind]; j++) {
-        struct unit *unit = units++;
-        unit->hull = max_hull;
-        unit->kind = kind;
-        unit->combatant_id = (uint8_t)i;
+      if (combatant->unit_groups[kind] == 0) {
+        continue;
       }
+
+      struct block *block = &party->blocks[party->num_blocks++];
+      init_block(block, units_attributes, combatant, kind, (uint8_t)i);
+      block->num_undamaged = combatant->unit_groups[kind];
     }
   }
 
+  update_offsets(party);
+
   return party;
 
 fail_party:
-  free(party);
+  cleanup_party(party);
 fail:
   return NULL;
 }
 
-static void restore_shields(const struct units_attributes *restrict units_attributes, struct party *restrict party) {
-  const struct combatant *combatants = party->combatants;
-  struct unit *units = party->units;
-  uint64_t num_alive = party->num_alive;
+static void restore_shields(struct party *party) {
+  /* Undamaged units get full shields when they are materialized. */
+  for (uint32_t b = 0; b < party->num_blocks; b++) {
+    struct block *block = &party->blocks[b];
+    for (uint64_t i = 0; i < block->num_damaged; i++) {
+      block->damaged[i].shield = block->max_shield;
+    }
+  }
+}
 
-  for (uint64_t i = 0; i < num_alive; i++) {
-    struct unit *unit = &units[i];
-    unit->shield = units_attributes->attributes[unit->kind].shield *
-                   (1.0f + 0.1f * combatants[unit->combatant_id].shielding_technology);
+/* Returns the block of the unit with the given index. */
+static inline uint32_t find_block(const struct party *party, uint64_t index) {
+  const uint64_t *offsets = party->offsets;
+  uint32_t low = 0, high = party->num_blocks;
+  while (high - low > 1) {
+    uint32_t middle = low + (high - low) / 2;
+    if (offsets[middle] <= index) {
+      low = middle;
+    } else {
+      high = middle;
+    }
   }
+  return low;
 }
 
-static void fire(const struct units_attributes *restrict units_attributes, struct party *restrict attackers_party,
-                 struct party *restrict defenders_party, uint32_t round, uint32_t *restrict random) {
-  const uint8_t num_kinds = units_attributes->num_kinds;
+/* Returns the block and the unit with the given index, materializing the unit if it is undamaged. */
+static struct unit *find_target(struct party *restrict party, uint64_t index, struct block **restrict target_block) {
+  const uint64_t *offsets = party->offsets;
+  uint32_t low = find_block(party, index);
 
-  uint32_t r = *random;
+  struct block *block = &party->blocks[low];
+  *target_block = block;
 
-  struct combatant *attackers = attackers_party->combatants;
-  struct unit *shooters = attackers_party->units;
-  uint64_t num_shooters = attackers_party->num_alive;
+  uint64_t j = index - offsets[low];
+  if (j < block->num_damaged) {
+    return &block->damaged[j];
+  }
 
-  struct combatant *defenders = defenders_party->combatants;
-  struct unit *targets = defenders_party->units;
-  uint64_t num_targets = defenders_party->num_alive;
+  j -= block->num_damaged;
+  if (j < block->num_hit) {
+    return &block->hit[j];
+  }
 
-  for (uint64_t i = 0; i < num_shooters; i++) {
-    const struct unit *shooter = &shooters[i];
-    uint8_t shooter_kind = shooter->kind;
+  if (!reserve_units(&block->hit, &block->hit_capacity, block->num_hit + 1)) {
+    return NULL;
+  }
 
-    const struct unit_attributes *shooter_attrs = &units_attributes->attributes[shooter_kind];
+  struct unit *unit = &block->hit[block->num_hit++];
+  unit->shield = block->max_shield;
+  unit->hull = block->max_hull;
+  return unit;
+}
 
-    struct combatant *attacker = &attackers[shooter->combatant_id];
+/*
+ * Applies the shield and hull damage of a shot to a unit that is not destroyed. Returns the new hull, which is not
+ * stored yet, as the explosion check comes next.
+ */
+static inline float damage_unit(struct unit *restrict target, float damage, float max_shield,
+                                struct unit_group_stats *restrict shooter_stats,
+                                struct unit_group_stats *restrict target_stats) {
+  float hull = target->hull;
+  float hull_damage = damage - target->shield;
 
-    struct unit_group_stats *shooter_stats = &attacker->stats[round * num_kinds + shooter_kind];
+  if (hull_damage < 0.0f) {
+    float shield_damage = 0.01f * floorf(100.0f * damage / max_shield) * max_shield;
+    target->shield -= shield_damage;
 
-    float damage = shooter_attrs->weapons * (1.0f + 0.1f * attackers[shooter->combatant_id].weapons_technology);
+    shooter_stats->shield_damage_dealt += (uint64_t)shield_damage;
+    target_stats->shield_damage_taken += (uint64_t)shield_damage;
+  } else {
+    shooter_stats->shield_damage_dealt += (uint64_t)target->shield;
+    target_stats->shield_damage_taken += (uint64_t)target->shield;
 
-    uint32_t rapid_fire;
+    target->shield = 0.0f;
+    if (hull_damage > hull) {
+      hull_damage = hull;
+    }
+    hull -= hull_damage;
 
-    do {
-      r = RANDOM_NEXT(r);
-      struct unit *target = &targets[r % num_targets];
-      uint8_t target_kind = target->kind;
+    shooter_stats->hull_damage_dealt += (uint64_t)hull_damage;
+    target_stats->hull_damage_taken += (uint64_t)hull_damage;
+  }
 
-      const struct unit_attributes *target_attrs = &units_attributes->attributes[target_kind];
+  return hull;
+}
 
-      struct combatant *defender = &defenders[target->combatant_id];
+/* Fires a shot and all the following rapid fire shots of one shooter. rng must be of the given kind. */
+static inline bool fire_shooter(const struct units_attributes *restrict units_attributes,
+                                const struct unit_attributes *restrict shooter_attrs,
+                                struct unit_group_stats *restrict shooter_stats, float damage,
+                                struct party *restrict defenders_party, uint32_t round, struct rng *restrict rng,
+                                const enum rng_kind kind) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
 
-      struct unit_group_stats *target_stats = &defender->stats[round * num_kinds + target_kind];
+  struct combatant *defenders = defenders_party->combatants;
+  uint64_t num_targets = defenders_party->num_alive;
 
-      shooter_stats->times_fired++;
-      target_stats->times_was_shot++;
+  uint32_t rapid_fire;
 
-      if (target->hull != 0.0f) {
-        float hull = target->hull;
-        float hull_damage = damage - target->shield;
+  do {
+    struct block *target_block;
+    struct unit *target = find_target(defenders_party, rng_below(rng, kind, num_targets), &target_block);
+    if (target == NULL) {
+      return false;
+    }
+    uint8_t target_kind = target_block->kind;
 
-        if (hull_damage < 0.0f) {
-          float max_shield = target_attrs->shield * (1.0f + 0.1f * defender->shielding_technology);
-          float shield_damage = 0.01f * floorf(100.0f * damage / max_shield) * max_shield;
-          target->shield -= shield_damage;
+    const struct unit_attributes *target_attrs = &units_attributes->attributes[target_kind];
 
-          shooter_stats->shield_damage_dealt += (uint64_t)shield_damage;
-          target_stats->shield_damage_taken += (uint64_t)shield_damage;
-        } else {
-          shooter_stats->shield_damage_dealt += (uint64_t)target->shield;
-          target_stats->shield_damage_taken += (uint64_t)target->shield;
+    struct combatant *defender = &defenders[target_block->combatant_id];
 
-          target->shield = 0.0f;
-          if (hull_damage > hull) {
-            hull_damage = hull;
-          }
-          hull -= hull_damage;
+    struct unit_group_stats *target_stats = &defender->stats[round * num_kinds + target_kind];
 
-          shooter_stats->hull_damage_dealt += (uint64_t)hull_damage;
-          target_stats->hull_damage_taken += (uint64_t)hull_damage;
-        }
+    shooter_stats->times_fired++;
+    target_stats->times_was_shot++;
+
+    if (target->hull != 0.0f) {
+      float max_shield = target_attrs->shield * (1.0f + 0.1f * defender->shielding_technology);
+      float hull = damage_unit(target, damage, max_shield, shooter_stats, target_stats);
 
-        if (hull != 0.0f) {
-          float max_hull = 0.1f * target_attrs->armor * (1.0f + 0.1f * defender->armor_technology);
-          if (hull < 0.7f * max_hull) {
-            r = RANDOM_NEXT(r);
-            if (hull < (1.0f / (float)RANDOM_MAX) * (float)r * max_hull) {
-              hull = 0.0f;
-            }
+      if (hull != 0.0f) {
+        float max_hull = 0.1f * target_attrs->armor * (1.0f + 0.1f * defender->armor_technology);
+        if (hull < 0.7f * max_hull) {
+          if (hull < rng_unit(rng, kind) * max_hull) {
+            hull = 0.0f;
           }
         }
-        target->hull = hull;
       }
+      target->hull = hull;
+    }
+
+    rapid_fire = shooter_attrs->rapid_fire[target_kind];
+  } while (rapid_fire != 0 && rng_below32(rng, kind, rapid_fire) != 0);
+
+  return true;
+}
+
+/* Fires all the shots of a party. The loop is specialized for each kind of random number generator. */
+static inline bool fire_with(const struct units_attributes *restrict units_attributes,
+                             struct party *restrict attackers_party, struct party *restrict defenders_party,
+                             uint32_t round, struct rng *restrict random, struct round_profile *restrict profile,
+                             const enum rng_kind kind) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
 
-      rapid_fire = shooter_attrs->rapid_fire[target_kind];
-    } while (rapid_fire != 0 && (r = RANDOM_NEXT(r)) % rapid_fire != 0);
+  struct combatant *attackers = attackers_party->combatants;
+
+  /* A local copy lets the compiler keep the generator state in registers. */
+  struct rng rng = *random;
+
+  for (uint32_t b = 0; b < attackers_party->num_blocks; b++) {
+    const struct block *block = &attackers_party->blocks[b];
+    const struct unit_attributes *shooter_attrs = &units_attributes->attributes[block->kind];
+    struct combatant *attacker = &attackers[block->combatant_id];
+    struct unit_group_stats *shooter_stats = &attacker->stats[round * num_kinds + block->kind];
+    float damage = shooter_attrs->weapons * (1.0f + 0.1f * attacker->weapons_technology);
+
+    /* Units destroyed in this round still fire, they are removed in update_units(). */
+    uint64_t num_shooters = block->num_damaged + block->num_undamaged;
+    for (uint64_t i = 0; i < num_shooters; i++) {
+      uint64_t times_fired = shooter_stats->times_fired;
+      if (!fire_shooter(units_attributes, shooter_attrs, shooter_stats, damage, defenders_party, round, &rng, kind)) {
+        return false;
+      }
+      if (profile != NULL) {
+        uint64_t chain = shooter_stats->times_fired - times_fired;
+        profile->num_chains++;
+        profile->num_shots += chain;
+        if (chain > profile->max_chain) {
+          profile->max_chain = chain;
+        }
+      }
+    }
   }
 
-  *random = r;
+  *random = rng;
+  return true;
 }
 
-static void update_units(const struct units_attributes *restrict units_attributes,
+static bool fire(const struct units_attributes *restrict units_attributes, struct party *restrict attackers_party,
+                 struct party *restrict defenders_party, uint32_t round, struct rng *restrict random,
+                 struct round_profile *restrict profile) {
+  if (random->kind == RNG_LEHMER) {
+    return fire_with(units_attributes, attackers_party, defenders_party, round, random, profile, RNG_LEHMER);
+  }
+  return fire_with(units_attributes, attackers_party, defenders_party, round, random, profile, RNG_XOSHIRO);
+}
+
+static bool update_units(const struct units_attributes *restrict units_attributes,
                          struct combatant *restrict combatants, struct party *restrict party, uint32_t round) {
   const uint8_t num_kinds = units_attributes->num_kinds;
-  struct unit *units = party->units;
-  uint64_t num_alive = party->num_alive, n = 0;
 
-  for (uint64_t i = 0; i < num_alive; i++) {
-    struct unit *unit = &units[i];
-    if (unit->hull != 0.0f) {
-      units[n++] = *unit;
-      struct combatant *combatant = &combatants[unit->combatant_id];
-      combatant->stats[round * num_kinds + unit->kind].num_remaining_units++;
+  uint32_t num_blocks = 0;
+  for (uint32_t b = 0; b < party->num_blocks; b++) {
+    struct block *block = &party->blocks[b];
+
+    uint64_t n = 0;
+    for (uint64_t i = 0; i < block->num_damaged; i++) {
+      if (block->damaged[i].hull != 0.0f) {
+        block->damaged[n++] = block->damaged[i];
+      }
+    }
+
+    /* Hit undamaged units: destroyed ones are removed, damaged ones are moved, the others are undamaged again. */
+    for (uint64_t j = 0; j < block->num_hit; j++) {
+      const struct unit *unit = &block->hit[j];
+      if (unit->hull == block->max_hull) {
+        continue;
+      }
+
+      block->num_undamaged--;
+      if (unit->hull != 0.0f) {
+        if (!reserve_units(&block->damaged, &block->damaged_capacity, n + 1)) {
+          return false;
+        }
+        block->damaged[n++] = *unit;
+      }
+    }
+
+    block->num_damaged = n;
+    block->num_hit = 0;
+
+    uint64_t num_remaining = block->num_damaged + block->num_undamaged;
+    combatants[block->combatant_id].stats[round * num_kinds + block->kind].num_remaining_units += num_remaining;
+
+    if (num_remaining != 0) {
+      party->blocks[num_blocks++] = *block;
+    } else {
+      free(block->damaged);
+      free(block->hit);
     }
   }
 
-  party->num_alive = n;
+  party->num_blocks = num_blocks;
+  update_offsets(party);
+  return true;
 }
 
 static void update_combatants(const struct units_attributes *restrict units_attributes,
@@ -420,81 +960,2627 @@ static void update_combatants(const struct units_attributes *restrict units_attr
     memset(combatant->unit_groups, 0, num_kinds * sizeof(*combatant->unit_groups));
   }
 
-  for (uint64_t i = 0; i < party->num_alive; i++) {
-    const struct unit *unit = &party->units[i];
-    combatants[unit->combatant_id].unit_groups[unit->kind]++;
+  for (uint32_t b = 0; b < party->num_blocks; b++) {
+    const struct block *block = &party->blocks[b];
+    combatants[block->combatant_id].unit_groups[block->kind] = block->num_damaged + block->num_undamaged;
   }
 }
 
-static bool fight(const struct units_attributes *restrict units_attributes, struct combatant *restrict attackers,
+/* Fights the rounds from *round until last_round or until a party is destroyed, *round is the next round to fight. */
+static NOINLINE bool fight_rounds(const struct units_attributes *restrict units_attributes,
+                                  struct combatant *restrict attackers, struct combatant *restrict defenders,
+                                  struct party *restrict attackers_party, struct party *restrict defenders_party,
+                                  uint32_t *restrict round, uint32_t last_round, struct rng *restrict random,
+                                  struct round_profile *restrict profile) {
+  while (*round < last_round && attackers_party->num_alive > 0 && defenders_party->num_alive > 0) {
+    struct round_profile *round_profile = profile != NULL ? &profile[*round] : NULL;
+    uint64_t start = round_profile != NULL ? now_ns() : 0;
+
+    restore_shields(attackers_party);
+    restore_shields(defenders_party);
+
+    if (!fire(units_attributes, attackers_party, defenders_party, *round, random, round_profile) ||
+        !fire(units_attributes, defenders_party, attackers_party, *round, random, round_profile) ||
+        !update_units(units_attributes, attackers, attackers_party, *round) ||
+        !update_units(units_attributes, defenders, defenders_party, *round)) {
+      return false;
+    }
+
+    if (round_profile != NULL) {
+      round_profile->num_fights++;
+      round_profile->time_ns += now_ns() - start;
+    }
+
+    (*round)++;
+  }
+
+  return true;
+}
+
+static bool fight(const struct units_attributes *restrict units_attributes, struct combatant *restrict attackers,
                   uint32_t num_attackers, struct combatant *restrict defenders, uint32_t num_defenders,
-                  uint32_t *restrict num_rounds, uint32_t *restrict random) {
+                  uint32_t *restrict num_rounds, struct rng *restrict random, struct round_profile *restrict profile) {
+  bool ret = false;
+
+  struct party *attackers_party = create_party(units_attributes, attackers, num_attackers);
+  if (attackers_party == NULL) {
+    goto out;
+  }
+
+  struct party *defenders_party = create_party(units_attributes, defenders, num_defenders);
+  if (defenders_party == NULL) {
+    goto out_attackers_party;
+  }
+
+  uint32_t round = 0;
+  if (!fight_rounds(units_attributes, attackers, defenders, attackers_party, defenders_party, &round, MAX_ROUNDS,
+                    random, profile)) {
+    goto out_defenders_party;
+  }
+
+  *num_rounds = round;
+
+  update_combatants(units_attributes, attackers, num_attackers, attackers_party);
+  update_combatants(units_attributes, defenders, num_defenders, defenders_party);
+
+  ret = true;
+
+out_defenders_party:
+  cleanup_party(defenders_party);
+out_attackers_party:
+  cleanup_party(attackers_party);
+out:
+  return ret;
+}
+
+/*
+ * Parallel fights (--battle-threads): the rounds of one battle are fought by several threads. Shooters are split into
+ * chunks of PARALLEL_CHUNK_SHOOTERS, and every chunk draws its shots from its own random stream. A shot is drawn with
+ * its target, its explosion roll and the rapid fire roll that follows it, which depends only on the kind of the target,
+ * so chunks are independent. Shots are then applied by partitions of the targets, every unit getting its shots in the
+ * order of chunks as in fight(), and stats are summed per thread. Targets are split in the same partitions whatever the
+ * number of threads, so results depend on the seed but not on the number of threads. They are statistically
+ * equivalent to fight() but not the same, random numbers are drawn in another order.
+ */
+#define MAX_BATTLE_THREADS 1024
+#define PARALLEL_CHUNK_SHOOTERS 16384
+/* Shots are drawn and applied for this many chunks at a time, which bounds the memory used by shots. */
+#define PARALLEL_WAVE_CHUNKS 64
+#define PARALLEL_PARTITIONS 256
+/* Blocks with fewer damaged units are compacted by one thread. */
+#define PARALLEL_MIN_UNITS 65536
+
+struct parallel_shot {
+  uint64_t target;
+  uint32_t shooter_block;
+  uint32_t target_block;
+  float roll;
+};
+
+/* The shots of a chunk of shooters, sorted by partition of their targets. */
+struct shot_chunk {
+  struct parallel_shot *shots;
+  struct parallel_shot *sorted;
+  size_t num_shots;
+  size_t capacity;
+  /* partition_offsets[p] is the index of the first sorted shot at the partition p. */
+  size_t partition_offsets[PARALLEL_PARTITIONS + 1];
+  struct round_profile profile;
+};
+
+/* The undamaged units of a block in a partition, hit units are materialized as in find_target(). */
+struct hit_segment {
+  struct unit *hit;
+  uint64_t num_hit;
+  uint64_t hit_capacity;
+  /* The index of the first undamaged unit of the block in the partition. */
+  uint64_t first;
+  /* The hit units that are not undamaged anymore, and the damaged ones and their offset in the block. */
+  uint64_t num_changed;
+  uint64_t num_damaged;
+  uint64_t offset;
+};
+
+/* Consecutive units of a party, with one segment for every block from first_block it overlaps. */
+struct partition {
+  struct hit_segment *segments;
+  uint32_t num_segments;
+  uint32_t segments_capacity;
+  uint32_t first_block;
+};
+
+struct parallel_side {
+  struct partition partitions[PARALLEL_PARTITIONS];
+  uint64_t partition_size;
+};
+
+struct parallel_fight {
+  uint32_t num_threads;
+  struct shot_chunk chunks[PARALLEL_WAVE_CHUNKS];
+  /* Attackers and defenders. */
+  struct parallel_side sides[2];
+  /* Stats of the current round per thread, attackers first, num_thread_stats per thread. */
+  struct unit_group_stats *thread_stats;
+  size_t num_thread_stats;
+  /* Damaged units are moved there when they are compacted by several threads. */
+  struct unit *spare;
+  uint64_t spare_capacity;
+  uint64_t segment_offsets[MAX_BATTLE_THREADS + 1];
+};
+
+static int thread_num(void) {
+#ifdef _OPENMP
+  return omp_get_thread_num();
+#else
+  return 0;
+#endif
+}
+
+/* Splits the units of a party in partitions before it is fired at. */
+static bool init_partitions(const struct party *restrict party, struct parallel_side *restrict side) {
+  side->partition_size = (party->num_alive + PARALLEL_PARTITIONS - 1) / PARALLEL_PARTITIONS;
+
+  for (uint32_t p = 0; p < PARALLEL_PARTITIONS; p++) {
+    struct partition *partition = &side->partitions[p];
+    partition->num_segments = 0;
+
+    uint64_t start = p * side->partition_size;
+    if (start >= party->num_alive) {
+      continue;
+    }
+    uint64_t end = party->num_alive - start < side->partition_size ? party->num_alive : start + side->partition_size;
+
+    uint32_t first_block = find_block(party, start);
+    uint32_t num_segments = find_block(party, end - 1) - first_block + 1;
+    if (num_segments > partition->segments_capacity) {
+      struct hit_segment *segments = realloc(partition->segments, num_segments * sizeof(*segments));
+      if (segments == NULL) {
+        report_error("Allocating memory for party units failed\n");
+        return false;
+      }
+      memset(&segments[partition->segments_capacity], 0,
+             (num_segments - partition->segments_capacity) * sizeof(*segments));
+      partition->segments = segments;
+      partition->segments_capacity = num_segments;
+    }
+
+    partition->first_block = first_block;
+    partition->num_segments = num_segments;
+    for (uint32_t s = 0; s < num_segments; s++) {
+      struct hit_segment *segment = &partition->segments[s];
+      uint64_t first_undamaged = party->offsets[first_block + s] + party->blocks[first_block + s].num_damaged;
+      segment->first = first_undamaged > start ? first_undamaged : start;
+      segment->num_hit = 0;
+    }
+  }
+
+  return true;
+}
+
+static bool reserve_shots(struct shot_chunk *chunk) {
+  if (chunk->num_shots < chunk->capacity) {
+    return true;
+  }
+
+  size_t capacity = chunk->capacity != 0 ? 2 * chunk->capacity : 4096;
+  struct parallel_shot *shots = realloc(chunk->shots, capacity * sizeof(*shots));
+  if (shots == NULL) {
+    report_error("Allocating memory for shots failed\n");
+    return false;
+  }
+  chunk->shots = shots;
+
+  /* The sorted shots are rewritten from scratch, they do not need to be copied. */
+  free(chunk->sorted);
+  chunk->sorted = malloc(capacity * sizeof(*chunk->sorted));
+  if (chunk->sorted == NULL) {
+    report_error("Allocating memory for shots failed\n");
+    return false;
+  }
+  chunk->capacity = capacity;
+  return true;
+}
+
+/* Draws the shots of a chunk of shooters. rng must be of the given kind. */
+static inline bool draw_shots(const struct units_attributes *restrict units_attributes,
+                              const struct party *restrict attackers_party,
+                              const struct party *restrict defenders_party, uint64_t partition_size,
+                              uint64_t chunk_index, struct shot_chunk *restrict chunk, struct rng *restrict rng,
+                              const enum rng_kind kind, struct unit_group_stats *restrict shooters_stats,
+                              struct unit_group_stats *restrict targets_stats) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+
+  uint64_t num_targets = defenders_party->num_alive;
+  uint64_t first = chunk_index * PARALLEL_CHUNK_SHOOTERS;
+  uint64_t last = attackers_party->num_alive - first < PARALLEL_CHUNK_SHOOTERS ? attackers_party->num_alive
+                                                                               : first + PARALLEL_CHUNK_SHOOTERS;
+
+  chunk->num_shots = 0;
+  memset(&chunk->profile, 0, sizeof(chunk->profile));
+
+  uint32_t b = find_block(attackers_party, first);
+  for (uint64_t i = first; i < last; i++) {
+    while (attackers_party->offsets[b + 1] <= i) {
+      b++;
+    }
+    const struct block *block = &attackers_party->blocks[b];
+    const struct unit_attributes *shooter_attrs = &units_attributes->attributes[block->kind];
+    struct unit_group_stats *shooter_stats = &shooters_stats[block->combatant_id * num_kinds + block->kind];
+
+    uint64_t chain = 0;
+    uint32_t rapid_fire;
+    do {
+      if (!reserve_shots(chunk)) {
+        return false;
+      }
+
+      struct parallel_shot *shot = &chunk->shots[chunk->num_shots++];
+      shot->target = rng_below(rng, kind, num_targets);
+      shot->shooter_block = b;
+      shot->target_block = find_block(defenders_party, shot->target);
+      shot->roll = rng_unit(rng, kind);
+
+      const struct block *target_block = &defenders_party->blocks[shot->target_block];
+      shooter_stats->times_fired++;
+      targets_stats[target_block->combatant_id * num_kinds + target_block->kind].times_was_shot++;
+      chain++;
+
+      rapid_fire = shooter_attrs->rapid_fire[target_block->kind];
+    } while (rapid_fire != 0 && rng_below32(rng, kind, rapid_fire) != 0);
+
+    chunk->profile.num_chains++;
+    chunk->profile.num_shots += chain;
+    if (chain > chunk->profile.max_chain) {
+      chunk->profile.max_chain = chain;
+    }
+  }
+
+  /* Counting sort by partition, the order of shots at the same partition is kept. */
+  size_t *offsets = chunk->partition_offsets;
+  memset(offsets, 0, sizeof(chunk->partition_offsets));
+  for (size_t i = 0; i < chunk->num_shots; i++) {
+    offsets[chunk->shots[i].target / partition_size + 1]++;
+  }
+  for (uint32_t p = 0; p < PARALLEL_PARTITIONS; p++) {
+    offsets[p + 1] += offsets[p];
+  }
+  for (size_t i = 0; i < chunk->num_shots; i++) {
+    chunk->sorted[offsets[chunk->shots[i].target / partition_size]++] = chunk->shots[i];
+  }
+  for (uint32_t p = PARALLEL_PARTITIONS; p > 0; p--) {
+    offsets[p] = offsets[p - 1];
+  }
+  offsets[0] = 0;
+
+  return true;
+}
+
+/* Applies the shots of the chunks at the partition p of the targets. */
+static bool apply_shots(const struct units_attributes *restrict units_attributes,
+                        const struct party *restrict attackers_party, struct party *restrict defenders_party,
+                        struct partition *restrict partition, const struct shot_chunk *restrict chunks, int num_chunks,
+                        uint32_t p, struct unit_group_stats *restrict shooters_stats,
+                        struct unit_group_stats *restrict targets_stats) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+
+  for (int c = 0; c < num_chunks; c++) {
+    const struct shot_chunk *chunk = &chunks[c];
+    for (size_t i = chunk->partition_offsets[p]; i < chunk->partition_offsets[p + 1]; i++) {
+      const struct parallel_shot *shot = &chunk->sorted[i];
+
+      struct block *block = &defenders_party->blocks[shot->target_block];
+      struct unit *target;
+      uint64_t j = shot->target - defenders_party->offsets[shot->target_block];
+      if (j < block->num_damaged) {
+        target = &block->damaged[j];
+      } else {
+        struct hit_segment *segment = &partition->segments[shot->target_block - partition->first_block];
+        uint64_t k = shot->target - segment->first;
+        if (k < segment->num_hit) {
+          target = &segment->hit[k];
+        } else {
+          if (!reserve_units(&segment->hit, &segment->hit_capacity, segment->num_hit + 1)) {
+            return false;
+          }
+          target = &segment->hit[segment->num_hit++];
+          target->shield = block->max_shield;
+          target->hull = block->max_hull;
+        }
+      }
+
+      if (target->hull == 0.0f) {
+        continue;
+      }
+
+      const struct block *shooter_block = &attackers_party->blocks[shot->shooter_block];
+      const struct combatant *attacker = &attackers_party->combatants[shooter_block->combatant_id];
+      float damage =
+          units_attributes->attributes[shooter_block->kind].weapons * (1.0f + 0.1f * attacker->weapons_technology);
+
+      float hull = damage_unit(target, damage, block->max_shield,
+                               &shooters_stats[shooter_block->combatant_id * num_kinds + shooter_block->kind],
+                               &targets_stats[block->combatant_id * num_kinds + block->kind]);
+      if (hull != 0.0f && hull < 0.7f * block->max_hull && hull < shot->roll * block->max_hull) {
+        hull = 0.0f;
+      }
+      target->hull = hull;
+    }
+  }
+
+  return true;
+}
+
+/* Fires all the shots of a party, see fire(). */
+static bool parallel_fire(const struct units_attributes *restrict units_attributes,
+                          struct party *restrict attackers_party, struct party *restrict defenders_party,
+                          struct parallel_fight *restrict parallel, struct parallel_side *restrict side,
+                          size_t shooters_offset, size_t targets_offset, struct rng *restrict random,
+                          struct round_profile *restrict profile) {
+  const enum rng_kind kind = random->kind;
+
+  if (!init_partitions(defenders_party, side)) {
+    return false;
+  }
+
+  /* Chunks of every fire get their streams from one number of the stream of the simulation. */
+  uint32_t seed = rng_below32(random, kind, UINT32_MAX);
+
+  uint64_t num_chunks = (attackers_party->num_alive + PARALLEL_CHUNK_SHOOTERS - 1) / PARALLEL_CHUNK_SHOOTERS;
+
+  for (uint64_t first = 0; first < num_chunks; first += PARALLEL_WAVE_CHUNKS) {
+    int count = (int)(num_chunks - first < PARALLEL_WAVE_CHUNKS ? num_chunks - first : PARALLEL_WAVE_CHUNKS);
+    int failed = 0;
+
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic) num_threads((int)parallel->num_threads) reduction(| : failed)
+#endif
+    for (int c = 0; c < count; c++) {
+      struct unit_group_stats *stats = &parallel->thread_stats[(size_t)thread_num() * parallel->num_thread_stats];
+      uint64_t chunk_index = first + (uint64_t)c;
+      struct rng rng;
+      init_rng(&rng, kind, seed, (uint32_t)chunk_index);
+      bool ok =
+          kind == RNG_LEHMER
+              ? draw_shots(units_attributes, attackers_party, defenders_party, side->partition_size, chunk_index,
+                           &parallel->chunks[c], &rng, RNG_LEHMER, &stats[shooters_offset], &stats[targets_offset])
+              : draw_shots(units_attributes, attackers_party, defenders_party, side->partition_size, chunk_index,
+                           &parallel->chunks[c], &rng, RNG_XOSHIRO, &stats[shooters_offset], &stats[targets_offset]);
+      if (!ok) {
+        failed = 1;
+      }
+    }
+
+    if (failed) {
+      return false;
+    }
+
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic) num_threads((int)parallel->num_threads) reduction(| : failed)
+#endif
+    for (int p = 0; p < PARALLEL_PARTITIONS; p++) {
+      struct unit_group_stats *stats = &parallel->thread_stats[(size_t)thread_num() * parallel->num_thread_stats];
+      if (!apply_shots(units_attributes, attackers_party, defenders_party, &side->partitions[p], parallel->chunks,
+                       count, (uint32_t)p, &stats[shooters_offset], &stats[targets_offset])) {
+        failed = 1;
+      }
+    }
+
+    if (failed) {
+      return false;
+    }
+
+    if (profile != NULL) {
+      for (int c = 0; c < count; c++) {
+        const struct round_profile *chunk_profile = &parallel->chunks[c].profile;
+        profile->num_chains += chunk_profile->num_chains;
+        profile->num_shots += chunk_profile->num_shots;
+        if (chunk_profile->max_chain > profile->max_chain) {
+          profile->max_chain = chunk_profile->max_chain;
+        }
+      }
+    }
+  }
+
+  return true;
+}
+
+static void parallel_restore_shields(struct party *restrict party, const struct parallel_fight *restrict parallel) {
+  for (uint32_t b = 0; b < party->num_blocks; b++) {
+    struct block *block = &party->blocks[b];
+    int64_t num_damaged = (int64_t)block->num_damaged;
+    float max_shield = block->max_shield;
+    struct unit *damaged = block->damaged;
+#ifdef _OPENMP
+#pragma omp parallel for num_threads((int)parallel->num_threads) if (num_damaged >= PARALLEL_MIN_UNITS)
+#endif
+    for (int64_t i = 0; i < num_damaged; i++) {
+      damaged[i].shield = max_shield;
+    }
+  }
+  (void)parallel;
+}
+
+/* Removes destroyed units from the damaged units of a block, in segments with several threads for large blocks. */
+static bool parallel_compact_damaged(struct block *restrict block, struct parallel_fight *restrict parallel) {
+  uint64_t num_damaged = block->num_damaged;
+
+  if (num_damaged < PARALLEL_MIN_UNITS || parallel->num_threads <= 1) {
+    uint64_t n = 0;
+    for (uint64_t i = 0; i < num_damaged; i++) {
+      if (block->damaged[i].hull != 0.0f) {
+        block->damaged[n++] = block->damaged[i];
+      }
+    }
+    block->num_damaged = n;
+    return true;
+  }
+
+  if (!reserve_units(&parallel->spare, &parallel->spare_capacity, num_damaged)) {
+    return false;
+  }
+
+  int num_segments = (int)parallel->num_threads;
+  uint64_t *offsets = parallel->segment_offsets;
+  const struct unit *damaged = block->damaged;
+  struct unit *spare = parallel->spare;
+
+#ifdef _OPENMP
+#pragma omp parallel for num_threads(num_segments)
+#endif
+  for (int s = 0; s < num_segments; s++) {
+    uint64_t n = 0;
+    for (uint64_t i = num_damaged * (uint64_t)s / (uint64_t)num_segments;
+         i < num_damaged * (uint64_t)(s + 1) / (uint64_t)num_segments; i++) {
+      n += damaged[i].hull != 0.0f;
+    }
+    offsets[s + 1] = n;
+  }
+
+  offsets[0] = 0;
+  for (int s = 0; s < num_segments; s++) {
+    offsets[s + 1] += offsets[s];
+  }
+
+#ifdef _OPENMP
+#pragma omp parallel for num_threads(num_segments)
+#endif
+  for (int s = 0; s < num_segments; s++) {
+    uint64_t n = offsets[s];
+    for (uint64_t i = num_damaged * (uint64_t)s / (uint64_t)num_segments;
+         i < num_damaged * (uint64_t)(s + 1) / (uint64_t)num_segments; i++) {
+      if (damaged[i].hull != 0.0f) {
+        spare[n++] = damaged[i];
+      }
+    }
+  }
+
+  /* The compacted units are in the spare buffer, the old units become the spare buffer. */
+  parallel->spare = block->damaged;
+  block->damaged = spare;
+  uint64_t capacity = block->damaged_capacity;
+  block->damaged_capacity = parallel->spare_capacity;
+  parallel->spare_capacity = capacity;
+  block->num_damaged = offsets[num_segments];
+  return true;
+}
+
+/* Same as update_units(), hit undamaged units are in the segments of the partitions of the side. */
+static bool parallel_update_units(const struct units_attributes *restrict units_attributes,
+                                  struct combatant *restrict combatants, struct party *restrict party,
+                                  struct parallel_fight *restrict parallel, struct parallel_side *restrict side,
+                                  uint32_t round) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+
+  /* Hit units that are still undamaged are dropped, damaged ones are kept at the start of their segment. */
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic) num_threads((int)parallel->num_threads)
+#endif
+  for (int p = 0; p < PARALLEL_PARTITIONS; p++) {
+    struct partition *partition = &side->partitions[p];
+    for (uint32_t s = 0; s < partition->num_segments; s++) {
+      struct hit_segment *segment = &partition->segments[s];
+      float max_hull = party->blocks[partition->first_block + s].max_hull;
+      uint64_t num_changed = 0, n = 0;
+      for (uint64_t i = 0; i < segment->num_hit; i++) {
+        float hull = segment->hit[i].hull;
+        if (hull != max_hull) {
+          num_changed++;
+          if (hull != 0.0f) {
+            segment->hit[n++] = segment->hit[i];
+          }
+        }
+      }
+      segment->num_changed = num_changed;
+      segment->num_damaged = n;
+    }
+  }
+
+  for (uint32_t b = 0; b < party->num_blocks; b++) {
+    if (!parallel_compact_damaged(&party->blocks[b], parallel)) {
+      return false;
+    }
+  }
+
+  /* Newly damaged units are appended in the order of partitions. */
+  for (uint32_t p = 0; p < PARALLEL_PARTITIONS; p++) {
+    struct partition *partition = &side->partitions[p];
+    for (uint32_t s = 0; s < partition->num_segments; s++) {
+      struct hit_segment *segment = &partition->segments[s];
+      struct block *block = &party->blocks[partition->first_block + s];
+      segment->offset = block->num_damaged;
+      block->num_damaged += segment->num_damaged;
+      block->num_undamaged -= segment->num_changed;
+      if (!reserve_units(&block->damaged, &block->damaged_capacity, block->num_damaged)) {
+        return false;
+      }
+    }
+  }
+
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic) num_threads((int)parallel->num_threads)
+#endif
+  for (int p = 0; p < PARALLEL_PARTITIONS; p++) {
+    const struct partition *partition = &side->partitions[p];
+    for (uint32_t s = 0; s < partition->num_segments; s++) {
+      const struct hit_segment *segment = &partition->segments[s];
+      /* Both arrays may be NULL if no unit was damaged. */
+      if (segment->num_damaged != 0) {
+        memcpy(&party->blocks[partition->first_block + s].damaged[segment->offset], segment->hit,
+               segment->num_damaged * sizeof(*segment->hit));
+      }
+    }
+  }
+
+  uint32_t num_blocks = 0;
+  for (uint32_t b = 0; b < party->num_blocks; b++) {
+    struct block *block = &party->blocks[b];
+    uint64_t num_remaining = block->num_damaged + block->num_undamaged;
+    combatants[block->combatant_id].stats[round * num_kinds + block->kind].num_remaining_units += num_remaining;
+
+    if (num_remaining != 0) {
+      party->blocks[num_blocks++] = *block;
+    } else {
+      free(block->damaged);
+      free(block->hit);
+    }
+  }
+
+  party->num_blocks = num_blocks;
+  update_offsets(party);
+  return true;
+}
+
+/* Adds the stats of all threads to the stats of the round and clears them. */
+static void reduce_thread_stats(const struct parallel_fight *restrict parallel, struct combatant *restrict attackers,
+                                uint32_t num_attackers, struct combatant *restrict defenders, uint8_t num_kinds,
+                                uint32_t round) {
+  for (uint32_t t = 0; t < parallel->num_threads; t++) {
+    struct unit_group_stats *stats = &parallel->thread_stats[(size_t)t * parallel->num_thread_stats];
+    for (size_t i = 0; i < parallel->num_thread_stats; i++) {
+      uint32_t id = (uint32_t)(i / num_kinds);
+      struct combatant *combatant = id < num_attackers ? &attackers[id] : &defenders[id - num_attackers];
+      struct unit_group_stats *round_stats = &combatant->stats[round * num_kinds + i % num_kinds];
+      round_stats->times_fired += stats[i].times_fired;
+      round_stats->times_was_shot += stats[i].times_was_shot;
+      round_stats->shield_damage_dealt += stats[i].shield_damage_dealt;
+      round_stats->hull_damage_dealt += stats[i].hull_damage_dealt;
+      round_stats->shield_damage_taken += stats[i].shield_damage_taken;
+      round_stats->hull_damage_taken += stats[i].hull_damage_taken;
+    }
+    memset(stats, 0, parallel->num_thread_stats * sizeof(*stats));
+  }
+}
+
+static void cleanup_parallel_fight(struct parallel_fight *parallel) {
+  for (int c = 0; c < PARALLEL_WAVE_CHUNKS; c++) {
+    free(parallel->chunks[c].shots);
+    free(parallel->chunks[c].sorted);
+  }
+  for (int i = 0; i < 2; i++) {
+    for (uint32_t p = 0; p < PARALLEL_PARTITIONS; p++) {
+      struct partition *partition = &parallel->sides[i].partitions[p];
+      for (uint32_t s = 0; s < partition->segments_capacity; s++) {
+        free(partition->segments[s].hit);
+      }
+      free(partition->segments);
+    }
+  }
+  free(parallel->thread_stats);
+  free(parallel->spare);
+  free(parallel);
+}
+
+static struct parallel_fight *create_parallel_fight(uint32_t num_threads, size_t num_thread_stats) {
+  struct parallel_fight *parallel = calloc(1, sizeof(*parallel));
+  if (parallel == NULL) {
+    report_error("Allocating memory for a parallel fight failed\n");
+    return NULL;
+  }
+
+  parallel->num_threads = num_threads;
+  parallel->num_thread_stats = num_thread_stats;
+  parallel->thread_stats = calloc(num_threads * num_thread_stats, sizeof(*parallel->thread_stats));
+  if (parallel->thread_stats == NULL) {
+    report_error("Allocating memory for a parallel fight failed\n");
+    cleanup_parallel_fight(parallel);
+    return NULL;
+  }
+  return parallel;
+}
+
+/* Same as fight() with num_threads threads for one battle, see parallel_fire(). */
+static bool parallel_fight(const struct units_attributes *restrict units_attributes,
+                           struct combatant *restrict attackers, uint32_t num_attackers,
+                           struct combatant *restrict defenders, uint32_t num_defenders, uint32_t *restrict num_rounds,
+                           struct rng *restrict random, struct round_profile *restrict profile, uint32_t num_threads) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
   bool ret = false;
 
-  struct party *attackers_party = create_party(units_attributes, attackers, num_attackers);
-  if (attackers_party == NULL) {
-    goto out;
+  size_t attackers_stats = (size_t)num_attackers * num_kinds;
+  struct parallel_fight *parallel =
+      create_parallel_fight(num_threads, attackers_stats + (size_t)num_defenders * num_kinds);
+  if (parallel == NULL) {
+    goto out;
+  }
+
+  struct party *attackers_party = create_party(units_attributes, attackers, num_attackers);
+  if (attackers_party == NULL) {
+    goto out_parallel;
+  }
+
+  struct party *defenders_party = create_party(units_attributes, defenders, num_defenders);
+  if (defenders_party == NULL) {
+    goto out_attackers_party;
+  }
+
+  uint32_t round = 0;
+
+  while (round < MAX_ROUNDS && attackers_party->num_alive > 0 && defenders_party->num_alive > 0) {
+    struct round_profile *round_profile = profile != NULL ? &profile[round] : NULL;
+    uint64_t start = round_profile != NULL ? now_ns() : 0;
+
+    parallel_restore_shields(attackers_party, parallel);
+    parallel_restore_shields(defenders_party, parallel);
+
+    if (!parallel_fire(units_attributes, attackers_party, defenders_party, parallel, &parallel->sides[1], 0,
+                       attackers_stats, random, round_profile) ||
+        !parallel_fire(units_attributes, defenders_party, attackers_party, parallel, &parallel->sides[0],
+                       attackers_stats, 0, random, round_profile)) {
+      goto out_defenders_party;
+    }
+
+    reduce_thread_stats(parallel, attackers, num_attackers, defenders, num_kinds, round);
+
+    if (!parallel_update_units(units_attributes, attackers, attackers_party, parallel, &parallel->sides[0], round) ||
+        !parallel_update_units(units_attributes, defenders, defenders_party, parallel, &parallel->sides[1], round)) {
+      goto out_defenders_party;
+    }
+
+    if (round_profile != NULL) {
+      round_profile->num_fights++;
+      round_profile->time_ns += now_ns() - start;
+    }
+
+    round++;
+  }
+
+  *num_rounds = round;
+
+  update_combatants(units_attributes, attackers, num_attackers, attackers_party);
+  update_combatants(units_attributes, defenders, num_defenders, defenders_party);
+
+  ret = true;
+
+out_defenders_party:
+  cleanup_party(defenders_party);
+out_attackers_party:
+  cleanup_party(attackers_party);
+out_parallel:
+  cleanup_parallel_fight(parallel);
+out:
+  return ret;
+}
+
+/*
+ * Approximate mode: the units of a group (one kind of one combatant) are kept as a histogram of their states instead
+ * of one by one. Units with the same shield and a hull in the same bucket are merged into one cell with their mean
+ * state, and the explosion rule is applied per cell, so the cost of a round depends on the number of groups and cells,
+ * not on the number of units.
+ *
+ * The shots of a shooter group are sampled at once. Every shooter ends its chain with one shot, the other shots of the
+ * chains continue it, so there are num_shooters ending shots and a negative binomial number of continuing shots. Both
+ * are split multinomially across target groups, weighted by the number of targets and the chance that a shot at them
+ * continues or ends the chain, and then across the cells of a group. All the shots of a shooter group have the same
+ * damage, so a unit hit k times always follows the same path: the exact rules of fire_shooter() applied k times, with
+ * the chance to survive the explosion checks on the way. The explosion chance is linear in the hull, so merging units
+ * into their mean hull does not bias a single check.
+ */
+#define MAX_APPROX_BUCKETS 1000
+/* Cells with at most this many units get their hits unit by unit, larger cells by counts of units with k hits. */
+#define APPROX_EXACT_UNITS 16
+/* Binomials with a smaller mean are sampled exactly, larger ones with the normal approximation. */
+#define APPROX_EXACT_MEAN 16.0
+/* A unit that survives with a smaller chance is destroyed. */
+#define APPROX_MIN_SURVIVAL 1e-9
+
+struct approx_cell {
+  uint64_t count;
+  float shield;
+  float hull;
+  uint32_t key;
+};
+
+struct approx_group {
+  struct approx_cell *cells;
+  uint32_t num_cells;
+  uint32_t cells_capacity;
+  /* Units alive at the start of the round, destroyed ones included: they still fire and can be shot at. */
+  uint64_t num_units;
+  uint64_t num_destroyed;
+  float max_shield;
+  float max_hull;
+  uint8_t kind;
+  uint8_t combatant_id;
+};
+
+struct approx_party {
+  struct combatant *combatants;
+  struct approx_group *groups;
+  uint32_t num_groups;
+  uint64_t num_alive;
+};
+
+/* The state of a unit after k hits, if it survives, and the expected damage it took. */
+struct approx_step {
+  float shield;
+  float hull;
+  double survival;
+  double shield_damage;
+  double hull_damage;
+};
+
+struct approx_scratch {
+  uint32_t num_buckets;
+  struct approx_cell *cells;
+  size_t num_cells;
+  size_t cells_capacity;
+  struct approx_step *steps;
+  size_t num_steps;
+  size_t steps_capacity;
+  /* The state does not change anymore after the last step. */
+  bool final_step;
+  /* Per target group: cumulative weights of shots that end or continue chains and the shots of a shooter group. */
+  double *end_weights;
+  double *continue_weights;
+  uint64_t *shots;
+  /* Indexes of the units hit by few shots, see approx_hit_group(). */
+  uint64_t *targets;
+  size_t targets_capacity;
+};
+
+/* Returns a number in (0, 1). */
+static double rng_open_unit(struct rng *rng) {
+  if (rng->kind == RNG_LEHMER) {
+    rng->lehmer = RANDOM_NEXT(rng->lehmer);
+    return (double)rng->lehmer / (double)RANDOM_MODULUS;
+  }
+  return ((double)xoshiro_next(rng->xoshiro) + 0.5) / 4294967296.0;
+}
+
+static double rng_normal(struct rng *rng) {
+  double u = rng_open_unit(rng);
+  double v = rng_open_unit(rng);
+  return sqrt(-2.0 * log(u)) * cos(6.283185307179586 * v);
+}
+
+static uint64_t rng_binomial(struct rng *rng, uint64_t n, double p) {
+  if (n == 0 || p <= 0.0) {
+    return 0;
+  }
+  if (p >= 1.0) {
+    return n;
+  }
+  if (p > 0.5) {
+    return n - rng_binomial(rng, n, 1.0 - p);
+  }
+
+  double mean = (double)n * p;
+  if (mean < APPROX_EXACT_MEAN) {
+    /* Skips geometrically distributed runs of failures. */
+    double log_q = log1p(-p);
+    double trials = 0.0;
+    uint64_t x = 0;
+    for (;;) {
+      trials += floor(log(rng_open_unit(rng)) / log_q) + 1.0;
+      if (trials > (double)n) {
+        return x;
+      }
+      x++;
+    }
+  }
+
+  double x = floor(mean + sqrt(mean * (1.0 - p)) * rng_normal(rng) + 0.5);
+  return x <= 0.0 ? 0 : x >= (double)n ? n : (uint64_t)x;
+}
+
+/* Returns the number of shots that continue the chains of n shooters, a shot continues a chain with the chance q. */
+static uint64_t rng_chained_shots(struct rng *rng, uint64_t n, double q) {
+  if (n == 0 || q <= 0.0) {
+    return 0;
+  }
+
+  double mean = (double)n * q / (1.0 - q);
+  if (n <= APPROX_EXACT_UNITS || mean < APPROX_EXACT_MEAN) {
+    double log_q = log(q);
+    double x = 0.0;
+    for (uint64_t i = 0; i < n; i++) {
+      x += floor(log(rng_open_unit(rng)) / log_q);
+    }
+    return (uint64_t)x;
+  }
+
+  double x = floor(mean + sqrt(mean / (1.0 - q)) * rng_normal(rng) + 0.5);
+  return x <= 0.0 ? 0 : (uint64_t)x;
+}
+
+static uint32_t approx_bucket(uint32_t num_buckets, float value, float max_value) {
+  if (value >= max_value) {
+    return num_buckets;
+  }
+  uint32_t bucket = (uint32_t)((float)num_buckets * (value / max_value));
+  return bucket < num_buckets ? bucket : num_buckets - 1;
+}
+
+/*
+ * Full hulls have their own bucket, and hulls below the explosion threshold are never merged with others. Shields are
+ * not bucketed: a shot takes a whole number of percents of the maximum shield or the whole shield, so there are at most
+ * 101 shield states.
+ */
+static uint32_t approx_key(uint32_t num_buckets, const struct approx_group *group, float shield, float hull) {
+  uint32_t hull_bucket = 2 * approx_bucket(num_buckets, hull, group->max_hull) + (hull < 0.7f * group->max_hull);
+  uint32_t shield_percent = shield > 0.0f ? (uint32_t)lroundf(100.0f * shield / group->max_shield) : 0;
+  return hull_bucket * 101 + shield_percent;
+}
+
+static bool approx_push_cell(struct approx_scratch *scratch, uint64_t count, float shield, float hull, uint32_t key) {
+  if (scratch->num_cells == scratch->cells_capacity) {
+    size_t capacity = scratch->cells_capacity != 0 ? 2 * scratch->cells_capacity : 64;
+    struct approx_cell *cells = realloc(scratch->cells, capacity * sizeof(*cells));
+    if (cells == NULL) {
+      report_error("Allocating memory for approximate units failed\n");
+      return false;
+    }
+    scratch->cells = cells;
+    scratch->cells_capacity = capacity;
+  }
+
+  struct approx_cell *cell = &scratch->cells[scratch->num_cells++];
+  cell->count = count;
+  cell->shield = shield;
+  cell->hull = hull;
+  cell->key = key;
+  return true;
+}
+
+static int compare_u64(const void *a, const void *b) {
+  uint64_t x = *(const uint64_t *)a, y = *(const uint64_t *)b;
+  return (x > y) - (x < y);
+}
+
+static int compare_approx_cells(const void *a, const void *b) {
+  uint32_t x = ((const struct approx_cell *)a)->key, y = ((const struct approx_cell *)b)->key;
+  return (x > y) - (x < y);
+}
+
+/* Replaces the cells of the group with the scratch cells, cells with the same key are merged into their mean state. */
+static bool approx_merge_cells(struct approx_group *restrict group, struct approx_scratch *restrict scratch) {
+  struct approx_cell *cells = scratch->cells;
+  size_t num_cells = scratch->num_cells;
+  qsort(cells, num_cells, sizeof(*cells), compare_approx_cells);
+
+  if (num_cells > group->cells_capacity) {
+    if (num_cells > UINT32_MAX) {
+      report_error("Too many approximate cells\n");
+      return false;
+    }
+    struct approx_cell *new_cells = realloc(group->cells, num_cells * sizeof(*new_cells));
+    if (new_cells == NULL) {
+      report_error("Allocating memory for approximate units failed\n");
+      return false;
+    }
+    group->cells = new_cells;
+    group->cells_capacity = (uint32_t)num_cells;
+  }
+
+  uint32_t n = 0;
+  for (size_t i = 0; i < num_cells;) {
+    struct approx_cell *cell = &group->cells[n++];
+    *cell = cells[i];
+    cell->count = 0;
+
+    /* Full shields and hulls stay exact, their buckets hold only exact values. */
+    bool same = true;
+    double count = 0.0, shield = 0.0, hull = 0.0;
+    for (; i < num_cells && cells[i].key == cell->key; i++) {
+      same = same && cells[i].shield == cell->shield && cells[i].hull == cell->hull;
+      cell->count += cells[i].count;
+      count += (double)cells[i].count;
+      shield += (double)cells[i].count * cells[i].shield;
+      hull += (double)cells[i].count * cells[i].hull;
+    }
+    if (!same) {
+      cell->shield = (float)(shield / count);
+      cell->hull = (float)(hull / count);
+    }
+  }
+
+  group->num_cells = n;
+  scratch->num_cells = 0;
+  return true;
+}
+
+static bool approx_reserve_step(struct approx_scratch *scratch) {
+  if (scratch->num_steps < scratch->steps_capacity) {
+    return true;
+  }
+
+  size_t capacity = scratch->steps_capacity != 0 ? 2 * scratch->steps_capacity : 64;
+  struct approx_step *steps = realloc(scratch->steps, capacity * sizeof(*steps));
+  if (steps == NULL) {
+    report_error("Allocating memory for approximate units failed\n");
+    return false;
+  }
+  scratch->steps = steps;
+  scratch->steps_capacity = capacity;
+  return true;
+}
+
+/* Returns the state of a unit after k hits, the steps are computed up to k if needed. */
+static const struct approx_step *approx_step_at(struct approx_scratch *restrict scratch,
+                                                const struct approx_group *restrict group, float damage, uint64_t k) {
+  while (scratch->num_steps <= k && !scratch->final_step) {
+    if (!approx_reserve_step(scratch)) {
+      return NULL;
+    }
+
+    const struct approx_step *prev = &scratch->steps[scratch->num_steps - 1];
+    struct approx_step *step = &scratch->steps[scratch->num_steps];
+    *step = *prev;
+
+    /* The same rules as in fire_shooter(). */
+    float hull = prev->hull;
+    float hull_damage = damage - prev->shield;
+    if (hull_damage < 0.0f) {
+      float shield_damage = 0.01f * floorf(100.0f * damage / group->max_shield) * group->max_shield;
+      step->shield -= shield_damage;
+      step->shield_damage += prev->survival * (double)(uint64_t)shield_damage;
+    } else {
+      step->shield_damage += prev->survival * (double)(uint64_t)prev->shield;
+      step->shield = 0.0f;
+      if (hull_damage > hull) {
+        hull_damage = hull;
+      }
+      hull -= hull_damage;
+      step->hull_damage += prev->survival * (double)(uint64_t)hull_damage;
+    }
+    step->hull = hull;
+
+    bool check = hull < 0.7f * group->max_hull;
+    if (hull == 0.0f) {
+      step->survival = 0.0;
+    } else if (check) {
+      step->survival *= (double)hull / (double)group->max_hull;
+    }
+
+    if (step->survival < APPROX_MIN_SURVIVAL) {
+      step->survival = 0.0;
+      scratch->num_steps++;
+      scratch->final_step = true;
+    } else if (step->shield == prev->shield && step->hull == prev->hull && !check) {
+      scratch->final_step = true;
+    } else {
+      scratch->num_steps++;
+    }
+  }
+
+  return &scratch->steps[k < scratch->num_steps ? k : scratch->num_steps - 1];
+}
+
+/* Adds count units hit k times, step is their state after the hits. */
+static bool approx_add_hit_units(struct approx_scratch *restrict scratch, struct approx_group *restrict group,
+                                 const struct approx_step *restrict step, uint64_t count, double *restrict damage_sums,
+                                 struct rng *restrict rng) {
+  if (count == 0) {
+    return true;
+  }
+
+  damage_sums[0] += (double)count * step->shield_damage;
+  damage_sums[1] += (double)count * step->hull_damage;
+
+  uint64_t survivors = rng_binomial(rng, count, step->survival);
+  group->num_destroyed += count - survivors;
+  if (survivors == 0) {
+    return true;
+  }
+  return approx_push_cell(scratch, survivors, step->shield, step->hull,
+                          approx_key(scratch->num_buckets, group, step->shield, step->hull));
+}
+
+/* Applies num_shots shots spread uniformly across the units of the cell. */
+static bool approx_hit_cell(struct approx_scratch *restrict scratch, struct approx_group *restrict group,
+                            const struct approx_cell *restrict cell, uint64_t num_shots, float damage,
+                            double *restrict damage_sums, struct rng *restrict rng) {
+  scratch->num_steps = 0;
+  if (!approx_reserve_step(scratch)) {
+    return false;
+  }
+  scratch->steps[0] = (struct approx_step){cell->shield, cell->hull, 1.0, 0.0, 0.0};
+  scratch->num_steps = 1;
+  scratch->final_step = false;
+
+  uint64_t count = cell->count;
+  const struct approx_step *step;
+
+  if (count <= APPROX_EXACT_UNITS) {
+    uint64_t remaining = num_shots;
+    for (uint64_t i = 0; i < count; i++) {
+      uint64_t hits = rng_binomial(rng, remaining, 1.0 / (double)(count - i));
+      remaining -= hits;
+      if ((step = approx_step_at(scratch, group, damage, hits)) == NULL ||
+          !approx_add_hit_units(scratch, group, step, 1, damage_sums, rng)) {
+        return false;
+      }
+    }
+    return true;
+  }
+
+  /* Counts of units hit k times, every unit is hit a binomial number of times. */
+  double log_p = -log((double)count), log_q = log1p(-1.0 / (double)count);
+  double log_shots = lgamma((double)num_shots + 1.0);
+  double tail = 1.0;
+  uint64_t remaining = count;
+  for (uint64_t k = 0; remaining != 0; k++) {
+    if ((step = approx_step_at(scratch, group, damage, k)) == NULL) {
+      return false;
+    }
+
+    uint64_t n = remaining;
+    if (k < num_shots && !(scratch->final_step && k + 1 >= scratch->num_steps)) {
+      double p = exp(log_shots - lgamma((double)k + 1.0) - lgamma((double)(num_shots - k) + 1.0) + (double)k * log_p +
+                     (double)(num_shots - k) * log_q);
+      n = rng_binomial(rng, remaining, tail > p ? p / tail : 1.0);
+      tail -= p;
+    }
+
+    if (!approx_add_hit_units(scratch, group, step, n, damage_sums, rng)) {
+      return false;
+    }
+    remaining -= n;
+  }
+  return true;
+}
+
+static bool approx_hit_group(struct approx_scratch *restrict scratch, struct approx_group *restrict group,
+                             uint64_t num_shots, float damage, struct unit_group_stats *restrict shooter_stats,
+                             struct unit_group_stats *restrict target_stats, struct rng *restrict rng) {
+  double damage_sums[2] = {0.0, 0.0};
+
+  /* Few shots are cheaper to sample one by one, as sorted indexes of the hit units, than with a binomial per cell. */
+  bool one_by_one = num_shots < group->num_cells;
+  if (one_by_one) {
+    if (num_shots > scratch->targets_capacity) {
+      uint64_t *targets = realloc(scratch->targets, num_shots * sizeof(*targets));
+      if (targets == NULL) {
+        report_error("Allocating memory for approximate units failed\n");
+        return false;
+      }
+      scratch->targets = targets;
+      scratch->targets_capacity = num_shots;
+    }
+    for (uint64_t i = 0; i < num_shots; i++) {
+      scratch->targets[i] = rng_below(rng, rng->kind, group->num_units);
+    }
+    qsort(scratch->targets, num_shots, sizeof(*scratch->targets), compare_u64);
+  }
+
+  /* Shots at units destroyed in this round do nothing, they are after the units of all cells. */
+  uint64_t remaining_shots = num_shots, remaining_units = group->num_units, offset = 0, t = 0;
+  for (uint32_t c = 0; c < group->num_cells; c++) {
+    const struct approx_cell *cell = &group->cells[c];
+    uint64_t shots;
+    if (one_by_one) {
+      offset += cell->count;
+      for (shots = 0; t < num_shots && scratch->targets[t] < offset; t++) {
+        shots++;
+      }
+    } else {
+      shots = rng_binomial(rng, remaining_shots, (double)cell->count / (double)remaining_units);
+      remaining_shots -= shots;
+      remaining_units -= cell->count;
+    }
+
+    if (shots == 0) {
+      if (!approx_push_cell(scratch, cell->count, cell->shield, cell->hull, cell->key)) {
+        return false;
+      }
+    } else if (!approx_hit_cell(scratch, group, cell, shots, damage, damage_sums, rng)) {
+      return false;
+    }
+  }
+
+  uint64_t shield_damage = (uint64_t)(damage_sums[0] + 0.5), hull_damage = (uint64_t)(damage_sums[1] + 0.5);
+  shooter_stats->shield_damage_dealt += shield_damage;
+  target_stats->shield_damage_taken += shield_damage;
+  shooter_stats->hull_damage_dealt += hull_damage;
+  target_stats->hull_damage_taken += hull_damage;
+
+  return approx_merge_cells(group, scratch);
+}
+
+/* The share of the remaining weight, rounding errors of the remaining weight are ignored. */
+static double approx_share(double weight, double remaining_weight) {
+  return remaining_weight > weight ? weight / remaining_weight : 1.0;
+}
+
+/* The chance that a shot at a unit of the group continues the chain of the shooter. */
+static double approx_chain_chance(const struct unit_attributes *shooter_attrs, const struct approx_group *group) {
+  uint32_t rapid_fire = shooter_attrs->rapid_fire[group->kind];
+  return rapid_fire > 1 ? 1.0 - 1.0 / (double)rapid_fire : 0.0;
+}
+
+/* Splits shots across groups with the given cumulative weights and adds them to shots. */
+static void approx_split_shots(struct rng *restrict rng, uint64_t num_shots, const double *restrict cumulative_weights,
+                               uint32_t num_groups, uint64_t *restrict shots) {
+  if (num_shots == 0) {
+    return;
+  }
+
+  /* Few shots are cheaper to sample one by one than with a binomial per group. */
+  if (num_shots < num_groups) {
+    for (uint64_t i = 0; i < num_shots; i++) {
+      double x = rng_open_unit(rng) * cumulative_weights[num_groups - 1];
+      uint32_t low = 0, high = num_groups - 1;
+      while (low < high) {
+        uint32_t middle = low + (high - low) / 2;
+        if (cumulative_weights[middle] > x) {
+          high = middle;
+        } else {
+          low = middle + 1;
+        }
+      }
+      shots[low]++;
+    }
+    return;
+  }
+
+  double remaining_weight = cumulative_weights[num_groups - 1];
+  for (uint32_t g = 0; g < num_groups && num_shots != 0; g++) {
+    double weight = cumulative_weights[g] - (g != 0 ? cumulative_weights[g - 1] : 0.0);
+    uint64_t n = rng_binomial(rng, num_shots, g + 1 == num_groups ? 1.0 : approx_share(weight, remaining_weight));
+    remaining_weight -= weight;
+    num_shots -= n;
+    shots[g] += n;
+  }
+}
+
+static bool approx_fire(const struct units_attributes *restrict units_attributes,
+                        struct approx_party *restrict attackers_party, struct approx_party *restrict defenders_party,
+                        uint32_t round, struct rng *restrict rng, struct approx_scratch *restrict scratch,
+                        struct round_profile *restrict profile) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+
+  struct combatant *attackers = attackers_party->combatants;
+  struct combatant *defenders = defenders_party->combatants;
+  uint32_t num_groups = defenders_party->num_groups;
+
+  for (uint32_t a = 0; a < attackers_party->num_groups; a++) {
+    const struct approx_group *shooters = &attackers_party->groups[a];
+    const struct unit_attributes *shooter_attrs = &units_attributes->attributes[shooters->kind];
+    struct combatant *attacker = &attackers[shooters->combatant_id];
+    struct unit_group_stats *shooter_stats = &attacker->stats[round * num_kinds + shooters->kind];
+    float damage = shooter_attrs->weapons * (1.0f + 0.1f * attacker->weapons_technology);
+
+    double end_weight = 0.0, continue_weight = 0.0;
+    for (uint32_t g = 0; g < num_groups; g++) {
+      const struct approx_group *group = &defenders_party->groups[g];
+      double chance = approx_chain_chance(shooter_attrs, group);
+      end_weight += (double)group->num_units * (1.0 - chance);
+      continue_weight += (double)group->num_units * chance;
+      scratch->end_weights[g] = end_weight;
+      scratch->continue_weights[g] = continue_weight;
+      scratch->shots[g] = 0;
+    }
+
+    uint64_t ending_shots = shooters->num_units;
+    uint64_t continuing_shots = rng_chained_shots(rng, ending_shots, continue_weight / (end_weight + continue_weight));
+    shooter_stats->times_fired += ending_shots + continuing_shots;
+
+    if (profile != NULL) {
+      profile->num_chains += ending_shots;
+      profile->num_shots += ending_shots + continuing_shots;
+    }
+
+    approx_split_shots(rng, ending_shots, scratch->end_weights, num_groups, scratch->shots);
+    approx_split_shots(rng, continuing_shots, scratch->continue_weights, num_groups, scratch->shots);
+
+    for (uint32_t g = 0; g < num_groups; g++) {
+      uint64_t num_shots = scratch->shots[g];
+      if (num_shots == 0) {
+        continue;
+      }
+
+      struct approx_group *group = &defenders_party->groups[g];
+      struct unit_group_stats *target_stats = &defenders[group->combatant_id].stats[round * num_kinds + group->kind];
+      target_stats->times_was_shot += num_shots;
+      if (!approx_hit_group(scratch, group, num_shots, damage, shooter_stats, target_stats, rng)) {
+        return false;
+      }
+    }
+  }
+
+  return true;
+}
+
+static void cleanup_approx_party(struct approx_party *party) {
+  if (party->groups != NULL) {
+    for (uint32_t g = 0; g < party->num_groups; g++) {
+      free(party->groups[g].cells);
+    }
+  }
+  free(party->groups);
+  free(party);
+}
+
+static struct approx_party *create_approx_party(const struct units_attributes *restrict units_attributes,
+                                                struct combatant *combatants, uint32_t num_combatants,
+                                                uint32_t num_buckets) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+
+  struct approx_party *party = calloc(1, sizeof(*party));
+  if (party == NULL) {
+    report_error("Allocating memory for a party failed\n");
+    return NULL;
+  }
+
+  uint64_t total_units = 0;
+  uint32_t num_groups = 0;
+  for (uint32_t i = 0; i < num_combatants; i++) {
+    for (uint8_t kind = 0; kind < num_kinds; kind++) {
+      uint64_t num_units = combatants[i].unit_groups[kind];
+      if (num_units > UINT64_MAX - total_units) {
+        report_error("Too many units\n");
+        goto fail;
+      }
+      total_units += num_units;
+      num_groups += num_units != 0;
+    }
+  }
+
+  party->combatants = combatants;
+  party->groups = calloc(num_groups != 0 ? num_groups : 1, sizeof(*party->groups));
+  if (party->groups == NULL) {
+    report_error("Allocating memory for party units failed\n");
+    goto fail;
+  }
+
+  /* Groups are in the order of combatants and kinds, the order in which units fire. */
+  for (uint32_t i = 0; i < num_combatants; i++) {
+    const struct combatant *combatant = &combatants[i];
+    for (uint8_t kind = 0; kind < num_kinds; kind++) {
+      if (combatant->unit_groups[kind] == 0) {
+        continue;
+      }
+
+      const struct unit_attributes *attrs = &units_attributes->attributes[kind];
+      struct approx_group *group = &party->groups[party->num_groups++];
+      group->num_units = combatant->unit_groups[kind];
+      group->max_shield = attrs->shield * (1.0f + 0.1f * combatant->shielding_technology);
+      group->max_hull = 0.1f * attrs->armor * (1.0f + 0.1f * combatant->armor_technology);
+      group->kind = kind;
+      group->combatant_id = (uint8_t)i;
+
+      group->cells = malloc(sizeof(*group->cells));
+      if (group->cells == NULL) {
+        report_error("Allocating memory for party units failed\n");
+        goto fail;
+      }
+      group->num_cells = group->cells_capacity = 1;
+      group->cells[0].count = group->num_units;
+      group->cells[0].shield = group->max_shield;
+      group->cells[0].hull = group->max_hull;
+      group->cells[0].key = approx_key(num_buckets, group, group->max_shield, group->max_hull);
+    }
+  }
+
+  party->num_alive = total_units;
+  return party;
+
+fail:
+  cleanup_approx_party(party);
+  return NULL;
+}
+
+/* Removes destroyed units and restores shields, see update_units(). */
+static bool approx_update_units(const struct units_attributes *restrict units_attributes,
+                                struct combatant *restrict combatants, struct approx_party *restrict party,
+                                struct approx_scratch *restrict scratch, uint32_t round) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+
+  for (uint32_t g = 0; g < party->num_groups; g++) {
+    struct approx_group *group = &party->groups[g];
+    group->num_units -= group->num_destroyed;
+    group->num_destroyed = 0;
+    combatants[group->combatant_id].stats[round * num_kinds + group->kind].num_remaining_units += group->num_units;
+
+    for (uint32_t c = 0; c < group->num_cells; c++) {
+      const struct approx_cell *cell = &group->cells[c];
+      if (!approx_push_cell(scratch, cell->count, group->max_shield, cell->hull,
+                            approx_key(scratch->num_buckets, group, group->max_shield, cell->hull))) {
+        return false;
+      }
+    }
+    if (!approx_merge_cells(group, scratch)) {
+      return false;
+    }
+  }
+
+  uint32_t num_groups = 0;
+  uint64_t num_alive = 0;
+  for (uint32_t g = 0; g < party->num_groups; g++) {
+    struct approx_group *group = &party->groups[g];
+    if (group->num_units == 0) {
+      free(group->cells);
+    } else {
+      num_alive += group->num_units;
+      party->groups[num_groups++] = *group;
+    }
+  }
+
+  party->num_groups = num_groups;
+  party->num_alive = num_alive;
+  return true;
+}
+
+static void approx_update_combatants(const struct units_attributes *restrict units_attributes,
+                                     struct combatant *restrict combatants, uint32_t num_combatants,
+                                     const struct approx_party *restrict party) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+
+  for (uint32_t i = 0; i < num_combatants; i++) {
+    memset(combatants[i].unit_groups, 0, num_kinds * sizeof(*combatants[i].unit_groups));
+  }
+
+  for (uint32_t g = 0; g < party->num_groups; g++) {
+    const struct approx_group *group = &party->groups[g];
+    combatants[group->combatant_id].unit_groups[group->kind] = group->num_units;
+  }
+}
+
+/* Same as fight() in the approximate mode, num_buckets is the number of hull buckets of groups. */
+static bool approx_fight(const struct units_attributes *restrict units_attributes, struct combatant *restrict attackers,
+                         uint32_t num_attackers, struct combatant *restrict defenders, uint32_t num_defenders,
+                         uint32_t *restrict num_rounds, struct rng *restrict random,
+                         struct round_profile *restrict profile, uint32_t num_buckets) {
+  bool ret = false;
+
+  struct approx_scratch scratch;
+  memset(&scratch, 0, sizeof(scratch));
+  scratch.num_buckets = num_buckets;
+
+  struct approx_party *attackers_party = create_approx_party(units_attributes, attackers, num_attackers, num_buckets);
+  if (attackers_party == NULL) {
+    goto out;
+  }
+
+  struct approx_party *defenders_party = create_approx_party(units_attributes, defenders, num_defenders, num_buckets);
+  if (defenders_party == NULL) {
+    goto out_attackers_party;
+  }
+
+  uint32_t max_groups = attackers_party->num_groups > defenders_party->num_groups ? attackers_party->num_groups
+                                                                                  : defenders_party->num_groups;
+  scratch.end_weights = malloc((max_groups != 0 ? max_groups : 1) * sizeof(*scratch.end_weights));
+  scratch.continue_weights = malloc((max_groups != 0 ? max_groups : 1) * sizeof(*scratch.continue_weights));
+  scratch.shots = malloc((max_groups != 0 ? max_groups : 1) * sizeof(*scratch.shots));
+  if (scratch.end_weights == NULL || scratch.continue_weights == NULL || scratch.shots == NULL) {
+    report_error("Allocating memory for approximate units failed\n");
+    goto out_defenders_party;
+  }
+
+  uint32_t round = 0;
+
+  while (round < MAX_ROUNDS && attackers_party->num_alive > 0 && defenders_party->num_alive > 0) {
+    struct round_profile *round_profile = profile != NULL ? &profile[round] : NULL;
+    uint64_t start = round_profile != NULL ? now_ns() : 0;
+
+    if (!approx_fire(units_attributes, attackers_party, defenders_party, round, random, &scratch, round_profile) ||
+        !approx_fire(units_attributes, defenders_party, attackers_party, round, random, &scratch, round_profile) ||
+        !approx_update_units(units_attributes, attackers, attackers_party, &scratch, round) ||
+        !approx_update_units(units_attributes, defenders, defenders_party, &scratch, round)) {
+      goto out_defenders_party;
+    }
+
+    if (round_profile != NULL) {
+      round_profile->num_fights++;
+      round_profile->time_ns += now_ns() - start;
+    }
+
+    round++;
+  }
+
+  *num_rounds = round;
+
+  approx_update_combatants(units_attributes, attackers, num_attackers, attackers_party);
+  approx_update_combatants(units_attributes, defenders, num_defenders, defenders_party);
+
+  ret = true;
+
+out_defenders_party:
+  cleanup_approx_party(defenders_party);
+out_attackers_party:
+  cleanup_approx_party(attackers_party);
+out:
+  free(scratch.targets);
+  free(scratch.shots);
+  free(scratch.continue_weights);
+  free(scratch.end_weights);
+  free(scratch.cells);
+  free(scratch.steps);
+  return ret;
+}
+
+static bool dump_stats(struct buffer *restrict buffer, const struct combatant *restrict combatants,
+                       uint32_t num_combatants, uint32_t num_rounds, uint8_t num_kinds) {
+  for (uint32_t i = 0; i < num_combatants; i++) {
+    const struct combatant *combatant = &combatants[i];
+    for (uint32_t round = 0; round < num_rounds; round++) {
+      const struct unit_group_stats *stats = &combatant->stats[round * num_kinds];
+
+      if (!buffer_reserve(buffer, (size_t)num_kinds * 7 * MAX_U64_TEXT_SIZE + 1)) {
+        return false;
+      }
+
+      for (uint8_t kind = 0; kind < num_kinds; kind++) {
+        const struct unit_group_stats *s = &stats[kind];
+        buffer_put_u64(buffer, s->times_fired, ' ');
+        buffer_put_u64(buffer, s->times_was_shot, ' ');
+        buffer_put_u64(buffer, s->shield_damage_dealt, ' ');
+        buffer_put_u64(buffer, s->hull_damage_dealt, ' ');
+        buffer_put_u64(buffer, s->shield_damage_taken, ' ');
+        buffer_put_u64(buffer, s->hull_damage_taken, ' ');
+        buffer_put_u64(buffer, s->num_remaining_units, '\n');
+      }
+
+      buffer->data[buffer->size++] = '\n';
+    }
+  }
+
+  return true;
+}
+
+/*
+ * Binary output format. All integers are little-endian. The output starts with a header:
+ *
+ *   char     magic[4] = "OGBE"
+ *   uint16_t version
+ *   uint16_t flags
+ *   uint32_t num_kinds
+ *   uint32_t num_combatants
+ *
+ * followed by every simulation: uint64_t num_rounds and then num_combatants * num_rounds * num_kinds records of
+ * 7 uint64_t, one per unit_group_stats field, in the same order as in the text format.
+ *
+ * A projected output (see struct projection) has only the last round if BINARY_FLAG_LAST_ROUND is set (no round if
+ * num_rounds is 0), only the kinds a combatant has at the start of the battle if BINARY_FLAG_SPARSE is set and only the
+ * fields of the mask in the flags bits 8-14 if it is not 0. BINARY_FLAG_XOSHIRO is set if the xoshiro generator was
+ * used, BINARY_FLAG_APPROX if the approximate mode was used and BINARY_FLAG_PARALLEL if battles were fought with
+ * --battle-threads.
+ *
+ * If BINARY_FLAG_SUMMARY is set, the header is followed by a summary instead, see dump_summary().
+ */
+#define BINARY_MAGIC "OGBE"
+#define BINARY_VERSION 1
+#define BINARY_HEADER_SIZE 16
+#define BINARY_FLAG_SUMMARY 0x1
+#define BINARY_FLAG_LAST_ROUND 0x2
+#define BINARY_FLAG_SPARSE 0x4
+#define BINARY_FLAG_XOSHIRO 0x8
+#define BINARY_FLAG_APPROX 0x10
+#define BINARY_FLAG_PARALLEL 0x20
+#define BINARY_FIELDS_SHIFT 8
+
+#ifndef BATTLE_ENGINE_LIBRARY
+static bool dump_binary_header(struct buffer *buffer, uint16_t flags, uint8_t num_kinds, uint32_t num_combatants) {
+  if (!buffer_reserve(buffer, BINARY_HEADER_SIZE)) {
+    return false;
+  }
+  memcpy(buffer->data + buffer->size, BINARY_MAGIC, 4);
+  buffer->size += 4;
+  buffer_put_le16(buffer, BINARY_VERSION);
+  buffer_put_le16(buffer, flags);
+  buffer_put_le32(buffer, num_kinds);
+  buffer_put_le32(buffer, num_combatants);
+  return true;
+}
+
+static uint16_t projection_flags(const struct projection *projection) {
+  uint16_t flags = 0;
+  if (projection->last_round) {
+    flags |= BINARY_FLAG_LAST_ROUND;
+  }
+  if (projection->sparse) {
+    flags |= BINARY_FLAG_SPARSE;
+  }
+  if (projection->fields != ALL_STATS_FIELDS) {
+    flags |= (uint16_t)(projection->fields << BINARY_FIELDS_SHIFT);
+  }
+  return flags;
+}
+#endif
+
+static bool dump_binary_stats(struct buffer *restrict buffer, const struct combatant *restrict combatants,
+                              uint32_t num_combatants, uint32_t num_rounds, uint8_t num_kinds) {
+  if (!buffer_reserve(buffer, 8 + (size_t)num_combatants * num_rounds * num_kinds * 7 * 8)) {
+    return false;
+  }
+
+  buffer_put_le64(buffer, num_rounds);
+
+  for (uint32_t i = 0; i < num_combatants; i++) {
+    const struct unit_group_stats *s = combatants[i].stats;
+    for (uint32_t j = 0; j < num_rounds * num_kinds; j++, s++) {
+      buffer_put_le64(buffer, s->times_fired);
+      buffer_put_le64(buffer, s->times_was_shot);
+      buffer_put_le64(buffer, s->shield_damage_dealt);
+      buffer_put_le64(buffer, s->hull_damage_dealt);
+      buffer_put_le64(buffer, s->shield_damage_taken);
+      buffer_put_le64(buffer, s->hull_damage_taken);
+      buffer_put_le64(buffer, s->num_remaining_units);
+    }
+  }
+
+  return true;
+}
+
+/*
+ * Writes the projected stats of a simulation in the text or the binary format. Sparse kinds are those with units in
+ * the initial state of the combatants.
+ */
+static bool dump_projected_stats(struct buffer *restrict buffer, const struct combatant *restrict initial_combatants,
+                                 const struct combatant *restrict combatants, uint32_t num_combatants,
+                                 uint32_t num_rounds, uint8_t num_kinds, const struct projection *restrict projection,
+                                 bool binary) {
+  uint32_t first_round = projection->last_round && num_rounds > 0 ? num_rounds - 1 : 0;
+  size_t max_field_size = binary ? 8 : MAX_U64_TEXT_SIZE;
+
+  if (binary) {
+    if (!buffer_reserve(buffer, 8)) {
+      return false;
+    }
+    buffer_put_le64(buffer, num_rounds);
+  } else {
+    if (!buffer_reserve(buffer, MAX_U64_TEXT_SIZE + 1)) {
+      return false;
+    }
+    buffer_put_u64(buffer, num_rounds, '\n');
+    buffer->data[buffer->size++] = '\n';
+  }
+
+  for (uint32_t i = 0; i < num_combatants; i++) {
+    const struct combatant *combatant = &combatants[i];
+    for (uint32_t round = first_round; round < num_rounds; round++) {
+      if (!buffer_reserve(buffer, (size_t)num_kinds * NUM_STATS_FIELDS * max_field_size + 1)) {
+        return false;
+      }
+
+      for (uint8_t kind = 0; kind < num_kinds; kind++) {
+        if (projection->sparse && initial_combatants[i].unit_groups[kind] == 0) {
+          continue;
+        }
+
+        const char *stats = (const char *)&combatant->stats[round * num_kinds + kind];
+        for (int field = 0; field < NUM_STATS_FIELDS; field++) {
+          if ((projection->fields & (1 << field)) == 0) {
+            continue;
+          }
+          uint64_t value;
+          memcpy(&value, stats + STATS_FIELD_OFFSETS[field], sizeof(value));
+          if (binary) {
+            buffer_put_le64(buffer, value);
+          } else {
+            buffer_put_u64(buffer, value, ' ');
+          }
+        }
+
+        if (!binary) {
+          buffer->data[buffer->size - 1] = '\n';
+        }
+      }
+
+      if (!binary) {
+        buffer->data[buffer->size++] = '\n';
+      }
+    }
+  }
+
+  return true;
+}
+
+/* Number of histogram buckets of remaining units, bucket b counts b * (n + 1) / B <= x < (b + 1) * (n + 1) / B. */
+#define SUMMARY_BUCKETS 32
+
+/* Running statistics of the remaining units of a unit group. */
+struct group_summary {
+  double mean;
+  /* Sum of squared differences from the mean (Welford). */
+  double m2;
+  uint64_t min;
+  uint64_t max;
+  uint64_t histogram[SUMMARY_BUCKETS];
+};
+
+struct summary {
+  uint64_t num_simulations;
+  uint64_t attackers_wins;
+  uint64_t defenders_wins;
+  uint64_t draws;
+  uint64_t rounds[MAX_ROUNDS + 1];
+  struct group_summary *groups;
+};
+
+/* Adds the final state of the combatants after a simulation to the summary. */
+static void update_summary(struct summary *restrict summary, const struct combatant *restrict initial_combatants,
+                           const struct combatant *restrict combatants, uint32_t num_attackers, uint32_t num_combatants,
+                           uint8_t num_kinds, uint32_t num_rounds) {
+  bool attackers_alive = false, defenders_alive = false;
+
+  uint64_t n = ++summary->num_simulations;
+  summary->rounds[num_rounds]++;
+
+  for (uint32_t i = 0; i < num_combatants; i++) {
+    for (uint8_t kind = 0; kind < num_kinds; kind++) {
+      struct group_summary *group = &summary->groups[i * num_kinds + kind];
+      uint64_t initial = initial_combatants[i].unit_groups[kind];
+      uint64_t remaining = combatants[i].unit_groups[kind];
+
+      if (remaining != 0) {
+        if (i < num_attackers) {
+          attackers_alive = true;
+        } else {
+          defenders_alive = true;
+        }
+      }
+
+      double x = (double)remaining;
+      double delta = x - group->mean;
+      group->mean += delta / (double)n;
+      group->m2 += delta * (x - group->mean);
+
+      if (n == 1 || remaining < group->min) {
+        group->min = remaining;
+      }
+      if (remaining > group->max) {
+        group->max = remaining;
+      }
+
+      uint64_t bucket = (uint64_t)(x / ((double)initial + 1.0) * SUMMARY_BUCKETS);
+      group->histogram[bucket < SUMMARY_BUCKETS ? bucket : SUMMARY_BUCKETS - 1]++;
+    }
+  }
+
+  if (attackers_alive && !defenders_alive) {
+    summary->attackers_wins++;
+  } else if (defenders_alive && !attackers_alive) {
+    summary->defenders_wins++;
+  } else {
+    summary->draws++;
+  }
+}
+
+#ifndef BATTLE_ENGINE_LIBRARY
+static bool init_summary(struct summary *summary, uint32_t num_combatants, uint8_t num_kinds) {
+  memset(summary, 0, sizeof(*summary));
+  if (num_combatants == 0) {
+    return true;
+  }
+  summary->groups = calloc((size_t)num_combatants * num_kinds, sizeof(*summary->groups));
+  if (summary->groups == NULL) {
+    report_error("Allocating memory for summary failed\n");
+    return false;
+  }
+  return true;
+}
+
+static void cleanup_summary(struct summary *summary) { free(summary->groups); }
+
+/*
+ * Writes the summary. In the text format, the first line contains num_simulations, attackers_wins, defenders_wins and
+ * draws, the second line the histogram of the number of rounds (0 to MAX_ROUNDS), and then for every combatant and
+ * kind a line with mean, m2, min, max and SUMMARY_BUCKETS histogram buckets. The binary format has the same fields,
+ * mean and m2 as doubles and the rest as uint64_t.
+ */
+static bool dump_summary(struct buffer *restrict buffer, const struct summary *restrict summary, bool binary,
+                         uint32_t num_combatants, uint8_t num_kinds) {
+  size_t num_groups = (size_t)num_combatants * num_kinds;
+  if (!buffer_reserve(buffer, (4 + MAX_ROUNDS + 1 + num_groups * (4 + SUMMARY_BUCKETS)) * 32)) {
+    return false;
+  }
+
+  const uint64_t totals[] = {summary->num_simulations, summary->attackers_wins, summary->defenders_wins,
+                             summary->draws};
+
+  for (size_t i = 0; i < 4; i++) {
+    if (binary) {
+      buffer_put_le64(buffer, totals[i]);
+    } else {
+      buffer_put_u64(buffer, totals[i], i < 3 ? ' ' : '\n');
+    }
+  }
+
+  for (uint32_t round = 0; round <= MAX_ROUNDS; round++) {
+    if (binary) {
+      buffer_put_le64(buffer, summary->rounds[round]);
+    } else {
+      buffer_put_u64(buffer, summary->rounds[round], round < MAX_ROUNDS ? ' ' : '\n');
+    }
+  }
+
+  for (size_t i = 0; i < num_groups; i++) {
+    const struct group_summary *group = &summary->groups[i];
+    if (binary) {
+      buffer_put_le_double(buffer, group->mean);
+      buffer_put_le_double(buffer, group->m2);
+      buffer_put_le64(buffer, group->min);
+      buffer_put_le64(buffer, group->max);
+      for (uint32_t b = 0; b < SUMMARY_BUCKETS; b++) {
+        buffer_put_le64(buffer, group->histogram[b]);
+      }
+    } else {
+      int n = snprintf(buffer->data + buffer->size, 64, "%.17g %.17g ", group->mean, group->m2);
+      buffer->size += (size_t)n;
+      buffer_put_u64(buffer, group->min, ' ');
+      buffer_put_u64(buffer, group->max, ' ');
+      for (uint32_t b = 0; b < SUMMARY_BUCKETS; b++) {
+        buffer_put_u64(buffer, group->histogram[b], b < SUMMARY_BUCKETS - 1 ? ' ' : '\n');
+      }
+    }
+  }
+
+  return true;
+}
+#endif
+
+struct simulation_options {
+  bool binary;
+  /* Only a summary of all simulations is written instead of the stats of every simulation. */
+  bool summary;
+  /* The number of threads simulations are split across, 0 and 1 mean no multithreading. */
+  uint32_t num_threads;
+  /* The index of the first simulation, selects the random streams of simulations. */
+  uint32_t first_simulation;
+  /* Per-round timings and shot counts are written to stderr, see dump_profile(). */
+  bool profile;
+  /* Applied to the stats of every simulation, not to summaries. */
+  struct projection projection;
+  enum rng_kind rng;
+  /* The number of hull buckets of the approximate mode, see approx_fight(), 0 for the exact mode. */
+  uint32_t approx_buckets;
+  /* The number of threads every battle is fought with, see parallel_fight(), 0 to fight it in one thread. */
+  uint32_t battle_threads;
+  /* The snapshot after snapshot_round rounds is written instead of the results, see run_snapshot(). */
+  bool snapshot;
+  uint32_t snapshot_round;
+  /* The battle is resumed from a snapshot read from the input, see load_snapshot(). */
+  bool resume;
+  /* Resumed simulations continue the random stream of the snapshot instead of the streams of the seed. */
+  bool snapshot_stream;
+};
+
+static bool is_projected(const struct projection *projection) {
+  return projection->last_round || projection->sparse || projection->fields != ALL_STATS_FIELDS;
+}
+
+struct battle {
+  uint32_t num_attackers;
+  uint32_t num_defenders;
+  /* The initial state of combatants, copied before every simulation. */
+  struct combatant *combatants;
+  size_t combatants_size;
+  /* The state the simulations are resumed from with --resume, see resume_fight(), NULL otherwise. */
+  const struct snapshot *snapshot;
+};
+
+#ifndef BATTLE_ENGINE_LIBRARY
+static bool load_battle(FILE *restrict file, const struct units_attributes *restrict units_attributes,
+                        struct battle *restrict battle) {
+  int n;
+
+  memset(battle, 0, sizeof(*battle));
+
+  n = fscanf(file, "%" SCNu32 "%" SCNu32, &battle->num_attackers, &battle->num_defenders);
+  if (n != 2) {
+    report_error("Scanning the number of combatants failed\n");
+    goto fail;
+  }
+
+  if (battle->num_attackers > 256) {
+    report_error("The number of attackers cannot be greater than 256\n");
+    goto fail;
+  }
+
+  if (battle->num_defenders > 256) {
+    report_error("The number of defenders cannot be greater than 256\n");
+    goto fail;
+  }
+
+  uint32_t num_combatants = battle->num_attackers + battle->num_defenders;
+  if (num_combatants == 0) {
+    return true;
+  }
+
+  battle->combatants = load_combatants(file, units_attributes, num_combatants);
+  if (battle->combatants == NULL) {
+    goto fail;
+  }
+
+  if (battle->num_attackers == 0 || battle->num_defenders == 0) {
+    /* Nothing to fight, combatants are left unallocated. */
+    free(battle->combatants);
+    battle->combatants = NULL;
+    return true;
+  }
+
+  battle->combatants_size = calc_combatants_alloc_size(units_attributes, num_combatants);
+
+  return true;
+
+fail:
+  return false;
+}
+#endif
+
+static void cleanup_battle(struct battle *battle) { free(battle->combatants); }
+
+/*
+ * Snapshots (--snapshot, --resume): the state of one simulation after a round, from which other simulations continue.
+ * The format is little-endian:
+ *
+ *   char magic[4] = "OGBS"
+ *   uint16_t version
+ *   uint16_t rng (0 for lehmer, 1 for xoshiro)
+ *   uint32_t num_kinds
+ *   uint32_t num_attackers
+ *   uint32_t num_defenders
+ *   uint32_t num_rounds
+ *   uint32_t lehmer and uint32_t xoshiro[4], the state of the random number generator
+ *
+ * followed by every combatant: uint8_t weapons, shielding and armor technologies and a padding byte, num_kinds uint64_t
+ * unit groups at the start of the battle and num_rounds * num_kinds records of 7 uint64_t as in the binary output.
+ * Then for attackers and defenders: uint32_t num_blocks and every block (see struct block): uint8_t combatant and kind,
+ * 2 padding bytes, uint64_t num_undamaged, uint64_t num_damaged and the float hulls of damaged units.
+ */
+#define SNAPSHOT_MAGIC "OGBS"
+#define SNAPSHOT_VERSION 1
+#define SNAPSHOT_HEADER_SIZE 44
+
+struct snapshot_block {
+  uint8_t combatant_id;
+  uint8_t kind;
+  uint64_t num_undamaged;
+  uint64_t num_damaged;
+  /* The index of the hull of the first damaged unit in hulls. */
+  size_t first_hull;
+};
+
+/* The state of parties and the random number generator, the combatants are in the battle resumed from it. */
+struct snapshot {
+  uint32_t num_rounds;
+  struct rng rng;
+  /* Attackers and defenders. */
+  struct snapshot_block *blocks[2];
+  uint32_t num_blocks[2];
+  float *hulls;
+};
+
+static bool dump_snapshot(struct buffer *restrict output, const struct units_attributes *restrict units_attributes,
+                          const struct battle *restrict battle, const struct combatant *restrict combatants,
+                          struct party *parties[2], uint32_t num_rounds, const struct rng *restrict random) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+  uint32_t num_combatants = battle->num_attackers + battle->num_defenders;
+
+  size_t size = SNAPSHOT_HEADER_SIZE + num_combatants * (4 + num_kinds * sizeof(uint64_t) +
+                                                         num_rounds * num_kinds * sizeof(struct unit_group_stats));
+  for (int side = 0; side < 2; side++) {
+    size += 4;
+    for (uint32_t b = 0; b < parties[side]->num_blocks; b++) {
+      size += 20 + parties[side]->blocks[b].num_damaged * sizeof(float);
+    }
+  }
+
+  if (!buffer_reserve(output, size)) {
+    return false;
+  }
+
+  memcpy(output->data + output->size, SNAPSHOT_MAGIC, 4);
+  output->size += 4;
+  buffer_put_le16(output, SNAPSHOT_VERSION);
+  buffer_put_le16(output, random->kind == RNG_XOSHIRO);
+  buffer_put_le32(output, num_kinds);
+  buffer_put_le32(output, battle->num_attackers);
+  buffer_put_le32(output, battle->num_defenders);
+  buffer_put_le32(output, num_rounds);
+  buffer_put_le32(output, random->lehmer);
+  for (int i = 0; i < 4; i++) {
+    buffer_put_le32(output, random->xoshiro[i]);
+  }
+
+  for (uint32_t i = 0; i < num_combatants; i++) {
+    const struct combatant *combatant = &combatants[i];
+    output->data[output->size++] = (char)combatant->weapons_technology;
+    output->data[output->size++] = (char)combatant->shielding_technology;
+    output->data[output->size++] = (char)combatant->armor_technology;
+    output->data[output->size++] = 0;
+
+    for (uint8_t kind = 0; kind < num_kinds; kind++) {
+      buffer_put_le64(output, battle->combatants[i].unit_groups[kind]);
+    }
+
+    for (uint32_t j = 0; j < num_rounds * num_kinds; j++) {
+      const struct unit_group_stats *s = &combatant->stats[j];
+      buffer_put_le64(output, s->times_fired);
+      buffer_put_le64(output, s->times_was_shot);
+      buffer_put_le64(output, s->shield_damage_dealt);
+      buffer_put_le64(output, s->hull_damage_dealt);
+      buffer_put_le64(output, s->shield_damage_taken);
+      buffer_put_le64(output, s->hull_damage_taken);
+      buffer_put_le64(output, s->num_remaining_units);
+    }
+  }
+
+  for (int side = 0; side < 2; side++) {
+    const struct party *party = parties[side];
+    buffer_put_le32(output, party->num_blocks);
+    for (uint32_t b = 0; b < party->num_blocks; b++) {
+      const struct block *block = &party->blocks[b];
+      output->data[output->size++] = (char)block->combatant_id;
+      output->data[output->size++] = (char)block->kind;
+      buffer_put_le16(output, 0);
+      buffer_put_le64(output, block->num_undamaged);
+      buffer_put_le64(output, block->num_damaged);
+      for (uint64_t i = 0; i < block->num_damaged; i++) {
+        uint32_t bits;
+        memcpy(&bits, &block->damaged[i].hull, sizeof(bits));
+        buffer_put_le32(output, bits);
+      }
+    }
+  }
+
+  return true;
+}
+
+#ifndef BATTLE_ENGINE_LIBRARY
+struct snapshot_reader {
+  const unsigned char *data;
+  size_t size;
+  size_t offset;
+};
+
+/* Reads a little-endian value of size bytes. */
+static bool read_snapshot_value(struct snapshot_reader *reader, size_t size, uint64_t *value) {
+  if (reader->size - reader->offset < size) {
+    report_error("The snapshot is truncated\n");
+    return false;
+  }
+
+  *value = 0;
+  for (size_t i = 0; i < size; i++) {
+    *value |= (uint64_t)reader->data[reader->offset + i] << (8 * i);
+  }
+  reader->offset += size;
+  return true;
+}
+
+static void cleanup_snapshot(struct snapshot *snapshot) {
+  free(snapshot->blocks[0]);
+  free(snapshot->blocks[1]);
+  free(snapshot->hulls);
+}
+
+static bool parse_snapshot_blocks(struct snapshot_reader *restrict reader, struct snapshot *restrict snapshot, int side,
+                                  uint32_t num_combatants, uint8_t num_kinds, size_t *restrict num_hulls) {
+  uint64_t value, num_blocks;
+  if (!read_snapshot_value(reader, 4, &num_blocks)) {
+    return false;
+  }
+
+  /* Every block takes 20 bytes, which bounds the allocation by the size of the snapshot. */
+  if (num_blocks > (reader->size - reader->offset) / 20) {
+    report_error("The snapshot is truncated\n");
+    return false;
+  }
+
+  snapshot->blocks[side] = malloc((num_blocks != 0 ? num_blocks : 1) * sizeof(*snapshot->blocks[side]));
+  if (snapshot->blocks[side] == NULL) {
+    report_error("Allocating memory for the snapshot failed\n");
+    return false;
+  }
+
+  uint64_t total_units = 0;
+  for (uint32_t b = 0; b < num_blocks; b++) {
+    struct snapshot_block *block = &snapshot->blocks[side][b];
+    if (!read_snapshot_value(reader, 1, &value)) {
+      return false;
+    }
+    block->combatant_id = (uint8_t)value;
+    if (!read_snapshot_value(reader, 1, &value)) {
+      return false;
+    }
+    block->kind = (uint8_t)value;
+    if (!read_snapshot_value(reader, 2, &value) || !read_snapshot_value(reader, 8, &block->num_undamaged) ||
+        !read_snapshot_value(reader, 8, &block->num_damaged)) {
+      return false;
+    }
+
+    /* Blocks are in the order of create_party() and empty blocks are removed, see update_units(). */
+    if (block->combatant_id >= num_combatants || block->kind >= num_kinds ||
+        (b > 0 && (block->combatant_id < block[-1].combatant_id ||
+                   (block->combatant_id == block[-1].combatant_id && block->kind <= block[-1].kind)))) {
+      report_error("The snapshot has an invalid block #%" PRIu32 "\n", b);
+      return false;
+    }
+
+    if (block->num_damaged > (reader->size - reader->offset) / sizeof(float) ||
+        block->num_undamaged > MAX_UNITS - total_units - block->num_damaged ||
+        block->num_undamaged + block->num_damaged == 0) {
+      report_error("The snapshot has an invalid number of units in block #%" PRIu32 "\n", b);
+      return false;
+    }
+    total_units += block->num_undamaged + block->num_damaged;
+
+    block->first_hull = *num_hulls;
+    *num_hulls += block->num_damaged;
+    reader->offset += block->num_damaged * sizeof(float);
+  }
+
+  snapshot->num_blocks[side] = (uint32_t)num_blocks;
+  return true;
+}
+
+/*
+ * Loads a snapshot written by --snapshot, given as a line with its size followed by its bytes. The battle gets the
+ * combatants of the snapshot and points to the snapshot state.
+ */
+static bool load_snapshot(FILE *restrict file, const struct units_attributes *restrict units_attributes,
+                          struct battle *restrict battle, struct snapshot *restrict snapshot) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+  bool ret = false;
+  uint64_t value;
+
+  memset(battle, 0, sizeof(*battle));
+  memset(snapshot, 0, sizeof(*snapshot));
+
+  uint64_t size;
+  if (fscanf(file, "%" SCNu64, &size) != 1 || fgetc(file) != '\n' || size > SIZE_MAX) {
+    report_error("Scanning the size of the snapshot failed\n");
+    goto out;
+  }
+
+  unsigned char *data = malloc(size != 0 ? (size_t)size : 1);
+  if (data == NULL) {
+    report_error("Allocating memory for the snapshot failed\n");
+    goto out;
+  }
+
+  if (fread(data, 1, (size_t)size, file) != size) {
+    report_error("Reading the snapshot failed\n");
+    goto out_data;
+  }
+
+  struct snapshot_reader reader = {data, (size_t)size, 0};
+  if (size < SNAPSHOT_HEADER_SIZE || memcmp(data, SNAPSHOT_MAGIC, 4) != 0) {
+    report_error("The snapshot has an unsupported format\n");
+    goto out_data;
+  }
+  reader.offset = 4;
+
+  uint64_t version, rng, snapshot_num_kinds, num_attackers, num_defenders, num_rounds;
+  read_snapshot_value(&reader, 2, &version);
+  read_snapshot_value(&reader, 2, &rng);
+  read_snapshot_value(&reader, 4, &snapshot_num_kinds);
+  read_snapshot_value(&reader, 4, &num_attackers);
+  read_snapshot_value(&reader, 4, &num_defenders);
+  read_snapshot_value(&reader, 4, &num_rounds);
+  read_snapshot_value(&reader, 4, &value);
+  snapshot->rng.lehmer = (uint32_t)value;
+  for (int i = 0; i < 4; i++) {
+    read_snapshot_value(&reader, 4, &value);
+    snapshot->rng.xoshiro[i] = (uint32_t)value;
+  }
+  snapshot->rng.kind = rng != 0 ? RNG_XOSHIRO : RNG_LEHMER;
+  snapshot->num_rounds = (uint32_t)num_rounds;
+
+  if (version != SNAPSHOT_VERSION || rng > 1) {
+    report_error("The snapshot has an unsupported format\n");
+    goto out_data;
+  }
+
+  /* Both generators stay stuck in a zero state. */
+  const uint32_t *xoshiro = snapshot->rng.xoshiro;
+  if (snapshot->rng.kind == RNG_LEHMER ? snapshot->rng.lehmer == 0 || snapshot->rng.lehmer >= RANDOM_MODULUS
+                                       : (xoshiro[0] | xoshiro[1] | xoshiro[2] | xoshiro[3]) == 0) {
+    report_error("The snapshot has an invalid random number generator state\n");
+    goto out_data;
+  }
+
+  if (snapshot_num_kinds != num_kinds || num_attackers == 0 || num_attackers > 256 || num_defenders == 0 ||
+      num_defenders > 256 || num_rounds > MAX_ROUNDS) {
+    report_error("The snapshot does not match the units attributes\n");
+    goto out_data;
+  }
+
+  battle->num_attackers = (uint32_t)num_attackers;
+  battle->num_defenders = (uint32_t)num_defenders;
+  uint32_t num_combatants = battle->num_attackers + battle->num_defenders;
+  battle->combatants_size = calc_combatants_alloc_size(units_attributes, num_combatants);
+  battle->combatants = calloc(battle->combatants_size, 1);
+  if (battle->combatants == NULL) {
+    report_error("Allocating memory for combatants failed\n");
+    goto out_data;
+  }
+  init_combatants_layout(battle->combatants, num_combatants, num_kinds);
+  battle->snapshot = snapshot;
+
+  for (uint32_t i = 0; i < num_combatants; i++) {
+    struct combatant *combatant = &battle->combatants[i];
+    if (!read_snapshot_value(&reader, 1, &value)) {
+      goto out_data;
+    }
+    combatant->weapons_technology = (uint8_t)value;
+    if (!read_snapshot_value(&reader, 1, &value)) {
+      goto out_data;
+    }
+    combatant->shielding_technology = (uint8_t)value;
+    if (!read_snapshot_value(&reader, 1, &value)) {
+      goto out_data;
+    }
+    combatant->armor_technology = (uint8_t)value;
+    if (!read_snapshot_value(&reader, 1, &value)) {
+      goto out_data;
+    }
+
+    for (uint8_t kind = 0; kind < num_kinds; kind++) {
+      if (!read_snapshot_value(&reader, 8, &combatant->unit_groups[kind])) {
+        goto out_data;
+      }
+    }
+
+    for (uint32_t j = 0; j < num_rounds * num_kinds; j++) {
+      struct unit_group_stats *s = &combatant->stats[j];
+      if (!read_snapshot_value(&reader, 8, &s->times_fired) || !read_snapshot_value(&reader, 8, &s->times_was_shot) ||
+          !read_snapshot_value(&reader, 8, &s->shield_damage_dealt) ||
+          !read_snapshot_value(&reader, 8, &s->hull_damage_dealt) ||
+          !read_snapshot_value(&reader, 8, &s->shield_damage_taken) ||
+          !read_snapshot_value(&reader, 8, &s->hull_damage_taken) ||
+          !read_snapshot_value(&reader, 8, &s->num_remaining_units)) {
+        goto out_data;
+      }
+    }
+  }
+
+  /* Blocks are checked first and their hulls are copied afterwards, once the number of damaged units is known. */
+  size_t blocks_offset = reader.offset;
+  size_t num_hulls = 0;
+  if (!parse_snapshot_blocks(&reader, snapshot, 0, battle->num_attackers, num_kinds, &num_hulls) ||
+      !parse_snapshot_blocks(&reader, snapshot, 1, battle->num_defenders, num_kinds, &num_hulls)) {
+    goto out_data;
+  }
+
+  if (reader.offset != reader.size) {
+    report_error("The snapshot has trailing bytes\n");
+    goto out_data;
+  }
+
+  snapshot->hulls = malloc((num_hulls != 0 ? num_hulls : 1) * sizeof(*snapshot->hulls));
+  if (snapshot->hulls == NULL) {
+    report_error("Allocating memory for the snapshot failed\n");
+    goto out_data;
+  }
+
+  reader.offset = blocks_offset;
+  for (int side = 0; side < 2; side++) {
+    reader.offset += 4;
+    for (uint32_t b = 0; b < snapshot->num_blocks[side]; b++) {
+      const struct snapshot_block *block = &snapshot->blocks[side][b];
+      reader.offset += 20;
+      for (uint64_t i = 0; i < block->num_damaged; i++) {
+        read_snapshot_value(&reader, 4, &value);
+        uint32_t bits = (uint32_t)value;
+        float hull;
+        memcpy(&hull, &bits, sizeof(hull));
+        if (!(hull > 0.0f) || !isfinite(hull)) {
+          report_error("The snapshot has an invalid hull\n");
+          goto out_data;
+        }
+        snapshot->hulls[block->first_hull + i] = hull;
+      }
+    }
+  }
+
+  ret = true;
+
+out_data:
+  free(data);
+  if (!ret) {
+    cleanup_snapshot(snapshot);
+    cleanup_battle(battle);
+    memset(battle, 0, sizeof(*battle));
+  }
+out:
+  return ret;
+}
+#endif
+
+/* Same as create_party(), with the units of a side of a snapshot. */
+static struct party *restore_party(const struct units_attributes *restrict units_attributes,
+                                   struct combatant *combatants, const struct snapshot *restrict snapshot, int side) {
+  uint32_t num_blocks = snapshot->num_blocks[side];
+
+  struct party *party = calloc(1, sizeof(*party));
+  if (party == NULL) {
+    report_error("Allocating memory for a party failed\n");
+    goto fail;
+  }
+
+  party->combatants = combatants;
+  party->blocks = calloc(num_blocks != 0 ? num_blocks : 1, sizeof(*party->blocks));
+  party->offsets = malloc((num_blocks + 1) * sizeof(*party->offsets));
+  if (party->blocks == NULL || party->offsets == NULL) {
+    report_error("Allocating memory for party units failed\n");
+    goto fail_party;
+  }
+
+  for (uint32_t b = 0; b < num_blocks; b++) {
+    const struct snapshot_block *snapshot_block = &snapshot->blocks[side][b];
+    struct block *block = &party->blocks[party->num_blocks++];
+    init_block(block, units_attributes, &combatants[snapshot_block->combatant_id], snapshot_block->kind,
+               snapshot_block->combatant_id);
+    block->num_undamaged = snapshot_block->num_undamaged;
+
+    if (!reserve_units(&block->damaged, &block->damaged_capacity, snapshot_block->num_damaged)) {
+      goto fail_party;
+    }
+    for (uint64_t i = 0; i < snapshot_block->num_damaged; i++) {
+      block->damaged[i].shield = block->max_shield;
+      block->damaged[i].hull = snapshot->hulls[snapshot_block->first_hull + i];
+    }
+    block->num_damaged = snapshot_block->num_damaged;
+  }
+
+  update_offsets(party);
+
+  return party;
+
+fail_party:
+  cleanup_party(party);
+fail:
+  return NULL;
+}
+
+/*
+ * Same as fight(), from the state of the battle snapshot if it has one. If last_round is less than MAX_ROUNDS, the
+ * fight stops after it and the snapshot of the state is written to the output instead.
+ */
+static bool resume_fight(const struct units_attributes *restrict units_attributes, const struct battle *restrict battle,
+                         struct combatant *restrict combatants, uint32_t *restrict num_rounds,
+                         struct rng *restrict random, struct round_profile *restrict profile, uint32_t last_round,
+                         struct buffer *restrict snapshot_output) {
+  const struct snapshot *snapshot = battle->snapshot;
+  struct combatant *attackers = combatants;
+  struct combatant *defenders = &combatants[battle->num_attackers];
+  bool ret = false;
+
+  struct party *parties[2];
+  parties[0] = snapshot != NULL ? restore_party(units_attributes, attackers, snapshot, 0)
+                                : create_party(units_attributes, attackers, battle->num_attackers);
+  if (parties[0] == NULL) {
+    goto out;
+  }
+
+  parties[1] = snapshot != NULL ? restore_party(units_attributes, defenders, snapshot, 1)
+                                : create_party(units_attributes, defenders, battle->num_defenders);
+  if (parties[1] == NULL) {
+    goto out_attackers_party;
+  }
+
+  uint32_t round = snapshot != NULL ? snapshot->num_rounds : 0;
+  if (!fight_rounds(units_attributes, attackers, defenders, parties[0], parties[1], &round, last_round, random,
+                    profile)) {
+    goto out_defenders_party;
+  }
+
+  *num_rounds = round;
+
+  if (snapshot_output != NULL) {
+    ret = dump_snapshot(snapshot_output, units_attributes, battle, combatants, parties, round, random);
+    goto out_defenders_party;
+  }
+
+  update_combatants(units_attributes, attackers, battle->num_attackers, parties[0]);
+  update_combatants(units_attributes, defenders, battle->num_defenders, parties[1]);
+
+  ret = true;
+
+out_defenders_party:
+  cleanup_party(parties[1]);
+out_attackers_party:
+  cleanup_party(parties[0]);
+out:
+  return ret;
+}
+
+#ifndef BATTLE_ENGINE_LIBRARY
+/* Writes the snapshot of the simulation options->first_simulation of the seed after the round last_round - 1. */
+static bool run_snapshot(const struct units_attributes *restrict units_attributes, const struct battle *restrict battle,
+                         const struct simulation_options *restrict options, uint32_t seed,
+                         struct buffer *restrict output) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+
+  if (battle->combatants == NULL) {
+    report_error("A snapshot needs attackers and defenders\n");
+    return false;
   }
 
-  struct party *defenders_party = create_party(units_attributes, defenders, num_defenders);
-  if (defenders_party == NULL) {
-    goto out_attackers_party;
+  struct combatant *combatants = malloc(battle->combatants_size);
+  if (combatants == NULL) {
+    report_error("Allocating memory for combatants failed\n");
+    return false;
   }
+  copy_combatants(combatants, battle->combatants, battle->combatants_size,
+                  battle->num_attackers + battle->num_defenders, num_kinds);
 
-  uint32_t round = 0;
+  struct rng random;
+  if (options->snapshot_stream) {
+    random = battle->snapshot->rng;
+  } else {
+    init_rng(&random, options->rng, seed, options->first_simulation);
+  }
 
-  while (round < MAX_ROUNDS && attackers_party->num_alive > 0 && defenders_party->num_alive > 0) {
-    restore_shields(units_attributes, attackers_party);
-    restore_shields(units_attributes, defenders_party);
+  uint32_t num_rounds;
+  bool ok =
+      resume_fight(units_attributes, battle, combatants, &num_rounds, &random, NULL, options->snapshot_round, output);
+  free(combatants);
+  return ok;
+}
+#endif
+
+/*
+ * Writes the profile of simulations summed over slots: a line with the number of simulations, threads and the wall
+ * time, followed by a line for every round with the number of simulations that fought it, the time spent in them and
+ * the number of rapid fire chains, shots and the longest chain.
+ */
+static void dump_profile(FILE *restrict file, const struct round_profile *restrict slots_profiles, uint32_t num_slots,
+                         uint32_t num_simulations, uint32_t num_threads, uint64_t time_ns) {
+  fprintf(file, "profile %" PRIu32 " %" PRIu32 " %" PRIu64 "\n", num_simulations, num_threads, time_ns);
 
-    fire(units_attributes, attackers_party, defenders_party, round, random);
-    fire(units_attributes, defenders_party, attackers_party, round, random);
+  for (uint32_t round = 0; round < MAX_ROUNDS; round++) {
+    struct round_profile total = {0, 0, 0, 0, 0};
+    for (uint32_t i = 0; i < num_slots; i++) {
+      const struct round_profile *profile = &slots_profiles[i * MAX_ROUNDS + round];
+      total.num_fights += profile->num_fights;
+      total.time_ns += profile->time_ns;
+      total.num_chains += profile->num_chains;
+      total.num_shots += profile->num_shots;
+      if (profile->max_chain > total.max_chain) {
+        total.max_chain = profile->max_chain;
+      }
+    }
+    fprintf(file, "profile-round %" PRIu32 " %" PRIu64 " %" PRIu64 " %" PRIu64 " %" PRIu64 " %" PRIu64 "\n", round,
+            total.num_fights, total.time_ns, total.num_chains, total.num_shots, total.max_chain);
+  }
 
-    update_units(units_attributes, attackers, attackers_party, round);
-    update_units(units_attributes, defenders, defenders_party, round);
+  fflush(file);
+}
 
-    round++;
+/* The stats written in the memory of the caller of the library, see battle_engine_simulate(). */
+struct stats_output {
+  uint64_t *num_rounds;
+  uint64_t *stats;
+};
+
+/*
+ * Fights the simulations in chunks. The results are written to the stats output if it is given, otherwise added to the
+ * summary if it is given, otherwise written to the output. If the flush file is given, the output is written to it
+ * after every chunk, otherwise the whole output is accumulated in the buffer.
+ *
+ * With multiple threads, a chunk of simulations is fought in parallel, each in its own copy of the combatants, and the
+ * results are processed in the order of simulations afterwards.
+ */
+static bool run_chunks(const struct units_attributes *restrict units_attributes, const struct battle *restrict battle,
+                       const struct simulation_options *restrict options, uint32_t seed, uint32_t num_simulations,
+                       struct summary *restrict summary, struct buffer *restrict output, FILE *restrict flush_file,
+                       const struct stats_output *restrict stats_output) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+  uint32_t num_combatants = battle->num_attackers + battle->num_defenders;
+  bool projected = is_projected(&options->projection);
+
+  bool ret = false;
+
+  /* Threads are used within battles rather than across simulations with --battle-threads. */
+  uint32_t num_threads = options->num_threads > 1 && options->battle_threads == 0 ? options->num_threads : 1;
+  uint32_t num_slots = num_threads > 1 ? 2 * num_threads : 1;
+  if (num_slots > num_simulations) {
+    num_slots = num_simulations;
   }
 
-  *num_rounds = round;
+  uint64_t start = options->profile ? now_ns() : 0;
 
-  update_combatants(units_attributes, attackers, num_attackers, attackers_party);
-  update_combatants(units_attributes, defenders, num_defenders, defenders_party);
+  size_t slot_size = battle->combatants_size;
+  char *slots = malloc(num_slots * slot_size);
+  uint32_t *slots_num_rounds = malloc(num_slots * sizeof(*slots_num_rounds));
+  struct round_profile *slots_profiles =
+      options->profile ? calloc(num_slots * MAX_ROUNDS, sizeof(*slots_profiles)) : NULL;
+  if (slots == NULL || slots_num_rounds == NULL || (options->profile && slots_profiles == NULL)) {
+    report_error("Allocating memory for simulations failed\n");
+    goto out;
+  }
+
+  for (uint32_t first = 0; first < num_simulations; first += num_slots) {
+    int count = (int)(num_simulations - first < num_slots ? num_simulations - first : num_slots);
+    int failed = 0;
+
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic) num_threads((int)num_threads) reduction(| : failed)
+#endif
+    for (int i = 0; i < count; i++) {
+      struct combatant *combatants = (struct combatant *)(slots + (size_t)i * slot_size);
+      copy_combatants(combatants, battle->combatants, slot_size, num_combatants, num_kinds);
+
+      struct rng random;
+      if (options->snapshot_stream) {
+        random = battle->snapshot->rng;
+      } else {
+        init_rng(&random, options->rng, seed, options->first_simulation + first + (uint32_t)i);
+      }
+      struct round_profile *profile = slots_profiles != NULL ? &slots_profiles[(size_t)i * MAX_ROUNDS] : NULL;
+      slots_num_rounds[i] = 0;
+      bool ok;
+      if (options->approx_buckets != 0) {
+        ok = approx_fight(units_attributes, combatants, battle->num_attackers, &combatants[battle->num_attackers],
+                          battle->num_defenders, &slots_num_rounds[i], &random, profile, options->approx_buckets);
+      } else if (battle->snapshot != NULL) {
+        ok = resume_fight(units_attributes, battle, combatants, &slots_num_rounds[i], &random, profile, MAX_ROUNDS,
+                          NULL);
+      } else if (options->battle_threads != 0) {
+        ok = parallel_fight(units_attributes, combatants, battle->num_attackers, &combatants[battle->num_attackers],
+                            battle->num_defenders, &slots_num_rounds[i], &random, profile, options->battle_threads);
+      } else {
+        ok = fight(units_attributes, combatants, battle->num_attackers, &combatants[battle->num_attackers],
+                   battle->num_defenders, &slots_num_rounds[i], &random, profile);
+      }
+      if (!ok) {
+        failed = 1;
+      }
+    }
+
+    if (failed) {
+      goto out;
+    }
+
+    for (int i = 0; i < count; i++) {
+      const struct combatant *combatants = (const struct combatant *)(slots + (size_t)i * slot_size);
+      uint32_t num_rounds = slots_num_rounds[i];
+
+      if (stats_output != NULL) {
+        size_t simulation = (size_t)first + (size_t)i;
+        size_t simulation_size = (size_t)num_combatants * MAX_ROUNDS * num_kinds * NUM_STATS_FIELDS;
+        stats_output->num_rounds[simulation] = num_rounds;
+        /* The stats of all combatants are contiguous, see init_combatants_layout(). */
+        memcpy(&stats_output->stats[simulation * simulation_size], combatants[0].stats,
+               simulation_size * sizeof(uint64_t));
+      } else if (summary != NULL) {
+        update_summary(summary, battle->combatants, combatants, battle->num_attackers, num_combatants, num_kinds,
+                       num_rounds);
+      } else if (projected) {
+        if (!dump_projected_stats(output, battle->combatants, combatants, num_combatants, num_rounds, num_kinds,
+                                  &options->projection, options->binary)) {
+          goto out;
+        }
+      } else if (options->binary) {
+        if (!dump_binary_stats(output, combatants, num_combatants, num_rounds, num_kinds)) {
+          goto out;
+        }
+      } else {
+        if (!buffer_reserve(output, MAX_U64_TEXT_SIZE + 1)) {
+          goto out;
+        }
+        buffer_put_u64(output, num_rounds, '\n');
+        output->data[output->size++] = '\n';
+
+        if (!dump_stats(output, combatants, num_combatants, num_rounds, num_kinds)) {
+          goto out;
+        }
+      }
+    }
+
+    if (flush_file != NULL) {
+      fwrite(output->data, 1, output->size, flush_file);
+      output->size = 0;
+    }
+  }
+
+  if (slots_profiles != NULL) {
+    dump_profile(stderr, slots_profiles, num_slots, num_simulations, num_threads, now_ns() - start);
+  }
 
   ret = true;
 
-  free(defenders_party->units);
-  free(defenders_party);
-out_attackers_party:
-  free(attackers_party->units);
-  free(attackers_party);
 out:
+  free(slots_profiles);
+  free(slots_num_rounds);
+  free(slots);
   return ret;
 }
 
-static void dump_stats(FILE *restrict file, const struct combatant *restrict combatants, uint32_t num_combatants,
-                       uint32_t num_rounds, uint8_t num_kinds) {
-  for (uint32_t i = 0; i < num_combatants; i++) {
-    const struct combatant *combatant = &combatants[i];
-    for (uint32_t round = 0; round < num_rounds; round++) {
-      const struct unit_group_stats *stats = &combatant->stats[round * num_kinds];
+#ifndef BATTLE_ENGINE_LIBRARY
+/* Runs the simulations and writes their results or their summary to the output, see run_chunks(). */
+static bool run_simulations(const struct units_attributes *restrict units_attributes, struct battle *restrict battle,
+                            const struct simulation_options *restrict options, uint32_t seed, uint32_t num_simulations,
+                            struct buffer *restrict output, FILE *restrict flush_file) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+  uint32_t num_combatants = battle->combatants != NULL ? battle->num_attackers + battle->num_defenders : 0;
 
-      for (uint8_t kind = 0; kind < num_kinds; kind++) {
-        const struct unit_group_stats *s = &stats[kind];
-        fprintf(file, "%" PRIu64 " %" PRIu64 " %" PRIu64 " %" PRIu64 " %" PRIu64 " %" PRIu64 " %" PRIu64 "\n",
-                s->times_fired, s->times_was_shot, s->shield_damage_dealt, s->hull_damage_dealt, s->shield_damage_taken,
-                s->hull_damage_taken, s->num_remaining_units);
-      }
+  if (options->binary) {
+    uint16_t flags = options->summary ? BINARY_FLAG_SUMMARY : projection_flags(&options->projection);
+    if (options->rng == RNG_XOSHIRO) {
+      flags |= BINARY_FLAG_XOSHIRO;
+    }
+    if (options->approx_buckets != 0) {
+      flags |= BINARY_FLAG_APPROX;
+    }
+    if (options->battle_threads != 0) {
+      flags |= BINARY_FLAG_PARALLEL;
+    }
+    if (!dump_binary_header(output, flags, num_kinds, num_combatants)) {
+      return false;
+    }
+  }
+
+  if (options->summary) {
+    struct summary summary;
+    if (!init_summary(&summary, num_combatants, num_kinds)) {
+      return false;
+    }
+    bool ok = battle->combatants == NULL ||
+              run_chunks(units_attributes, battle, options, seed, num_simulations, &summary, output, NULL, NULL);
+    if (battle->combatants == NULL) {
+      summary.num_simulations = summary.draws = summary.rounds[0] = num_simulations;
+    }
+    ok = ok && dump_summary(output, &summary, options->binary, num_combatants, num_kinds);
+    cleanup_summary(&summary);
+    return ok;
+  }
 
-      fputc('\n', file);
+  if (battle->combatants == NULL) {
+    if (!options->binary) {
+      return buffer_append(output, "0\n", 2);
+    }
+    for (uint32_t n = 0; n < num_simulations; n++) {
+      if (!buffer_reserve(output, 8)) {
+        return false;
+      }
+      buffer_put_le64(output, 0);
     }
+    return true;
   }
+
+  return run_chunks(units_attributes, battle, options, seed, num_simulations, NULL, output, flush_file, NULL);
 }
 
-static int simulate(uint32_t seed, uint32_t num_simulations) {
-  int n, ret = 1;
+static int simulate(const struct simulation_options *options, uint32_t seed, uint32_t num_simulations) {
+  int ret = 1;
 
-  if (num_simulations == 0) {
+  /* The binary output has a header even without simulations. */
+  if (num_simulations == 0 && !options->binary) {
     return 0;
   }
 
@@ -503,83 +3589,556 @@ static int simulate(uint32_t seed, uint32_t num_simulations) {
     goto out;
   }
 
-  uint32_t num_attackers, num_defenders;
-  n = fscanf(stdin, "%" SCNu32 "%" SCNu32, &num_attackers, &num_defenders);
-  if (n != 2) {
-    fputs("Scanning the number of combatants failed\n", stderr);
+  struct battle battle;
+  struct snapshot snapshot;
+  if (options->resume ? !load_snapshot(stdin, units_attributes, &battle, &snapshot)
+                      : !load_battle(stdin, units_attributes, &battle)) {
     goto out_units_attributes;
   }
 
-  if (num_attackers == 0 || num_defenders == 0) {
-    puts("0");
+  if (options->resume && snapshot.rng.kind != options->rng) {
+    report_error("The snapshot was made with another random number generator\n");
+    goto out_battle;
+  }
+
+  struct buffer output = {NULL, 0, 0};
+  bool ok = options->snapshot
+                ? run_snapshot(units_attributes, &battle, options, seed, &output)
+                : run_simulations(units_attributes, &battle, options, seed, num_simulations, &output, stdout);
+  if (ok) {
+    fwrite(output.data, 1, output.size, stdout);
     ret = 0;
-    goto out_units_attributes;
   }
 
-  if (num_attackers > 256) {
-    fputs("The number of attackers cannot be greater than 256\n", stderr);
-    goto out_units_attributes;
+  buffer_cleanup(&output);
+out_battle:
+  if (options->resume) {
+    cleanup_snapshot(&snapshot);
   }
+  cleanup_battle(&battle);
+out_units_attributes:
+  cleanup_units_attributes(units_attributes);
+out:
+  return ret;
+}
 
-  if (num_defenders > 256) {
-    fputs("The number of defenders cannot be greater than 256\n", stderr);
-    goto out_units_attributes;
+/*
+ * Writes a response frame in the serve mode: a line with the status and the size of the payload, followed by the
+ * payload itself.
+ */
+static void write_frame(const char *restrict status, const char *restrict data, size_t size) {
+  printf("%s %" PRIu64 "\n", status, (uint64_t)size);
+  fwrite(data, 1, size, stdout);
+  fflush(stdout);
+}
+
+static void write_error_frame(void) { write_frame("error", error_message, strlen(error_message)); }
+
+/* Answers a simulate or run request with the results of the simulations or an error. */
+static void serve_simulations(const struct units_attributes *restrict units_attributes, struct battle *restrict battle,
+                              const struct simulation_options *restrict options, uint32_t seed,
+                              uint32_t num_simulations, struct buffer *restrict output) {
+  output->size = 0;
+  if (seed == 0) {
+    report_error("Seed cannot be 0\n");
+    write_error_frame();
+  } else if ((num_simulations != 0 || options->binary) &&
+             !run_simulations(units_attributes, battle, options, seed, num_simulations, output, NULL)) {
+    write_error_frame();
+  } else {
+    write_frame("ok", output->data, output->size);
   }
+}
 
-  uint32_t num_combatants = num_attackers + num_defenders;
-  struct combatant *combatants = load_combatants(stdin, units_attributes, num_combatants);
-  if (combatants == NULL) {
-    goto out_units_attributes;
+/*
+ * The battle of run requests: a battle request sets it, set-unit, set-tech and set-rapid-fire requests change it (the
+ * latter changes the units attributes of all requests) and a reset request restores it as loaded.
+ */
+struct prepared_battle {
+  struct battle base;
+  struct battle battle;
+  uint32_t *base_rapid_fire;
+};
+
+static bool copy_battle(struct battle *restrict dst, const struct battle *restrict src, uint8_t num_kinds) {
+  *dst = *src;
+  if (src->combatants == NULL) {
+    return true;
+  }
+
+  dst->combatants = malloc(src->combatants_size);
+  if (dst->combatants == NULL) {
+    report_error("Allocating memory for combatants failed\n");
+    return false;
+  }
+  copy_combatants(dst->combatants, src->combatants, src->combatants_size, src->num_attackers + src->num_defenders,
+                  num_kinds);
+  return true;
+}
+
+static void reset_prepared_battle(struct units_attributes *restrict units_attributes,
+                                  struct prepared_battle *restrict prepared) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+
+  cleanup_battle(&prepared->battle);
+  memset(&prepared->battle, 0, sizeof(prepared->battle));
+  memcpy(units_attributes->rapid_fire, prepared->base_rapid_fire,
+         (size_t)num_kinds * (size_t)num_kinds * sizeof(*units_attributes->rapid_fire));
+
+  if (!copy_battle(&prepared->battle, &prepared->base, num_kinds)) {
+    write_error_frame();
+  } else {
+    write_frame("ok", "", 0);
+  }
+}
+
+/* Returns the combatant of a set-unit or set-tech request, attackers first, or NULL if there is no such combatant. */
+static struct combatant *find_prepared_combatant(struct prepared_battle *prepared, uint32_t index) {
+  const struct battle *battle = &prepared->battle;
+  if (battle->combatants == NULL || index >= battle->num_attackers + battle->num_defenders) {
+    report_error("There is no combatant #%" PRIu32 "\n", index);
+    return NULL;
   }
+  return &battle->combatants[index];
+}
+
+/*
+ * Reads and answers a request other than simulate. Returns false if the request cannot be parsed, which is fatal as
+ * for simulate requests.
+ */
+static bool serve_prepared_request(const char *restrict command, struct units_attributes *restrict units_attributes,
+                                   struct prepared_battle *restrict prepared,
+                                   const struct simulation_options *restrict options, struct buffer *restrict output) {
+  const uint8_t num_kinds = units_attributes->num_kinds;
+  int n;
 
-  struct combatant *combatants_copy = NULL;
-  size_t combatants_size = 0;
-  if (num_simulations > 1) {
-    combatants_size = calc_combatants_alloc_size(units_attributes, num_combatants);
-    combatants_copy = malloc(combatants_size);
-    if (combatants_copy == NULL) {
-      goto out_combatants;
+  if (strcmp(command, "battle") == 0) {
+    struct battle battle;
+    if (!load_battle(stdin, units_attributes, &battle)) {
+      return false;
+    }
+    cleanup_battle(&prepared->base);
+    prepared->base = battle;
+    reset_prepared_battle(units_attributes, prepared);
+  } else if (strcmp(command, "run") == 0) {
+    uint32_t seed, num_simulations;
+    n = fscanf(stdin, "%" SCNu32 "%" SCNu32, &seed, &num_simulations);
+    if (n != 2) {
+      report_error("Scanning seed and num_simulations failed\n");
+      return false;
+    }
+    serve_simulations(units_attributes, &prepared->battle, options, seed, num_simulations, output);
+  } else if (strcmp(command, "reset") == 0) {
+    reset_prepared_battle(units_attributes, prepared);
+  } else if (strcmp(command, "set-unit") == 0) {
+    uint32_t index;
+    uint8_t kind;
+    uint64_t num_units;
+    n = fscanf(stdin, "%" SCNu32 "%" SCNu8 "%" SCNu64, &index, &kind, &num_units);
+    if (n != 3) {
+      report_error("Scanning the unit group failed\n");
+      return false;
     }
-    memcpy(combatants_copy, combatants, combatants_size);
+    struct combatant *combatant = find_prepared_combatant(prepared, index);
+    if (combatant == NULL) {
+      write_error_frame();
+    } else if (kind >= num_kinds) {
+      report_error("The unit group #%" PRIu8 " is invalid\n", kind);
+      write_error_frame();
+    } else {
+      combatant->unit_groups[kind] = num_units;
+      write_frame("ok", "", 0);
+    }
+  } else if (strcmp(command, "set-tech") == 0) {
+    uint32_t index;
+    uint8_t weapons_technology, shielding_technology, armor_technology;
+    n = fscanf(stdin, "%" SCNu32 "%" SCNu8 "%" SCNu8 "%" SCNu8, &index, &weapons_technology, &shielding_technology,
+               &armor_technology);
+    if (n != 4) {
+      report_error("Scanning the technologies failed\n");
+      return false;
+    }
+    struct combatant *combatant = find_prepared_combatant(prepared, index);
+    if (combatant == NULL) {
+      write_error_frame();
+    } else {
+      combatant->weapons_technology = weapons_technology;
+      combatant->shielding_technology = shielding_technology;
+      combatant->armor_technology = armor_technology;
+      write_frame("ok", "", 0);
+    }
+  } else if (strcmp(command, "set-rapid-fire") == 0) {
+    uint8_t kind, target_kind;
+    uint32_t rapid_fire;
+    n = fscanf(stdin, "%" SCNu8 "%" SCNu8 "%" SCNu32, &kind, &target_kind, &rapid_fire);
+    if (n != 3) {
+      report_error("Scanning the rapid fire failed\n");
+      return false;
+    }
+    if (kind >= num_kinds || target_kind >= num_kinds) {
+      report_error("The rapid fire of #%" PRIu8 " against #%" PRIu8 " is invalid\n", kind, target_kind);
+      write_error_frame();
+    } else {
+      units_attributes->attributes[kind].rapid_fire[target_kind] = rapid_fire;
+      write_frame("ok", "", 0);
+    }
+  } else {
+    report_error("Unknown command\n");
+    return false;
   }
 
-  struct combatant *attackers = combatants;
-  struct combatant *defenders = &combatants[num_attackers];
+  return true;
+}
+
+/*
+ * The serve mode: the units attributes are loaded once, after them requests are read from stdin until EOF. Every
+ * request is answered with exactly one frame. Requests that cannot be parsed are fatal, since the rest of the input
+ * cannot be trusted.
+ *
+ * A simulate request has its own battle. A parameter sweep loads a battle once with a battle request and then sends
+ * only the changes of every variant followed by a run request and a reset request, see struct prepared_battle.
+ */
+static int serve(const struct simulation_options *options) {
+  int n, ret = 1;
+
+  capture_errors = true;
+
+  struct units_attributes *units_attributes = load_units_attributes(stdin);
+  if (units_attributes == NULL) {
+    write_error_frame();
+    goto out;
+  }
+
+  const uint8_t num_kinds = units_attributes->num_kinds;
+  size_t rapid_fire_size = (size_t)num_kinds * (size_t)num_kinds * sizeof(*units_attributes->rapid_fire);
+
+  struct prepared_battle prepared;
+  memset(&prepared, 0, sizeof(prepared));
+  prepared.base_rapid_fire = malloc(rapid_fire_size);
+  if (prepared.base_rapid_fire == NULL) {
+    report_error("Allocating memory for rapid fire failed\n");
+    write_error_frame();
+    goto out_units_attributes;
+  }
+  memcpy(prepared.base_rapid_fire, units_attributes->rapid_fire, rapid_fire_size);
+
+  struct buffer output = {NULL, 0, 0};
+
+  for (;;) {
+    char command[16];
+    n = fscanf(stdin, "%15s", command);
+    if (n == EOF) {
+      break;
+    }
+
+    if (n != 1) {
+      report_error("Unknown command\n");
+      write_error_frame();
+      goto out_output;
+    }
+
+    if (strcmp(command, "simulate") != 0) {
+      if (!serve_prepared_request(command, units_attributes, &prepared, options, &output)) {
+        write_error_frame();
+        goto out_output;
+      }
+      continue;
+    }
 
-  for (uint32_t n = 0; n < num_simulations; n++) {
-    if (n != 0) {
-      memcpy(combatants, combatants_copy, combatants_size);
+    uint32_t seed, num_simulations;
+    n = fscanf(stdin, "%" SCNu32 "%" SCNu32, &seed, &num_simulations);
+    if (n != 2) {
+      report_error("Scanning seed and num_simulations failed\n");
+      write_error_frame();
+      goto out_output;
     }
 
-    uint32_t num_rounds = 0;
-    fight(units_attributes, attackers, num_attackers, defenders, num_defenders, &num_rounds, &seed);
+    struct battle battle;
+    if (!load_battle(stdin, units_attributes, &battle)) {
+      write_error_frame();
+      goto out_output;
+    }
 
-    printf("%" PRIu32 "\n\n", num_rounds);
+    serve_simulations(units_attributes, &battle, options, seed, num_simulations, &output);
 
-    dump_stats(stdout, combatants, num_attackers + num_defenders, num_rounds, units_attributes->num_kinds);
+    cleanup_battle(&battle);
   }
 
   ret = 0;
 
-  free(combatants_copy);
-out_combatants:
-  free(combatants);
+out_output:
+  buffer_cleanup(&output);
+  cleanup_battle(&prepared.battle);
+  cleanup_battle(&prepared.base);
+  free(prepared.base_rapid_fire);
 out_units_attributes:
   cleanup_units_attributes(units_attributes);
 out:
   return ret;
 }
 
+static void print_usage(const char *program) {
+  fprintf(stderr,
+          "Usage: %s [OPTIONS] <SEED> <NUM_SIMULATIONS>\n"
+          "       %s [OPTIONS] --serve\n"
+          "\n"
+          "Options:\n"
+          "  --binary       Write the output in the binary format\n"
+          "  --threads <N>  Split simulations across N threads\n"
+          "  --summary      Write only a summary of all simulations\n"
+          "  --offset <N>   Start with the N-th simulation of the seed\n"
+          "  --profile      Write per-round timings and shot counts to stderr\n"
+          "  --last-round   Write only the stats of the last round\n"
+          "  --fields <M>   Write only the stats fields of the mask M (bit i = field i)\n"
+          "  --sparse       Write only the stats of kinds that combatants have\n"
+          "  --rng <NAME>   Random number generator: lehmer (default) or xoshiro\n"
+          "  --approx <B>   Approximate mode with B hull buckets per unit group\n"
+          "  --battle-threads <N>\n"
+          "                 Fight every battle with N threads instead of splitting simulations\n"
+          "  --snapshot <R> Write the state of the simulation after R rounds instead of its results\n"
+          "  --resume       Resume simulations from a snapshot given after the units attributes\n"
+          "  --snapshot-stream\n"
+          "                 Continue the random stream of the snapshot instead of the streams of the seed\n",
+          program, program);
+}
+#endif
+
+#ifdef BATTLE_ENGINE_LIBRARY
+#ifdef _WIN32
+#define BATTLE_ENGINE_API __declspec(dllexport)
+#else
+#define BATTLE_ENGINE_API __attribute__((visibility("default")))
+#endif
+
+/*
+ * The entry point of the shared library, see BattleEngine.py: the same simulations as the command line with
+ * --threads, --rng and --battle-threads, given as arrays instead of text and written to the memory of the caller.
+ *
+ * attributes has the weapons, shield and armor of every kind, rapid_fire[kind * num_kinds + target_kind] the rapid
+ * fire. Combatants are attackers followed by defenders: technologies has their weapons, shielding and armor
+ * technologies, unit_groups[combatant * num_kinds + kind] their units. The number of rounds of every simulation is
+ * written to num_rounds, and its stats to stats: num_combatants * MAX_ROUNDS * num_kinds records of the fields of
+ * struct unit_group_stats, zero after the last round. Returns 0, or 1 with the error message written to error.
+ */
+BATTLE_ENGINE_API int battle_engine_simulate(uint32_t num_kinds, const float *attributes, const uint32_t *rapid_fire,
+                                             uint32_t num_attackers, uint32_t num_defenders,
+                                             const uint8_t *technologies, const uint64_t *unit_groups, uint32_t seed,
+                                             uint32_t first_simulation, uint32_t num_simulations, uint32_t num_threads,
+                                             uint32_t rng, uint32_t battle_threads, uint64_t *num_rounds,
+                                             uint64_t *stats, char *error, size_t error_size) {
+  int ret = 1;
+
+  error_message[0] = '\0';
+
+  if (num_kinds == 0 || num_kinds > UINT8_MAX) {
+    report_error("The number of kinds must be between 1 and %d\n", UINT8_MAX);
+    goto out;
+  }
+
+  if (num_attackers > 256 || num_defenders > 256) {
+    report_error("The number of attackers and defenders cannot be greater than 256\n");
+    goto out;
+  }
+
+  if (seed == 0) {
+    report_error("Seed cannot be 0\n");
+    goto out;
+  }
+
+  if (rng != RNG_LEHMER && rng != RNG_XOSHIRO) {
+    report_error("Unknown random number generator\n");
+    goto out;
+  }
+
+  if (battle_threads > MAX_BATTLE_THREADS) {
+    report_error("The number of battle threads must be between 0 and %d\n", MAX_BATTLE_THREADS);
+    goto out;
+  }
+
+  uint32_t num_combatants = num_attackers + num_defenders;
+  size_t simulation_size = (size_t)num_combatants * MAX_ROUNDS * num_kinds * NUM_STATS_FIELDS;
+  if (num_attackers == 0 || num_defenders == 0) {
+    /* Nothing to fight, as in run_simulations(). */
+    memset(num_rounds, 0, (size_t)num_simulations * sizeof(*num_rounds));
+    memset(stats, 0, (size_t)num_simulations * simulation_size * sizeof(*stats));
+    ret = 0;
+    goto out;
+  }
+
+  struct units_attributes *units_attributes = create_units_attributes((uint8_t)num_kinds);
+  if (units_attributes == NULL) {
+    goto out;
+  }
+
+  for (uint32_t kind = 0; kind < num_kinds; kind++) {
+    struct unit_attributes *attr = &units_attributes->attributes[kind];
+    attr->weapons = attributes[3 * kind];
+    attr->shield = attributes[3 * kind + 1];
+    attr->armor = attributes[3 * kind + 2];
+  }
+  memcpy(units_attributes->rapid_fire, rapid_fire, (size_t)num_kinds * num_kinds * sizeof(*rapid_fire));
+
+  struct battle battle = {num_attackers, num_defenders, NULL, 0, NULL};
+  battle.combatants_size = calc_combatants_alloc_size(units_attributes, num_combatants);
+  battle.combatants = calloc(battle.combatants_size, 1);
+  if (battle.combatants == NULL) {
+    report_error("Allocating memory for combatants failed\n");
+    goto out_units_attributes;
+  }
+
+  init_combatants_layout(battle.combatants, num_combatants, (uint8_t)num_kinds);
+  for (uint32_t i = 0; i < num_combatants; i++) {
+    struct combatant *combatant = &battle.combatants[i];
+    combatant->weapons_technology = technologies[3 * i];
+    combatant->shielding_technology = technologies[3 * i + 1];
+    combatant->armor_technology = technologies[3 * i + 2];
+    memcpy(combatant->unit_groups, &unit_groups[(size_t)i * num_kinds], num_kinds * sizeof(*unit_groups));
+  }
+
+  struct simulation_options options = {.num_threads = num_threads,
+                                       .first_simulation = first_simulation,
+                                       .projection = {false, false, ALL_STATS_FIELDS},
+                                       .rng = (enum rng_kind)rng,
+                                       .battle_threads = battle_threads};
+  struct stats_output output = {num_rounds, stats};
+  if (run_chunks(units_attributes, &battle, &options, seed, num_simulations, NULL, NULL, NULL, &output)) {
+    ret = 0;
+  }
+
+  cleanup_battle(&battle);
+out_units_attributes:
+  cleanup_units_attributes(units_attributes);
+out:
+  if (ret != 0 && error_size != 0) {
+    /* Errors of other threads of OpenMP are in their own messages. */
+    snprintf(error, error_size, "%s", error_message[0] != '\0' ? error_message : "Simulating the battle failed\n");
+  }
+  return ret;
+}
+#else
 int main(int argc, char *argv[]) {
   int n;
 
-  if (argc != 3) {
-    fprintf(stderr, "Usage: %s <SEED> <NUM_SIMULATIONS>\n", argv[0]);
+  bool serve_mode = false;
+  /* Options that are not given are false or 0. */
+  struct simulation_options options = {
+      .num_threads = 1, .projection = {false, false, ALL_STATS_FIELDS}, .rng = RNG_LEHMER};
+  const char *positional[2];
+  int num_positional = 0;
+
+  for (int i = 1; i < argc; i++) {
+    if (strcmp(argv[i], "--serve") == 0) {
+      serve_mode = true;
+    } else if (strcmp(argv[i], "--binary") == 0) {
+      options.binary = true;
+    } else if (strcmp(argv[i], "--summary") == 0) {
+      options.summary = true;
+    } else if (strcmp(argv[i], "--profile") == 0) {
+      options.profile = true;
+    } else if (strcmp(argv[i], "--rng") == 0 && i + 1 < argc) {
+      i++;
+      if (strcmp(argv[i], "lehmer") == 0) {
+        options.rng = RNG_LEHMER;
+      } else if (strcmp(argv[i], "xoshiro") == 0) {
+        options.rng = RNG_XOSHIRO;
+      } else {
+        fputs("Unknown random number generator\n", stderr);
+        return 1;
+      }
+    } else if (strcmp(argv[i], "--last-round") == 0) {
+      options.projection.last_round = true;
+    } else if (strcmp(argv[i], "--sparse") == 0) {
+      options.projection.sparse = true;
+    } else if (strcmp(argv[i], "--fields") == 0 && i + 1 < argc) {
+      unsigned fields;
+      n = sscanf(argv[++i], "%u", &fields);
+      if (n != 1 || fields == 0 || fields > ALL_STATS_FIELDS) {
+        fputs("Fields must be a mask between 1 and 127\n", stderr);
+        return 1;
+      }
+      options.projection.fields = (uint8_t)fields;
+    } else if (strcmp(argv[i], "--approx") == 0 && i + 1 < argc) {
+      n = sscanf(argv[++i], "%" SCNu32, &options.approx_buckets);
+      if (n != 1 || options.approx_buckets == 0 || options.approx_buckets > MAX_APPROX_BUCKETS) {
+        fprintf(stderr, "The number of buckets must be between 1 and %d\n", MAX_APPROX_BUCKETS);
+        return 1;
+      }
+    } else if (strcmp(argv[i], "--battle-threads") == 0 && i + 1 < argc) {
+      n = sscanf(argv[++i], "%" SCNu32, &options.battle_threads);
+      if (n != 1 || options.battle_threads == 0 || options.battle_threads > MAX_BATTLE_THREADS) {
+        fprintf(stderr, "The number of battle threads must be between 1 and %d\n", MAX_BATTLE_THREADS);
+        return 1;
+      }
+    } else if (strcmp(argv[i], "--snapshot") == 0 && i + 1 < argc) {
+      options.snapshot = true;
+      n = sscanf(argv[++i], "%" SCNu32, &options.snapshot_round);
+      if (n != 1 || options.snapshot_round > MAX_ROUNDS) {
+        fprintf(stderr, "The snapshot round must be between 0 and %d\n", MAX_ROUNDS);
+        return 1;
+      }
+    } else if (strcmp(argv[i], "--resume") == 0) {
+      options.resume = true;
+    } else if (strcmp(argv[i], "--snapshot-stream") == 0) {
+      options.snapshot_stream = true;
+    } else if (strcmp(argv[i], "--offset") == 0 && i + 1 < argc) {
+      n = sscanf(argv[++i], "%" SCNu32, &options.first_simulation);
+      if (n != 1) {
+        fputs("Scanning the offset failed\n", stderr);
+        return 1;
+      }
+    } else if (strcmp(argv[i], "--threads") == 0 && i + 1 < argc) {
+      n = sscanf(argv[++i], "%" SCNu32, &options.num_threads);
+      if (n != 1) {
+        fputs("Scanning the number of threads failed\n", stderr);
+        return 1;
+      }
+    } else if (strncmp(argv[i], "--", 2) == 0 || num_positional == 2) {
+      print_usage(argv[0]);
+      return 1;
+    } else {
+      positional[num_positional++] = argv[i];
+    }
+  }
+
+  if (options.approx_buckets != 0 && options.battle_threads != 0) {
+    fputs("The approximate mode cannot be used with battle threads\n", stderr);
+    return 1;
+  }
+
+  if ((options.snapshot || options.resume) && (options.approx_buckets != 0 || options.battle_threads != 0)) {
+    fputs("Snapshots cannot be used with the approximate mode or battle threads\n", stderr);
+    return 1;
+  }
+
+  if (options.snapshot_stream && !options.resume) {
+    fputs("The snapshot stream can only be used with --resume\n", stderr);
+    return 1;
+  }
+
+#ifdef _WIN32
+  if (serve_mode || options.binary || options.snapshot) {
+    _setmode(_fileno(stdout), _O_BINARY);
+  }
+  if (options.resume) {
+    _setmode(_fileno(stdin), _O_BINARY);
+  }
+#endif
+
+  if (serve_mode) {
+    if (num_positional != 0 || options.snapshot || options.resume) {
+      print_usage(argv[0]);
+      return 1;
+    }
+    return serve(&options);
+  }
+
+  if (num_positional != 2) {
+    print_usage(argv[0]);
     return 1;
   }
 
   uint32_t seed;
-  n = sscanf(argv[1], "%" SCNu32, &seed);
+  n = sscanf(positional[0], "%" SCNu32, &seed);
   if (n != 1) {
     fputs("Scanning seed failed\n", stderr);
     return 1;
@@ -591,11 +4150,17 @@ int main(int argc, char *argv[]) {
   }
 
   uint32_t num_simulations;
-  n = sscanf(argv[2], "%" SCNu32, &num_simulations);
+  n = sscanf(positional[1], "%" SCNu32, &num_simulations);
   if (n != 1) {
     fputs("Scanning num_simulations failed\n", stderr);
     return 1;
   }
 
-  return simulate(seed, num_simulations);
+  if (options.snapshot && num_simulations != 1) {
+    fputs("A snapshot is made of exactly 1 simulation\n", stderr);
+    return 1;
+  }
+
+  return simulate(&options, seed, num_simulations);
 }
+#endif
@@ -13,12 +13,86 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import array
+import asyncio
+import collections
+import ctypes
+import hashlib
+import math
+import mmap
+import os
+import queue
 import random
+import struct
 import subprocess
-from typing import Dict, List, NewType
+import threading
+import time
+import weakref
+from typing import Callable, Dict, Iterator, List, NewType, Optional, Sequence, Tuple, Union
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 UnitKind = NewType('UnitKind', int)
 
+MAX_ROUNDS = 6
+
+SUMMARY_BUCKETS = 32
+
+# Hull buckets per unit group in the approximate mode, see BattleEngine.simulate().
+APPROXIMATE_BUCKETS = 64
+MAX_APPROXIMATE_BUCKETS = 1000
+
+# Threads of one battle with BattleEngine(battle_threads=...), 0 fights every battle in one thread.
+MAX_BATTLE_THREADS = 1024
+
+UNIT_GROUP_STATS_FIELDS = ('times_fired', 'times_was_shot', 'shield_damage_dealt', 'hull_damage_dealt',
+                           'shield_damage_taken', 'hull_damage_taken', 'num_remaining_units')
+
+_BINARY_MAGIC = b'OGBE'
+_BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct('<4sHHII')
+_BINARY_NUM_ROUNDS = struct.Struct('<Q')
+_BINARY_GROUP_STATS = struct.Struct('<7Q')
+# Stats written by the library in the byte order of the machine.
+_NATIVE_GROUP_STATS = struct.Struct('=7Q')
+_LIBRARY_ERROR_SIZE = 256
+
+# Outcome store: a header padded to _STORE_HEADER_SIZE, followed by records of a key (simulation, combatant, round,
+# kind) and the stats in the format of the binary output.
+_STORE_MAGIC = b'OGBO'
+_STORE_VERSION = 1
+_STORE_HEADER = struct.Struct('<4sHHQQ')
+_STORE_HEADER_SIZE = 64
+_STORE_KEY = struct.Struct('<QIHH')
+_STORE_SIMULATION = struct.Struct('<Q')
+_STORE_RECORD_SIZE = _STORE_KEY.size + _BINARY_GROUP_STATS.size
+# Appended records are written and committed once they take this many bytes.
+_STORE_FLUSH_SIZE = 1 << 20
+_BINARY_FLAG_SUMMARY = 0x1
+_BINARY_FLAG_LAST_ROUND = 0x2
+_BINARY_FLAG_SPARSE = 0x4
+_BINARY_FLAG_XOSHIRO = 0x8
+_BINARY_FLAG_APPROXIMATE = 0x10
+_BINARY_FLAG_PARALLEL = 0x20
+_BINARY_FIELDS_SHIFT = 8
+_SNAPSHOT_MAGIC = b'OGBS'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<4sHHIIII')
+_BINARY_SUMMARY_TOTALS = struct.Struct('<{}Q'.format(4 + MAX_ROUNDS + 1))
+
+# Sizes of the engine structures on 64-bit platforms, used by BattleEngine.estimate_memory().
+_SIZEOF_COMBATANT = 24
+_SIZEOF_UNIT_GROUP_STATS = 56
+_SIZEOF_UNIT = 8
+_SIZEOF_BLOCK = 72
+
+BACKENDS = ('process', 'numpy')
+
+RNGS = ('lehmer', 'xoshiro')
+
 
 class UnitAttributes:
     weapons: float
@@ -106,18 +180,877 @@ class BattleOutcome:
         self.defenders_outcomes = defenders_outcomes
 
 
+class _LazyCombatantOutcome(CombatantOutcome):
+    def __init__(self, stats: 'numpy.ndarray', num_rounds: int):
+        self._stats = stats
+        self._num_rounds = num_rounds
+        self._rounds_stats = None
+
+    @property
+    def rounds_stats(self) -> List[Dict[UnitKind, UnitGroupStats]]:
+        if self._rounds_stats is None:
+            self._rounds_stats = [{UnitKind(kind): UnitGroupStats(*fields) for kind, fields in enumerate(round_stats)}
+                                  for round_stats in self._stats[:self._num_rounds].tolist()]
+        return self._rounds_stats
+
+
+class OutputProjection:
+    last_round: bool
+    fields: Tuple[str, ...]
+    sparse: bool
+
+    def __init__(self, last_round: bool = False, fields: Sequence[str] = None, sparse: bool = False):
+        if fields is None:
+            fields = UNIT_GROUP_STATS_FIELDS
+        for field in fields:
+            if field not in UNIT_GROUP_STATS_FIELDS:
+                raise ValueError('unknown field {}'.format(field))
+        if not fields:
+            raise ValueError('fields cannot be empty')
+        self.last_round = last_round
+        # The engine writes fields in the order of UnitGroupStats.
+        self.fields = tuple(field for field in UNIT_GROUP_STATS_FIELDS if field in fields)
+        self.sparse = sparse
+
+    @property
+    def field_mask(self) -> int:
+        return sum(1 << UNIT_GROUP_STATS_FIELDS.index(field) for field in self.fields)
+
+    @property
+    def _all_fields(self) -> bool:
+        return len(self.fields) == len(UNIT_GROUP_STATS_FIELDS)
+
+    def _engine_options(self) -> Tuple[str, ...]:
+        options = []
+        if self.last_round:
+            options.append('--last-round')
+        if not self._all_fields:
+            options.extend(('--fields', str(self.field_mask)))
+        if self.sparse:
+            options.append('--sparse')
+        return tuple(options)
+
+    @property
+    def _binary_flags(self) -> int:
+        flags = 0
+        if self.last_round:
+            flags |= _BINARY_FLAG_LAST_ROUND
+        if self.sparse:
+            flags |= _BINARY_FLAG_SPARSE
+        if not self._all_fields:
+            flags |= self.field_mask << _BINARY_FIELDS_SHIFT
+        return flags
+
+    def _kinds(self, combatant: Combatant, num_kinds: int) -> List[UnitKind]:
+        if self.sparse:
+            return sorted(UnitKind(kind) for kind, count in combatant.unit_groups.items() if count != 0)
+        return [UnitKind(kind) for kind in range(num_kinds)]
+
+    def _num_written_rounds(self, num_rounds: int) -> int:
+        return min(num_rounds, 1) if self.last_round else num_rounds
+
+    def _make_outcome(self, num_rounds: int, kinds: List[UnitKind], values: Sequence[int]) -> CombatantOutcome:
+        # Fields that were not written are None, so are the rounds before the last one with last_round.
+        indices = [UNIT_GROUP_STATS_FIELDS.index(field) for field in self.fields]
+        num_fields = len(indices)
+        num_written_rounds = self._num_written_rounds(num_rounds)
+        rounds_stats = [None] * (num_rounds - num_written_rounds)
+        index = 0
+        for _ in range(num_written_rounds):
+            round_stats = {}
+            for kind in kinds:
+                fields = [None] * len(UNIT_GROUP_STATS_FIELDS)
+                for field, value in zip(indices, values[index:index + num_fields]):
+                    fields[field] = value
+                round_stats[kind] = UnitGroupStats(*fields)
+                index += num_fields
+            rounds_stats.append(round_stats)
+        return CombatantOutcome(rounds_stats)
+
+
+class SimulationBatch:
+    stats: 'numpy.ndarray'
+    num_rounds: 'numpy.ndarray'
+    num_attackers: int
+    num_defenders: int
+
+    def __init__(self, stats: 'numpy.ndarray', num_rounds: 'numpy.ndarray', num_attackers: int, num_defenders: int):
+        self.stats = stats
+        self.num_rounds = num_rounds
+        self.num_attackers = num_attackers
+        self.num_defenders = num_defenders
+
+    def __len__(self) -> int:
+        return len(self.num_rounds)
+
+    def __getitem__(self, simulation: int) -> BattleOutcome:
+        num_rounds = int(self.num_rounds[simulation])
+        outcomes = [_LazyCombatantOutcome(stats, num_rounds) for stats in self.stats[simulation]]
+        return BattleOutcome(num_rounds, outcomes[:self.num_attackers], outcomes[self.num_attackers:])
+
+    def __iter__(self) -> Iterator[BattleOutcome]:
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def rounds_mask(self) -> 'numpy.ndarray':
+        return numpy.arange(MAX_ROUNDS) < self.num_rounds[:, numpy.newaxis]
+
+    def field(self, name: str) -> 'numpy.ndarray':
+        return self.stats[..., UNIT_GROUP_STATS_FIELDS.index(name)]
+
+    def final_stats(self) -> 'numpy.ndarray':
+        # Simulations without any round (one of the sides has no units) get zeroed stats.
+        last_round = numpy.maximum(self.num_rounds.astype(numpy.intp) - 1, 0)
+        stats = self.stats[numpy.arange(len(self)), :, last_round]
+        stats[self.num_rounds == 0] = 0
+        return stats
+
+    def final_field(self, name: str) -> 'numpy.ndarray':
+        return self.final_stats()[..., UNIT_GROUP_STATS_FIELDS.index(name)]
+
+    def final_remaining_units(self) -> 'numpy.ndarray':
+        return self.final_field('num_remaining_units')
+
+    def total_field(self, name: str) -> 'numpy.ndarray':
+        return self.field(name).sum(axis=2)
+
+    def _alive(self) -> Tuple['numpy.ndarray', 'numpy.ndarray']:
+        remaining = self.final_remaining_units()
+        attackers_alive = remaining[:, :self.num_attackers].any(axis=(1, 2))
+        defenders_alive = remaining[:, self.num_attackers:].any(axis=(1, 2))
+        return attackers_alive, defenders_alive
+
+    def attackers_win(self) -> 'numpy.ndarray':
+        attackers_alive, defenders_alive = self._alive()
+        return attackers_alive & ~defenders_alive
+
+    def defenders_win(self) -> 'numpy.ndarray':
+        attackers_alive, defenders_alive = self._alive()
+        return defenders_alive & ~attackers_alive
+
+    def draws(self) -> 'numpy.ndarray':
+        attackers_alive, defenders_alive = self._alive()
+        return attackers_alive == defenders_alive
+
+    def mean(self, name: str = 'num_remaining_units') -> 'numpy.ndarray':
+        return self.final_field(name).mean(axis=0)
+
+    def pstdev(self, name: str = 'num_remaining_units') -> 'numpy.ndarray':
+        return self.final_field(name).std(axis=0)
+
+    def min(self, name: str = 'num_remaining_units') -> 'numpy.ndarray':
+        return self.final_field(name).min(axis=0)
+
+    def max(self, name: str = 'num_remaining_units') -> 'numpy.ndarray':
+        return self.final_field(name).max(axis=0)
+
+
+class UnitGroupSummary:
+    num_simulations: int
+    num_units: int
+    mean: float
+    m2: float
+    min: int
+    max: int
+    histogram: List[int]
+
+    def __init__(self, num_simulations: int, num_units: int, mean: float, m2: float, min: int, max: int,
+                 histogram: List[int]):
+        self.num_simulations = num_simulations
+        self.num_units = num_units
+        self.mean = mean
+        self.m2 = m2
+        self.min = min
+        self.max = max
+        self.histogram = histogram
+
+    def merge(self, other: 'UnitGroupSummary') -> 'UnitGroupSummary':
+        num_simulations = self.num_simulations + other.num_simulations
+        if self.num_simulations == 0 or other.num_simulations == 0:
+            return self if other.num_simulations == 0 else other
+        # Chan et al. parallel variant of Welford's algorithm.
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.num_simulations / num_simulations
+        m2 = self.m2 + other.m2 + delta * delta * self.num_simulations * other.num_simulations / num_simulations
+        histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+        return UnitGroupSummary(num_simulations, self.num_units, mean, m2, min(self.min, other.min),
+                                max(self.max, other.max), histogram)
+
+    @property
+    def stdev(self) -> float:
+        if self.num_simulations < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.num_simulations - 1))
+
+    @property
+    def pstdev(self) -> float:
+        if self.num_simulations == 0:
+            return 0.0
+        return math.sqrt(self.m2 / self.num_simulations)
+
+    def percentile(self, p: float) -> float:
+        if not (0.0 <= p <= 100.0):
+            raise ValueError('p must be between 0 and 100')
+        if self.num_simulations == 0:
+            return 0.0
+
+        # Bucket b holds the remaining units x with b * (n + 1) / B <= x < (b + 1) * (n + 1) / B, the value is
+        # interpolated linearly within the bucket.
+        bucket_width = (self.num_units + 1) / SUMMARY_BUCKETS
+        rank = p / 100.0 * self.num_simulations
+        cumulative = 0
+        for bucket, count in enumerate(self.histogram):
+            if count != 0 and cumulative + count >= rank:
+                value = (bucket + (rank - cumulative) / count) * bucket_width
+                return min(max(value, self.min), self.max)
+            cumulative += count
+        return float(self.max)
+
+
+class SimulationSummary:
+    num_simulations: int
+    attackers_wins: int
+    defenders_wins: int
+    draws: int
+    rounds: List[int]
+    attackers_summaries: List[Dict[UnitKind, UnitGroupSummary]]
+    defenders_summaries: List[Dict[UnitKind, UnitGroupSummary]]
+
+    def __init__(self, num_simulations: int, attackers_wins: int, defenders_wins: int, draws: int, rounds: List[int],
+                 attackers_summaries: List[Dict[UnitKind, UnitGroupSummary]],
+                 defenders_summaries: List[Dict[UnitKind, UnitGroupSummary]]):
+        self.num_simulations = num_simulations
+        self.attackers_wins = attackers_wins
+        self.defenders_wins = defenders_wins
+        self.draws = draws
+        self.rounds = rounds
+        self.attackers_summaries = attackers_summaries
+        self.defenders_summaries = defenders_summaries
+
+    def merge(self, other: 'SimulationSummary') -> 'SimulationSummary':
+        def merge_summaries(a, b):
+            return [{kind: x[kind].merge(y[kind]) for kind in x} for x, y in zip(a, b)]
+
+        return SimulationSummary(self.num_simulations + other.num_simulations,
+                                 self.attackers_wins + other.attackers_wins,
+                                 self.defenders_wins + other.defenders_wins, self.draws + other.draws,
+                                 [a + b for a, b in zip(self.rounds, other.rounds)],
+                                 merge_summaries(self.attackers_summaries, other.attackers_summaries),
+                                 merge_summaries(self.defenders_summaries, other.defenders_summaries))
+
+    def _rate(self, count: int) -> float:
+        return count / self.num_simulations if self.num_simulations != 0 else 0.0
+
+    @property
+    def attackers_win_rate(self) -> float:
+        return self._rate(self.attackers_wins)
+
+    @property
+    def defenders_win_rate(self) -> float:
+        return self._rate(self.defenders_wins)
+
+    @property
+    def draw_rate(self) -> float:
+        return self._rate(self.draws)
+
+    @property
+    def mean_rounds(self) -> float:
+        return self._rate(sum(round_no * count for round_no, count in enumerate(self.rounds)))
+
+
+class Estimate:
+    value: float
+    low: float
+    high: float
+
+    def __init__(self, value: float, low: float, high: float):
+        self.value = value
+        self.low = low
+        self.high = high
+
+    @property
+    def width(self) -> float:
+        return self.high - self.low
+
+
+class AdaptiveSimulationResult:
+    num_simulations: int
+    converged: bool
+    summary: SimulationSummary
+    attackers_win_probability: Estimate
+    attackers_mean_remaining_units: List[Dict[UnitKind, Estimate]]
+    defenders_mean_remaining_units: List[Dict[UnitKind, Estimate]]
+
+    def __init__(self, num_simulations: int, converged: bool, summary: SimulationSummary,
+                 attackers_win_probability: Estimate, attackers_mean_remaining_units: List[Dict[UnitKind, Estimate]],
+                 defenders_mean_remaining_units: List[Dict[UnitKind, Estimate]]):
+        self.num_simulations = num_simulations
+        self.converged = converged
+        self.summary = summary
+        self.attackers_win_probability = attackers_win_probability
+        self.attackers_mean_remaining_units = attackers_mean_remaining_units
+        self.defenders_mean_remaining_units = defenders_mean_remaining_units
+
+
+class FleetSearchResult:
+    count: Optional[int]
+    unit_groups: Optional[Dict[UnitKind, int]]
+    win_probability: Optional[Estimate]
+    points: Dict[int, Estimate]
+    num_simulations: int
+
+    def __init__(self, count: Optional[int], unit_groups: Optional[Dict[UnitKind, int]],
+                 win_probability: Optional[Estimate], points: Dict[int, Estimate], num_simulations: int):
+        self.count = count
+        self.unit_groups = unit_groups
+        self.win_probability = win_probability
+        self.points = points
+        self.num_simulations = num_simulations
+
+    @property
+    def found(self) -> bool:
+        return self.count is not None
+
+
+class Variation:
+    # Changes of a prepared battle: unit counts by (side, combatant, kind), technologies (weapons, shielding, armor) by
+    # (side, combatant) and rapid fire by (kind, target kind). Sides are 'attackers' or 'defenders'.
+    unit_groups: Dict[Tuple[str, int, UnitKind], int]
+    technologies: Dict[Tuple[str, int], Tuple[int, int, int]]
+    rapid_fire: Dict[Tuple[UnitKind, UnitKind], int]
+
+    def __init__(self, unit_groups: Dict[Tuple[str, int, UnitKind], int] = None,
+                 technologies: Dict[Tuple[str, int], Tuple[int, int, int]] = None,
+                 rapid_fire: Dict[Tuple[UnitKind, UnitKind], int] = None):
+        self.unit_groups = dict(unit_groups or {})
+        self.technologies = dict(technologies or {})
+        self.rapid_fire = dict(rapid_fire or {})
+        if any(not (0 <= count <= 2 ** 32 - 1) for count in self.rapid_fire.values()):
+            raise ValueError('rapid_fire elements must be between 0 and 2**32-1')
+
+    def _key(self) -> tuple:
+        return (tuple(sorted(self.unit_groups.items())), tuple(sorted(self.technologies.items())),
+                tuple(sorted(self.rapid_fire.items())))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Variation) and self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def __repr__(self) -> str:
+        return 'Variation(unit_groups={!r}, technologies={!r}, rapid_fire={!r})'.format(
+            self.unit_groups, self.technologies, self.rapid_fire)
+
+
+class PreparedBattle:
+    attackers: List[Combatant]
+    defenders: List[Combatant]
+
+    def __init__(self, engine: 'BattleEngine', attackers: List[Combatant], defenders: List[Combatant]):
+        self.attackers = list(attackers)
+        self.defenders = list(defenders)
+        self._engine = engine
+        # The units attributes and the battle request, sent once by every BattleEngine.simulate_sweep() call.
+        self._stdin = '{}\nbattle {}\n'.format(engine._make_stdin_for_units_attributes(),
+                                                engine._make_stdin_for_combatants(attackers, defenders))
+
+    def _combatant_index(self, side: str, combatant: int) -> int:
+        if side not in ('attackers', 'defenders'):
+            raise ValueError('side must be attackers or defenders')
+        combatants = self.attackers if side == 'attackers' else self.defenders
+        if not (0 <= combatant < len(combatants)):
+            raise ValueError('no combatant {} in {}'.format(combatant, side))
+        return combatant if side == 'attackers' else len(self.attackers) + combatant
+
+    def combatants(self, variation: Variation) -> Tuple[List[Combatant], List[Combatant]]:
+        units_attributes = self._engine.units_attributes
+        for kind, target_kind in variation.rapid_fire:
+            if kind not in units_attributes or target_kind not in units_attributes:
+                raise ValueError('no UnitKind({}) or UnitKind({}) found in units_attributes'.format(kind, target_kind))
+
+        combatants = self.attackers + self.defenders
+        changes = {}
+        for (side, combatant, kind), count in variation.unit_groups.items():
+            if kind not in units_attributes:
+                raise ValueError('no UnitKind({}) found in units_attributes'.format(kind))
+            changes.setdefault(self._combatant_index(side, combatant), (None, {}))[1][kind] = count
+        for (side, combatant), technologies in variation.technologies.items():
+            index = self._combatant_index(side, combatant)
+            changes[index] = (technologies, changes.get(index, (None, {}))[1])
+
+        for index, (technologies, unit_groups) in changes.items():
+            base = combatants[index]
+            if technologies is None:
+                technologies = (base.weapons_technology, base.shielding_technology, base.armor_technology)
+            combatants[index] = Combatant(*technologies, {**base.unit_groups, **unit_groups})
+
+        return combatants[:len(self.attackers)], combatants[len(self.attackers):]
+
+    def _make_requests(self, variation: Variation) -> List[str]:
+        requests = []
+        for (side, combatant, kind), count in sorted(variation.unit_groups.items()):
+            requests.append('set-unit {} {} {}\n'.format(self._combatant_index(side, combatant), kind, count))
+        for (side, combatant), technologies in sorted(variation.technologies.items()):
+            requests.append('set-tech {} {} {} {}\n'.format(self._combatant_index(side, combatant), *technologies))
+        for (kind, target_kind), count in sorted(variation.rapid_fire.items()):
+            requests.append('set-rapid-fire {} {} {}\n'.format(kind, target_kind, count))
+        return requests
+
+
+def _normal_quantile(p: float) -> float:
+    low, high = -40.0, 40.0
+    for _ in range(100):
+        middle = (low + high) / 2
+        if 0.5 * (1.0 + math.erf(middle / math.sqrt(2.0))) < p:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def _wilson_interval(successes: int, n: int, z: float) -> Estimate:
+    if n == 0:
+        return Estimate(0.0, 0.0, 1.0)
+    p = successes / n
+    denominator = 1.0 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1.0 - p) / n + z * z / (4 * n * n)) / denominator
+    return Estimate(p, max(center - half_width, 0.0), min(center + half_width, 1.0))
+
+
+def _mean_interval(summary: UnitGroupSummary, z: float) -> Estimate:
+    if summary.num_simulations < 2:
+        return Estimate(summary.mean, -math.inf, math.inf)
+    half_width = z * summary.stdev / math.sqrt(summary.num_simulations)
+    return Estimate(summary.mean, summary.mean - half_width, summary.mean + half_width)
+
+
+class SimulationCache:
+    max_entries: int
+    max_bytes: Optional[int]
+    ttl: Optional[float]
+    directory: Optional[str]
+    hits: int
+    misses: int
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = None, ttl: float = None, directory: str = None):
+        if max_entries <= 0:
+            raise ValueError('max_entries must be greater than 0')
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError('max_bytes must be greater than 0')
+        if ttl is not None and ttl <= 0.0:
+            raise ValueError('ttl must be greater than 0')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.bin')
+
+    def _load(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            if self.ttl is not None and os.path.getmtime(path) + self.ttl < time.time():
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key: str, value: bytes):
+        # Written under a temporary name, so that concurrent readers never see a partial file.
+        path = self._path(key)
+        temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as f:
+            f.write(value)
+        os.replace(temp_path, path)
+
+    def _insert(self, key: str, value: bytes):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old[1])
+        self._entries[key] = (expires, value)
+        self._size += len(value)
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self._size > self.max_bytes):
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or time.monotonic() < expires:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self._size -= len(value)
+
+            value = self._load(key) if self.directory is not None else None
+            if value is None:
+                self.misses += 1
+                return None
+
+            self._insert(key, value)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes):
+        with self._lock:
+            self._insert(key, value)
+            if self.directory is not None:
+                self._store(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+
+class BattleOutcomeStore:
+    path: str
+    writable: bool
+
+    def __init__(self, path: str, mode: str = 'r'):
+        if mode not in ('r', 'a'):
+            raise ValueError("mode must be 'r' or 'a'")
+        self.path = path
+        self.writable = mode == 'a'
+        self._pending = bytearray()
+        self._mapping = None
+        if not self.writable:
+            # Unbuffered, refresh() must read the header that a writer committed, not a buffered copy.
+            self._file = open(path, 'rb', buffering=0)
+        else:
+            try:
+                self._file = open(path, 'r+b')
+            except FileNotFoundError:
+                self._file = open(path, 'w+b')
+                self._file.write(_STORE_HEADER.pack(_STORE_MAGIC, _STORE_VERSION, _STORE_RECORD_SIZE, 0, 0).ljust(
+                    _STORE_HEADER_SIZE, b'\0'))
+        try:
+            self._read_header()
+        except Error:
+            self._file.close()
+            raise
+        if self.writable:
+            # Records after the committed ones were cut short by an interruption.
+            self._file.truncate(_STORE_HEADER_SIZE + self._num_records * _STORE_RECORD_SIZE)
+
+    def __enter__(self) -> 'BattleOutcomeStore':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._num_records + len(self._pending) // _STORE_RECORD_SIZE
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int, UnitKind, UnitGroupStats]]:
+        return (self.record(i) for i in range(len(self)))
+
+    @property
+    def num_simulations(self) -> int:
+        # Simulations without any round have no records, but they are counted.
+        return self._num_simulations
+
+    def _read_header(self):
+        self._file.seek(0)
+        header = self._file.read(_STORE_HEADER_SIZE)
+        if len(header) != _STORE_HEADER_SIZE:
+            raise Error('{} is not an outcome store'.format(self.path))
+        magic, version, record_size, num_records, num_simulations = _STORE_HEADER.unpack_from(header)
+        if magic != _STORE_MAGIC or version != _STORE_VERSION or record_size != _STORE_RECORD_SIZE:
+            raise Error('{} is not an outcome store'.format(self.path))
+        self._num_records = num_records
+        self._num_simulations = num_simulations
+        self._committed_num_simulations = num_simulations
+
+    def refresh(self):
+        # Readers see the records committed by a writer since they opened the store.
+        if not self.writable:
+            self._read_header()
+
+    def _start_simulation(self, simulation: int):
+        if not self.writable:
+            raise ValueError('the store is opened for reading')
+        if simulation < self._num_simulations:
+            raise ValueError('simulations must be appended in increasing order')
+        self._num_simulations = simulation + 1
+
+    def append(self, simulation: int, outcome: BattleOutcome, combatants: List[Combatant]):
+        # Only the stats of kinds that combatants have, for the rounds fought. Combatants are attackers followed by
+        # defenders.
+        self._start_simulation(simulation)
+        combatants_outcomes = outcome.attackers_outcomes + outcome.defenders_outcomes
+        for i, (combatant, combatant_outcome) in enumerate(zip(combatants, combatants_outcomes)):
+            kinds = sorted(kind for kind, count in combatant.unit_groups.items() if count != 0)
+            for round_no in range(outcome.num_rounds):
+                round_stats = combatant_outcome.round_stats(round_no)
+                for kind in kinds:
+                    stats = round_stats[kind]
+                    self._pending += _STORE_KEY.pack(simulation, i, round_no, kind)
+                    self._pending += _BINARY_GROUP_STATS.pack(*(getattr(stats, field)
+                                                                 for field in UNIT_GROUP_STATS_FIELDS))
+        if len(self._pending) >= _STORE_FLUSH_SIZE:
+            self.flush()
+
+    def _append_binary(self, simulation: int, num_rounds: int, data: memoryview, layouts: List[List[UnitKind]],
+                       num_kinds: int):
+        # The stats of a simulation in the binary output are copied without being parsed.
+        self._start_simulation(simulation)
+        combatant_size = num_rounds * num_kinds * _BINARY_GROUP_STATS.size
+        for i, kinds in enumerate(layouts):
+            for round_no in range(num_rounds):
+                for kind in kinds:
+                    offset = i * combatant_size + (round_no * num_kinds + kind) * _BINARY_GROUP_STATS.size
+                    self._pending += _STORE_KEY.pack(simulation, i, round_no, kind)
+                    self._pending += data[offset:offset + _BINARY_GROUP_STATS.size]
+        if len(self._pending) >= _STORE_FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.writable:
+            return
+        if not self._pending and self._num_simulations == self._committed_num_simulations:
+            return
+        if self._pending:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(self._pending)
+            self._num_records += len(self._pending) // _STORE_RECORD_SIZE
+            self._pending.clear()
+            self._file.flush()
+        # The header is the commit point, readers see only the records that it counts.
+        self._file.seek(0)
+        self._file.write(_STORE_HEADER.pack(_STORE_MAGIC, _STORE_VERSION, _STORE_RECORD_SIZE, self._num_records,
+                                            self._num_simulations))
+        self._file.flush()
+        self._committed_num_simulations = self._num_simulations
+
+    def _map(self) -> mmap.mmap:
+        self.flush()
+        size = _STORE_HEADER_SIZE + self._num_records * _STORE_RECORD_SIZE
+        if self._mapping is None or len(self._mapping) != size:
+            if self._mapping is not None:
+                self._mapping.close()
+            self._mapping = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+        return self._mapping
+
+    def record(self, index: int) -> Tuple[int, int, int, UnitKind, UnitGroupStats]:
+        # (simulation, combatant, round, kind, stats)
+        mapping = self._map()
+        if not 0 <= index < self._num_records:
+            raise IndexError('record index out of range')
+        return self._unpack_record(mapping, index)
+
+    @staticmethod
+    def _unpack_record(mapping: mmap.mmap, index: int) -> Tuple[int, int, int, UnitKind, UnitGroupStats]:
+        offset = _STORE_HEADER_SIZE + index * _STORE_RECORD_SIZE
+        simulation, combatant, round_no, kind = _STORE_KEY.unpack_from(mapping, offset)
+        stats = UnitGroupStats(*_BINARY_GROUP_STATS.unpack_from(mapping, offset + _STORE_KEY.size))
+        return simulation, combatant, round_no, UnitKind(kind), stats
+
+    def _first_record(self, mapping: mmap.mmap, simulation: int) -> int:
+        # Records are in the order of simulations.
+        low, high = 0, self._num_records
+        while low < high:
+            middle = (low + high) // 2
+            middle_simulation, = _STORE_SIMULATION.unpack_from(mapping,
+                                                               _STORE_HEADER_SIZE + middle * _STORE_RECORD_SIZE)
+            if middle_simulation < simulation:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def simulation_records(self, simulation: int) -> List[Tuple[int, int, int, UnitKind, UnitGroupStats]]:
+        mapping = self._map()
+        return [self._unpack_record(mapping, i) for i in range(self._first_record(mapping, simulation),
+                                                               self._first_record(mapping, simulation + 1))]
+
+    def array(self) -> 'numpy.ndarray':
+        # A read-only structured array mapped on the file, for column scans like store.array()['hull_damage_taken'].
+        if numpy is None:
+            raise Error('array requires numpy')
+        self.flush()
+        dtype = numpy.dtype([('simulation', '<u8'), ('combatant', '<u4'), ('round', '<u2'), ('kind', '<u2')] +
+                            [(field, '<u8') for field in UNIT_GROUP_STATS_FIELDS])
+        if self._num_records == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(self.path, dtype=dtype, mode='r', offset=_STORE_HEADER_SIZE, shape=(self._num_records,))
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+        self._file.close()
+
+
+class RoundProfile:
+    num_fights: int
+    time: float
+    num_chains: int
+    num_shots: int
+    max_chain: int
+
+    def __init__(self, num_fights: int, time: float, num_chains: int, num_shots: int, max_chain: int):
+        self.num_fights = num_fights
+        self.time = time
+        self.num_chains = num_chains
+        self.num_shots = num_shots
+        self.max_chain = max_chain
+
+    @property
+    def mean_chain(self) -> float:
+        return self.num_shots / self.num_chains if self.num_chains != 0 else 0.0
+
+
+class EngineProfile:
+    num_simulations: int
+    num_threads: int
+    time: float
+    rounds: List[RoundProfile]
+
+    def __init__(self, num_simulations: int, num_threads: int, time: float, rounds: List[RoundProfile]):
+        self.num_simulations = num_simulations
+        self.num_threads = num_threads
+        self.time = time
+        self.rounds = rounds
+
+
+def _parse_profile(stderr: bytes) -> Optional[EngineProfile]:
+    profile = None
+    for line in stderr.decode('ascii').splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == 'profile':
+            profile = EngineProfile(int(fields[1]), int(fields[2]), int(fields[3]) / 1e9, [])
+        elif fields[0] == 'profile-round' and profile is not None:
+            num_fights, time_ns, num_chains, num_shots, max_chain = map(int, fields[2:])
+            profile.rounds.append(RoundProfile(num_fights, time_ns / 1e9, num_chains, num_shots, max_chain))
+    return profile
+
+
+class SimulationTiming:
+    method: str
+    num_simulations: int
+    num_units: int
+    cached: bool
+    bytes_in: int
+    bytes_out: int
+    serialize: float
+    spawn: float
+    engine: float
+    parse: float
+    total: float
+    profile: Optional[EngineProfile]
+
+    def __init__(self, method: str, num_simulations: int, num_units: int):
+        self.method = method
+        self.num_simulations = num_simulations
+        self.num_units = num_units
+        self.cached = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.serialize = 0.0
+        self.spawn = 0.0
+        self.engine = 0.0
+        self.parse = 0.0
+        self.total = 0.0
+        self.profile = None
+        self._start = time.perf_counter()
+
+
 class Error(Exception):
     pass
 
 
+def _load_library(path: str) -> ctypes.CDLL:
+    # Functions of a CDLL release the GIL during calls, so several threads can simulate at the same time.
+    library = ctypes.CDLL(path)
+    simulate = library.battle_engine_simulate
+    simulate.argtypes = (ctypes.c_uint32, ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_uint32),
+                         ctypes.c_uint32, ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint8),
+                         ctypes.POINTER(ctypes.c_uint64), ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32,
+                         ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint64),
+                         ctypes.POINTER(ctypes.c_uint64), ctypes.c_char_p, ctypes.c_size_t)
+    simulate.restype = ctypes.c_int
+    return library
+
+
 class BattleEngine:
     engine_path: str
     units_attributes: Dict[UnitKind, UnitAttributes]
+    async_concurrency: int
+    backend: str
+    cache: Optional[SimulationCache]
+    on_timing: Optional[Callable[[SimulationTiming], None]]
+    profile: bool
+    rng: str
+    battle_threads: int
+    library_path: Optional[str]
 
-    def __init__(self, engine_path: str, units_attributes: Dict[UnitKind, UnitAttributes]):
+    def __init__(self, engine_path: str, units_attributes: Dict[UnitKind, UnitAttributes],
+                 async_concurrency: int = None, backend: str = 'process', cache: SimulationCache = None,
+                 on_timing: Callable[[SimulationTiming], None] = None, profile: bool = False, rng: str = 'lehmer',
+                 battle_threads: int = 0, library_path: str = None):
+        if async_concurrency is None:
+            async_concurrency = os.cpu_count() or 1
+        if async_concurrency <= 0:
+            raise ValueError('async_concurrency must be greater than 0')
+        if backend not in BACKENDS:
+            raise ValueError('backend must be one of {}'.format(', '.join(BACKENDS)))
+        if backend == 'numpy' and numpy is None:
+            raise Error('the numpy backend requires numpy')
+        if rng not in RNGS:
+            raise ValueError('rng must be one of {}'.format(', '.join(RNGS)))
+        if backend == 'numpy' and rng != 'lehmer':
+            raise ValueError('the numpy backend supports only the lehmer rng')
+        if not 0 <= battle_threads <= MAX_BATTLE_THREADS:
+            raise ValueError('battle_threads must be between 0 and {}'.format(MAX_BATTLE_THREADS))
+        if backend == 'numpy' and battle_threads != 0:
+            raise ValueError('the numpy backend does not support battle threads')
+        if backend == 'numpy' and library_path is not None:
+            raise ValueError('the numpy backend does not use the library')
         self.engine_path = engine_path
         self.units_attributes = units_attributes
+        self.async_concurrency = async_concurrency
+        self.backend = backend
+        self.cache = cache
+        self.on_timing = on_timing
+        self.profile = profile
+        self.rng = rng
+        self.battle_threads = battle_threads
+        self.library_path = library_path
+        self._async_semaphores = weakref.WeakKeyDictionary()
         self._assert_valid_units_attributes()
+        self._library = None
+        if library_path is not None:
+            try:
+                self._library = _load_library(library_path)
+            except (OSError, AttributeError) as e:
+                raise Error('loading the library failed: {}'.format(e))
 
     def _assert_valid_units_attributes(self):
         num_kinds = len(self.units_attributes)
@@ -150,7 +1083,7 @@ class BattleEngine:
         return '\n'.join(stdin)
 
     def _assert_valid_combatants(self, name: str, combatants: List[Combatant]):
-        if len(combatants) >= 256:
+        if len(combatants) > 256:
             raise ValueError('too many {}'.format(name))
 
         for i, combatant in enumerate(combatants):
@@ -176,8 +1109,14 @@ class BattleEngine:
                      for combatant in defenders)
         return '\n'.join(stdin)
 
-    def parse_combatant_outcome(self, num_rounds: int, data: List[int]) -> CombatantOutcome:
+    def parse_combatant_outcome(self, num_rounds: int, data: List[int], projection: OutputProjection = None,
+                                combatant: Combatant = None) -> CombatantOutcome:
         num_kinds = len(self.units_attributes)
+        if projection is not None:
+            if projection.sparse and combatant is None:
+                raise ValueError('combatant is required to parse a sparse outcome')
+            return projection._make_outcome(num_rounds, projection._kinds(combatant, num_kinds), data)
+
         index = 0
         rounds_stats = []
         for round_no in range(num_rounds):
@@ -189,8 +1128,7 @@ class BattleEngine:
             rounds_stats.append(round_stats)
         return CombatantOutcome(rounds_stats)
 
-    def simulate(self, attackers: List[Combatant], defenders: List[Combatant], seed: int = 0,
-                 num_simulations: int = 1, timeout=None) -> List[BattleOutcome]:
+    def _prepare_simulation(self, attackers: List[Combatant], defenders: List[Combatant], seed: int) -> int:
         self._assert_valid_combatants('attackers', attackers)
         self._assert_valid_combatants('defenders', defenders)
 
@@ -200,48 +1138,1122 @@ class BattleEngine:
         if seed == 0:
             seed = random.randint(1, 1000000000)
 
+        return seed
+
+    def _engine_options(self) -> Tuple[str, ...]:
+        options = ('--rng', self.rng) if self.rng != 'lehmer' else ()
+        if self.battle_threads != 0:
+            options += ('--battle-threads', str(self.battle_threads))
+        return options
+
+    def _parse_binary_header(self, data: memoryview, expected_flags: int = 0) -> Tuple[int, int, int]:
+        if len(data) < _BINARY_HEADER.size:
+            raise Error('engine output is truncated')
+        if self.rng == 'xoshiro':
+            expected_flags |= _BINARY_FLAG_XOSHIRO
+        if self.battle_threads != 0:
+            expected_flags |= _BINARY_FLAG_PARALLEL
+        magic, version, flags, num_kinds, num_combatants = _BINARY_HEADER.unpack_from(data)
+        if magic != _BINARY_MAGIC or version != _BINARY_VERSION or flags != expected_flags:
+            raise Error('engine output has an unsupported format')
+        return num_kinds, num_combatants, _BINARY_HEADER.size
+
+    @staticmethod
+    def _parse_binary_combatant_outcome(num_rounds: int, num_kinds: int, data: memoryview,
+                                        group_stats: struct.Struct = _BINARY_GROUP_STATS) -> CombatantOutcome:
+        stats = [UnitGroupStats(*fields) for fields in group_stats.iter_unpack(data)]
+        kinds = [UnitKind(kind) for kind in range(num_kinds)]
+        rounds_stats = [dict(zip(kinds, stats[i:i + num_kinds])) for i in range(0, num_rounds * num_kinds, num_kinds)]
+        return CombatantOutcome(rounds_stats)
+
+    def _parse_binary_simulation(self, data: memoryview, offset: int, num_kinds: int, num_attackers: int,
+                                 num_combatants: int) -> Tuple[BattleOutcome, int]:
+        num_rounds, = _BINARY_NUM_ROUNDS.unpack_from(data, offset)
+        offset += _BINARY_NUM_ROUNDS.size
+
+        outcome_size = num_rounds * num_kinds * _BINARY_GROUP_STATS.size
+        if len(data) < offset + num_combatants * outcome_size:
+            raise Error('engine output is truncated')
+
+        outcomes = []
+        for j in range(num_combatants):
+            outcome = self._parse_binary_combatant_outcome(num_rounds, num_kinds, data[offset:offset + outcome_size])
+            outcomes.append(outcome)
+            offset += outcome_size
+
+        return BattleOutcome(num_rounds, outcomes[:num_attackers], outcomes[num_attackers:]), offset
+
+    def _parse_projected_simulation(self, data: memoryview, offset: int, num_attackers: int,
+                                    projection: OutputProjection,
+                                    layouts: List[List[UnitKind]]) -> Tuple[BattleOutcome, int]:
+        num_rounds, = _BINARY_NUM_ROUNDS.unpack_from(data, offset)
+        offset += _BINARY_NUM_ROUNDS.size
+
+        num_written_rounds = projection._num_written_rounds(num_rounds)
+        outcomes = []
+        for kinds in layouts:
+            count = num_written_rounds * len(kinds) * len(projection.fields)
+            if len(data) < offset + count * 8:
+                raise Error('engine output is truncated')
+            values = struct.unpack_from('<{}Q'.format(count), data, offset)
+            outcomes.append(projection._make_outcome(num_rounds, kinds, values))
+            offset += count * 8
+
+        return BattleOutcome(num_rounds, outcomes[:num_attackers], outcomes[num_attackers:]), offset
+
+    def _parse_output(self, out: bytes, num_attackers: int, num_defenders: int, num_simulations: int,
+                      projection: OutputProjection = None, combatants: List[Combatant] = None,
+                      approximate: bool = False) -> List[BattleOutcome]:
+        if num_attackers == 0 or num_defenders == 0:
+            return [BattleOutcome(0, [CombatantOutcome([]) for _ in range(num_attackers)],
+                                  [CombatantOutcome([]) for _ in range(num_defenders)])
+                    for _ in range(num_simulations)]
+
+        data = memoryview(out)
+        flags = projection._binary_flags if projection is not None else 0
+        if approximate:
+            flags |= _BINARY_FLAG_APPROXIMATE
+        num_kinds, num_combatants, offset = self._parse_binary_header(data, flags)
+        if num_kinds != len(self.units_attributes) or num_combatants != num_attackers + num_defenders:
+            raise Error('engine output does not match the request')
+
+        simulations = []
+        if projection is not None:
+            layouts = [projection._kinds(combatant, num_kinds) for combatant in combatants]
+            for i in range(num_simulations):
+                simulation, offset = self._parse_projected_simulation(data, offset, num_attackers, projection, layouts)
+                simulations.append(simulation)
+        else:
+            for i in range(num_simulations):
+                simulation, offset = self._parse_binary_simulation(data, offset, num_kinds, num_attackers,
+                                                                   num_combatants)
+                simulations.append(simulation)
+
+        return simulations
+
+    def _parse_batch_output(self, out: bytes, num_attackers: int, num_defenders: int,
+                            num_simulations: int) -> SimulationBatch:
+        num_kinds = len(self.units_attributes)
+        num_combatants = num_attackers + num_defenders
+        stats = numpy.zeros((num_simulations, num_combatants, MAX_ROUNDS, num_kinds, 7), dtype=numpy.uint64)
+        num_rounds = numpy.zeros(num_simulations, dtype=numpy.uint64)
+
+        if num_attackers == 0 or num_defenders == 0:
+            return SimulationBatch(stats, num_rounds, num_attackers, num_defenders)
+
+        data = memoryview(out)
+        num_kinds, num_combatants, offset = self._parse_binary_header(data)
+        if num_kinds != len(self.units_attributes) or num_combatants != num_attackers + num_defenders:
+            raise Error('engine output does not match the request')
+
+        for i in range(num_simulations):
+            rounds, = _BINARY_NUM_ROUNDS.unpack_from(data, offset)
+            offset += _BINARY_NUM_ROUNDS.size
+            count = num_combatants * rounds * num_kinds * 7
+            if len(data) < offset + count * 8:
+                raise Error('engine output is truncated')
+            simulation_stats = numpy.frombuffer(data, dtype='<u8', count=count, offset=offset)
+            stats[i, :, :rounds] = simulation_stats.reshape(num_combatants, rounds, num_kinds, 7)
+            num_rounds[i] = rounds
+            offset += count * 8
+
+        return SimulationBatch(stats, num_rounds, num_attackers, num_defenders)
+
+    def _parse_summary_output(self, out: bytes, attackers: List[Combatant],
+                              defenders: List[Combatant], num_simulations: int) -> SimulationSummary:
+        num_kinds = len(self.units_attributes)
+        combatants = attackers + defenders
+
+        if not attackers or not defenders:
+            summaries = []
+            for combatant in combatants:
+                summary = {}
+                for kind in range(num_kinds):
+                    num_units = combatant.unit_groups.get(kind, 0)
+                    histogram = [0] * SUMMARY_BUCKETS
+                    histogram[min(int(num_units / (num_units + 1) * SUMMARY_BUCKETS), SUMMARY_BUCKETS - 1)] = \
+                        num_simulations
+                    summary[UnitKind(kind)] = UnitGroupSummary(num_simulations, num_units, float(num_units), 0.0,
+                                                               num_units, num_units, histogram)
+                summaries.append(summary)
+            rounds = [num_simulations] + [0] * MAX_ROUNDS
+            return SimulationSummary(num_simulations, 0, 0, num_simulations, rounds, summaries[:len(attackers)],
+                                     summaries[len(attackers):])
+
+        data = memoryview(out)
+        num_kinds, num_combatants, offset = self._parse_binary_header(data, _BINARY_FLAG_SUMMARY)
+        if num_kinds != len(self.units_attributes) or num_combatants != len(combatants):
+            raise Error('engine output does not match the request')
+
+        group_summary = struct.Struct('<2d{}Q'.format(2 + SUMMARY_BUCKETS))
+        if len(data) != offset + _BINARY_SUMMARY_TOTALS.size + num_combatants * num_kinds * group_summary.size:
+            raise Error('engine output is truncated')
+
+        totals = _BINARY_SUMMARY_TOTALS.unpack_from(data, offset)
+        offset += _BINARY_SUMMARY_TOTALS.size
+        num_simulations, attackers_wins, defenders_wins, draws = totals[:4]
+        rounds = list(totals[4:])
+
+        groups = group_summary.iter_unpack(data[offset:])
+        summaries = []
+        for combatant in combatants:
+            summary = {}
+            for kind in range(num_kinds):
+                mean, m2, min_units, max_units, *histogram = next(groups)
+                summary[UnitKind(kind)] = UnitGroupSummary(num_simulations, combatant.unit_groups.get(kind, 0), mean,
+                                                           m2, min_units, max_units, histogram)
+            summaries.append(summary)
+
+        return SimulationSummary(num_simulations, attackers_wins, defenders_wins, draws, rounds,
+                                 summaries[:len(attackers)], summaries[len(attackers):])
+
+    def _assert_process_backend(self, name: str):
+        if self.backend != 'process':
+            raise Error('{} requires the process backend'.format(name))
+
+    def _make_engine_invocation(self, attackers: List[Combatant], defenders: List[Combatant], seed: int,
+                                num_simulations: int, workers: int,
+                                options: Tuple[str, ...] = ()) -> Tuple[List[str], bytes]:
+        if workers <= 0:
+            raise ValueError('workers must be greater than 0')
+        self._assert_process_backend('running the engine executable')
+
         attrs_stdin = self._make_stdin_for_units_attributes()
         combatants_stdin = self._make_stdin_for_combatants(attackers, defenders)
         stdin = attrs_stdin + '\n' + combatants_stdin
 
-        args = [self.engine_path, str(seed), str(num_simulations)]
+        if self.profile:
+            options = (*options, '--profile')
+
+        args = [self.engine_path, '--binary', '--threads', str(workers), *self._engine_options(), *options, str(seed),
+                str(num_simulations)]
+        return args, stdin.encode()
+
+    def _cache_key(self, attackers: List[Combatant], defenders: List[Combatant], seed: int, num_simulations: int,
+                   options: Tuple[str, ...]) -> Optional[str]:
+        # Random seeds (seed == 0) are never cached. Results do not depend on the number of workers.
+        if self.cache is None or seed == 0:
+            return None
+
+        def canonical_combatant(combatant):
+            return (combatant.weapons_technology, combatant.shielding_technology, combatant.armor_technology,
+                    sorted((int(kind), count) for kind, count in combatant.unit_groups.items() if count != 0))
+
+        units_attributes = [(int(kind), attrs.weapons, attrs.shield, attrs.armor,
+                             sorted((int(target), count) for target, count in attrs.rapid_fire.items() if count != 0))
+                            for kind, attrs in sorted(self.units_attributes.items())]
+        key = (units_attributes, [canonical_combatant(combatant) for combatant in attackers],
+               [canonical_combatant(combatant) for combatant in defenders], seed, num_simulations,
+               self._engine_options() + options)
+        return hashlib.sha256(repr(key).encode()).hexdigest()
+
+    def _run_engine(self, attackers: List[Combatant], defenders: List[Combatant], seed: int, num_simulations: int,
+                    timeout, workers: int, options: Tuple[str, ...] = (), cache_key: str = None,
+                    timing: SimulationTiming = None) -> bytes:
+        if timing is None:
+            timing = SimulationTiming('', num_simulations, 0)
+
+        if cache_key is not None:
+            out = self.cache.get(cache_key)
+            if out is not None:
+                timing.cached = True
+                timing.bytes_out = len(out)
+                return out
+
+        start = time.perf_counter()
+        args, stdin = self._make_engine_invocation(attackers, defenders, seed, num_simulations, workers, options)
+        timing.serialize = time.perf_counter() - start
+        timing.bytes_in = len(stdin)
+
+        start = time.perf_counter()
         p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        timing.spawn = time.perf_counter() - start
 
+        start = time.perf_counter()
         try:
-            outs = p.communicate(input=stdin.encode(), timeout=timeout)
+            outs = p.communicate(input=stdin, timeout=timeout)
         except subprocess.TimeoutExpired:
             p.kill()
             raise
+        timing.engine = time.perf_counter() - start
 
         if p.returncode != 0:
             stderr = outs[1].decode('ascii')
             raise Error(stderr)
 
+        timing.bytes_out = len(outs[0])
+        if self.profile:
+            timing.profile = _parse_profile(outs[1])
+
+        if cache_key is not None:
+            self.cache.put(cache_key, outs[0])
+
+        return outs[0]
+
+    @staticmethod
+    def _start_timing(method: str, attackers: List[Combatant], defenders: List[Combatant],
+                      num_simulations: int) -> SimulationTiming:
+        num_units = sum(sum(combatant.unit_groups.values()) for combatant in attackers + defenders)
+        return SimulationTiming(method, num_simulations, num_units)
+
+    def _finish_timing(self, timing: SimulationTiming):
+        timing.total = time.perf_counter() - timing._start
+        if self.on_timing is not None:
+            self.on_timing(timing)
+
+    def _simulate_in_process(self, attackers: List[Combatant], defenders: List[Combatant], seed: int,
+                             num_simulations: int, timeout, workers: int,
+                             timing: SimulationTiming = None) -> SimulationBatch:
+        import BattleEngineNumpy
+
+        if workers <= 0:
+            raise ValueError('workers must be greater than 0')
+        if num_simulations < 0:
+            raise ValueError('num_simulations must be at least 0')
+
+        start = time.perf_counter()
+        stats, num_rounds = BattleEngineNumpy.simulate(self.units_attributes, attackers, defenders, seed,
+                                                       num_simulations, timeout)
+        if timing is not None:
+            timing.engine = time.perf_counter() - start
+        return SimulationBatch(stats, num_rounds, len(attackers), len(defenders))
+
+    def _use_library(self, options: Tuple[str, ...], timeout) -> bool:
+        # The executable stays the fallback for what the library does not do: options, timeouts (a call cannot be
+        # interrupted), the cache and profiles.
+        return (self._library is not None and not options and timeout is None and self.cache is None and
+                not self.profile)
+
+    def _run_library(self, attackers: List[Combatant], defenders: List[Combatant], seed: int, num_simulations: int,
+                     workers: int, stats, num_rounds):
+        # Fills the preallocated buffers: num_rounds with num_simulations uint64 and stats with num_simulations *
+        # num_combatants * MAX_ROUNDS * num_kinds * 7 uint64, as in SimulationBatch.
+        if workers <= 0:
+            raise ValueError('workers must be greater than 0')
+        if num_simulations < 0:
+            raise ValueError('num_simulations must be at least 0')
+
         num_kinds = len(self.units_attributes)
-        num_attackers = len(attackers)
-        num_defenders = len(defenders)
+        combatants = attackers + defenders
+        attributes = (ctypes.c_float * (3 * num_kinds))()
+        rapid_fire = (ctypes.c_uint32 * (num_kinds * num_kinds))()
+        for kind in range(num_kinds):
+            attrs = self.units_attributes[kind]
+            attributes[3 * kind:3 * kind + 3] = [attrs.weapons, attrs.shield, attrs.armor]
+            for target_kind, count in attrs.rapid_fire.items():
+                rapid_fire[kind * num_kinds + target_kind] = count
 
-        out = outs[0].decode('ascii')
-        result = list(map(int, out.split()))
+        technologies = (ctypes.c_uint8 * (3 * len(combatants)))()
+        unit_groups = (ctypes.c_uint64 * (num_kinds * len(combatants)))()
+        for i, combatant in enumerate(combatants):
+            technologies[3 * i:3 * i + 3] = [combatant.weapons_technology, combatant.shielding_technology,
+                                             combatant.armor_technology]
+            for kind, count in combatant.unit_groups.items():
+                unit_groups[i * num_kinds + kind] = count
 
-        simulations = []
+        stats_size = num_simulations * len(combatants) * MAX_ROUNDS * num_kinds * 7
+        error = ctypes.create_string_buffer(_LIBRARY_ERROR_SIZE)
+        ret = self._library.battle_engine_simulate(
+            num_kinds, attributes, rapid_fire, len(attackers), len(defenders), technologies, unit_groups, seed, 0,
+            num_simulations, workers, RNGS.index(self.rng), self.battle_threads,
+            (ctypes.c_uint64 * num_simulations).from_buffer(num_rounds),
+            (ctypes.c_uint64 * stats_size).from_buffer(stats), error, len(error))
+        if ret != 0:
+            raise Error(error.value.decode('ascii'))
 
-        idx = 0
-        for i in range(num_simulations):
-            num_rounds = result[idx]
-            idx += 1
+    def _simulate_with_library(self, attackers: List[Combatant], defenders: List[Combatant], seed: int,
+                               num_simulations: int, workers: int, timing: SimulationTiming) -> List[BattleOutcome]:
+        num_kinds = len(self.units_attributes)
+        num_combatants = len(attackers) + len(defenders)
+        stats = array.array('Q', [0]) * (num_simulations * num_combatants * MAX_ROUNDS * num_kinds * 7)
+        num_rounds = array.array('Q', [0]) * num_simulations
 
-            outcome_size = num_rounds * num_kinds * 7
-            outcomes = []
-            for j in range(num_attackers + num_defenders):
-                d = result[idx:idx + outcome_size]
-                idx += outcome_size
-                outcome = self.parse_combatant_outcome(num_rounds, d)
-                outcomes.append(outcome)
+        start = time.perf_counter()
+        self._run_library(attackers, defenders, seed, num_simulations, workers, stats, num_rounds)
+        timing.engine = time.perf_counter() - start
 
-            attackers_outcomes, defenders_outcomes = outcomes[:num_attackers], outcomes[num_attackers:]
+        start = time.perf_counter()
+        data = memoryview(stats).cast('B')
+        combatant_size = MAX_ROUNDS * num_kinds * _NATIVE_GROUP_STATS.size
+        outcomes = []
+        for i, rounds in enumerate(num_rounds):
+            combatants_outcomes = []
+            for j in range(num_combatants):
+                offset = (i * num_combatants + j) * combatant_size
+                combatants_outcomes.append(self._parse_binary_combatant_outcome(
+                    rounds, num_kinds, data[offset:offset + rounds * num_kinds * _NATIVE_GROUP_STATS.size],
+                    _NATIVE_GROUP_STATS))
+            outcomes.append(BattleOutcome(rounds, combatants_outcomes[:len(attackers)],
+                                          combatants_outcomes[len(attackers):]))
+        timing.parse = time.perf_counter() - start
+        return outcomes
 
-            simulation = BattleOutcome(num_rounds, attackers_outcomes, defenders_outcomes)
-            simulations.append(simulation)
+    def _simulate_to_store(self, attackers: List[Combatant], defenders: List[Combatant], seed: int,
+                           num_simulations: int, workers: int, options: Tuple[str, ...], flags: int,
+                           store: BattleOutcomeStore):
+        self._assert_process_backend('simulating to a store')
+        if not store.writable:
+            raise ValueError('the store is opened for reading')
+        seed = self._prepare_simulation(attackers, defenders, seed)
+        args, stdin = self._make_engine_invocation(attackers, defenders, seed, num_simulations, workers, options)
 
-        return simulations
+        # Simulations are numbered after the ones already in the store.
+        first = store.num_simulations
+        if num_simulations <= 0:
+            return
+        if not attackers or not defenders:
+            store._start_simulation(first + num_simulations - 1)
+            return
+
+        num_kinds = len(self.units_attributes)
+        num_combatants = len(attackers) + len(defenders)
+        layouts = [sorted(kind for kind, count in combatant.unit_groups.items() if count != 0)
+                   for combatant in attackers + defenders]
+
+        def simulation_size(num_rounds: int) -> int:
+            return num_combatants * num_rounds * num_kinds * _BINARY_GROUP_STATS.size
+
+        for i, (num_rounds, data) in enumerate(self._stream_engine(args, stdin, flags, num_combatants, num_simulations,
+                                                                   simulation_size)):
+            store._append_binary(first + i, num_rounds, data[_BINARY_NUM_ROUNDS.size:], layouts, num_kinds)
+        store.flush()
+
+    def simulate(self, attackers: List[Combatant], defenders: List[Combatant], seed: int = 0,
+                 num_simulations: int = 1, timeout=None, workers: int = 1, projection: OutputProjection = None,
+                 approximate: bool = False, buckets: int = APPROXIMATE_BUCKETS,
+                 store: BattleOutcomeStore = None) -> List[BattleOutcome]:
+        if store is not None:
+            # Outcomes are appended to the store as the engine writes them instead of being returned.
+            if projection is not None:
+                raise ValueError('a store needs the stats without projection')
+            options = self._approximate_options(approximate, buckets)
+            flags = _BINARY_FLAG_APPROXIMATE if approximate else 0
+            self._simulate_to_store(attackers, defenders, seed, num_simulations, workers, options, flags, store)
+            return []
+
+        timing = self._start_timing('simulate', attackers, defenders, num_simulations)
+        options = self._projection_options(projection) + self._approximate_options(approximate, buckets)
+        cache_key = self._cache_key(attackers, defenders, seed, num_simulations, options)
+        seed = self._prepare_simulation(attackers, defenders, seed)
+        if self.backend == 'numpy':
+            outcomes = list(self._simulate_in_process(attackers, defenders, seed, num_simulations, timeout, workers,
+                                                      timing))
+        elif self._use_library(options, timeout):
+            outcomes = self._simulate_with_library(attackers, defenders, seed, num_simulations, workers, timing)
+        else:
+            out = self._run_engine(attackers, defenders, seed, num_simulations, timeout, workers, options, cache_key,
+                                   timing)
+            start = time.perf_counter()
+            outcomes = self._parse_output(out, len(attackers), len(defenders), num_simulations, projection,
+                                          attackers + defenders, approximate)
+            timing.parse = time.perf_counter() - start
+        self._finish_timing(timing)
+        return outcomes
+
+    def _approximate_options(self, approximate: bool, buckets: int) -> Tuple[str, ...]:
+        if not approximate:
+            return ()
+        self._assert_process_backend('the approximate mode')
+        if self.battle_threads != 0:
+            raise ValueError('the approximate mode cannot be used with battle threads')
+        if not 1 <= buckets <= MAX_APPROXIMATE_BUCKETS:
+            raise ValueError('buckets must be between 1 and {}'.format(MAX_APPROXIMATE_BUCKETS))
+        return '--approx', str(buckets)
+
+    def _projection_options(self, projection: Optional[OutputProjection]) -> Tuple[str, ...]:
+        if projection is None:
+            return ()
+        self._assert_process_backend('projection')
+        return projection._engine_options()
+
+    @staticmethod
+    def _read_exactly(stream, size: int) -> bytes:
+        data = stream.read(size)
+        if len(data) != size:
+            raise Error('engine output is truncated')
+        return data
+
+    def iter_simulate(self, attackers: List[Combatant], defenders: List[Combatant], seed: int = 0,
+                      num_simulations: int = 1, workers: int = 1,
+                      projection: OutputProjection = None) -> Iterator[BattleOutcome]:
+        self._assert_process_backend('iter_simulate')
+        options = self._projection_options(projection)
+        seed = self._prepare_simulation(attackers, defenders, seed)
+        args, stdin = self._make_engine_invocation(attackers, defenders, seed, num_simulations, workers, options)
+        # Not a generator itself, so that invalid arguments raise here and not on the first next().
+        return self._iter_simulate(attackers, defenders, num_simulations, projection, args, stdin)
+
+    def _iter_simulate(self, attackers: List[Combatant], defenders: List[Combatant], num_simulations: int,
+                       projection: Optional[OutputProjection], args: List[str],
+                       stdin: bytes) -> Iterator[BattleOutcome]:
+        if num_simulations == 0:
+            return
+        if not attackers or not defenders:
+            yield from self._parse_output(b'', len(attackers), len(defenders), num_simulations)
+            return
+
+        num_kinds = len(self.units_attributes)
+        num_combatants = len(attackers) + len(defenders)
+        flags = 0
+        if projection is not None:
+            flags = projection._binary_flags
+            layouts = [projection._kinds(combatant, num_kinds) for combatant in attackers + defenders]
+            round_size = sum(len(kinds) for kinds in layouts) * len(projection.fields) * 8
+
+            def simulation_size(num_rounds: int) -> int:
+                return projection._num_written_rounds(num_rounds) * round_size
+        else:
+            def simulation_size(num_rounds: int) -> int:
+                return num_combatants * num_rounds * num_kinds * _BINARY_GROUP_STATS.size
+
+        for num_rounds, data in self._stream_engine(args, stdin, flags, num_combatants, num_simulations,
+                                                    simulation_size):
+            if projection is not None:
+                outcome, _ = self._parse_projected_simulation(data, 0, len(attackers), projection, layouts)
+            else:
+                outcome, _ = self._parse_binary_simulation(data, 0, num_kinds, len(attackers), num_combatants)
+            yield outcome
+
+    def _stream_engine(self, args: List[str], stdin: bytes, flags: int, num_combatants: int, num_simulations: int,
+                       simulation_size: Callable[[int], int]) -> Iterator[Tuple[int, memoryview]]:
+        # Yields the number of rounds and the output of every simulation, including its number of rounds, as the
+        # engine writes them.
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            # The engine reads the whole input before it writes anything.
+            try:
+                p.stdin.write(stdin)
+                p.stdin.close()
+            except BrokenPipeError:
+                # The engine exited before reading its input, its error message tells why.
+                p.wait()
+                raise Error(p.stderr.read().decode('ascii')) from None
+
+            try:
+                header = self._read_exactly(p.stdout, _BINARY_HEADER.size)
+                num_kinds, header_num_combatants, _ = self._parse_binary_header(memoryview(header), flags)
+                if num_kinds != len(self.units_attributes) or header_num_combatants != num_combatants:
+                    raise Error('engine output does not match the request')
+
+                for _ in range(num_simulations):
+                    data = self._read_exactly(p.stdout, _BINARY_NUM_ROUNDS.size)
+                    num_rounds, = _BINARY_NUM_ROUNDS.unpack(data)
+                    data += self._read_exactly(p.stdout, simulation_size(num_rounds))
+                    yield num_rounds, memoryview(data)
+            except Error:
+                # Truncated output of a failed engine, its error message tells more.
+                if p.wait() != 0:
+                    raise Error(p.stderr.read().decode('ascii')) from None
+                raise
+
+            if p.wait() != 0:
+                raise Error(p.stderr.read().decode('ascii'))
+        finally:
+            # Also reached when the consumer stops early, the engine must not outlive the generator.
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+            p.stdout.close()
+            p.stderr.close()
+
+    def _async_semaphore(self) -> asyncio.Semaphore:
+        # A semaphore is bound to the event loop it is used in.
+        loop = asyncio.get_event_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.async_concurrency)
+            self._async_semaphores[loop] = semaphore
+        return semaphore
+
+    async def simulate_async(self, attackers: List[Combatant], defenders: List[Combatant], seed: int = 0,
+                             num_simulations: int = 1, timeout=None, workers: int = 1,
+                             projection: OutputProjection = None) -> List[BattleOutcome]:
+        timing = self._start_timing('simulate_async', attackers, defenders, num_simulations)
+        options = self._projection_options(projection)
+        cache_key = self._cache_key(attackers, defenders, seed, num_simulations, options)
+        seed = self._prepare_simulation(attackers, defenders, seed)
+        if self.backend == 'numpy':
+            async with self._async_semaphore():
+                batch = await asyncio.get_event_loop().run_in_executor(
+                    None, self._simulate_in_process, attackers, defenders, seed, num_simulations, timeout, workers,
+                    timing)
+            self._finish_timing(timing)
+            return list(batch)
+
+        out = self.cache.get(cache_key) if cache_key is not None else None
+        if out is not None:
+            timing.cached = True
+            timing.bytes_out = len(out)
+            outcomes = self._parse_output(out, len(attackers), len(defenders), num_simulations, projection,
+                                          attackers + defenders)
+            self._finish_timing(timing)
+            return outcomes
+
+        start = time.perf_counter()
+        args, stdin = self._make_engine_invocation(attackers, defenders, seed, num_simulations, workers, options)
+        timing.serialize = time.perf_counter() - start
+        timing.bytes_in = len(stdin)
+
+        async with self._async_semaphore():
+            start = time.perf_counter()
+            p = await asyncio.create_subprocess_exec(*args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                     stderr=subprocess.PIPE)
+            timing.spawn = time.perf_counter() - start
+            start = time.perf_counter()
+            try:
+                outs = await asyncio.wait_for(p.communicate(stdin), timeout)
+            except BaseException as e:
+                # Timed out or cancelled, the engine must not outlive the request.
+                try:
+                    p.kill()
+                except ProcessLookupError:
+                    pass
+                await p.wait()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise subprocess.TimeoutExpired(args, timeout) from None
+                raise
+            timing.engine = time.perf_counter() - start
+
+        if p.returncode != 0:
+            stderr = outs[1].decode('ascii')
+            raise Error(stderr)
+
+        timing.bytes_out = len(outs[0])
+        if self.profile:
+            timing.profile = _parse_profile(outs[1])
+
+        if cache_key is not None:
+            self.cache.put(cache_key, outs[0])
+
+        start = time.perf_counter()
+        outcomes = self._parse_output(outs[0], len(attackers), len(defenders), num_simulations, projection,
+                                      attackers + defenders)
+        timing.parse = time.perf_counter() - start
+        self._finish_timing(timing)
+        return outcomes
+
+    def simulate_batch(self, attackers: List[Combatant], defenders: List[Combatant], seed: int = 0,
+                       num_simulations: int = 1, timeout=None, workers: int = 1) -> SimulationBatch:
+        if numpy is None:
+            raise Error('simulate_batch requires numpy')
+        timing = self._start_timing('simulate_batch', attackers, defenders, num_simulations)
+        cache_key = self._cache_key(attackers, defenders, seed, num_simulations, ())
+        seed = self._prepare_simulation(attackers, defenders, seed)
+        if self.backend == 'numpy':
+            batch = self._simulate_in_process(attackers, defenders, seed, num_simulations, timeout, workers, timing)
+        elif self._use_library((), timeout):
+            num_combatants = len(attackers) + len(defenders)
+            stats = numpy.empty((num_simulations, num_combatants, MAX_ROUNDS, len(self.units_attributes), 7),
+                                dtype=numpy.uint64)
+            num_rounds = numpy.empty(num_simulations, dtype=numpy.uint64)
+            start = time.perf_counter()
+            self._run_library(attackers, defenders, seed, num_simulations, workers, stats, num_rounds)
+            timing.engine = time.perf_counter() - start
+            batch = SimulationBatch(stats, num_rounds, len(attackers), len(defenders))
+        else:
+            out = self._run_engine(attackers, defenders, seed, num_simulations, timeout, workers, cache_key=cache_key,
+                                   timing=timing)
+            start = time.perf_counter()
+            batch = self._parse_batch_output(out, len(attackers), len(defenders), num_simulations)
+            timing.parse = time.perf_counter() - start
+        self._finish_timing(timing)
+        return batch
+
+    def simulate_summary(self, attackers: List[Combatant], defenders: List[Combatant], seed: int = 0,
+                         num_simulations: int = 1, timeout=None, workers: int = 1,
+                         first_simulation: int = 0) -> SimulationSummary:
+        self._assert_process_backend('simulate_summary')
+        if not (0 <= first_simulation and first_simulation + num_simulations <= 2 ** 32 - 1):
+            raise ValueError('simulations must be between 0 and 2**32-1')
+        timing = self._start_timing('simulate_summary', attackers, defenders, num_simulations)
+        options = ('--summary', '--offset', str(first_simulation))
+        cache_key = self._cache_key(attackers, defenders, seed, num_simulations, options)
+        seed = self._prepare_simulation(attackers, defenders, seed)
+        out = self._run_engine(attackers, defenders, seed, num_simulations, timeout, workers, options, cache_key,
+                               timing)
+        start = time.perf_counter()
+        summary = self._parse_summary_output(out, attackers, defenders, num_simulations)
+        timing.parse = time.perf_counter() - start
+        self._finish_timing(timing)
+        return summary
+
+    def simulate_until(self, attackers: List[Combatant], defenders: List[Combatant], seed: int = 0,
+                       win_probability_width: float = None, remaining_units_width: float = None,
+                       confidence: float = 0.95, batch_size: int = 100, max_simulations: int = 100000,
+                       time_budget: float = None, workers: int = 1) -> AdaptiveSimulationResult:
+        if win_probability_width is None and remaining_units_width is None:
+            raise ValueError('win_probability_width or remaining_units_width must be given')
+        if not (0.0 < confidence < 1.0):
+            raise ValueError('confidence must be between 0 and 1')
+        if batch_size <= 0:
+            raise ValueError('batch_size must be greater than 0')
+        if max_simulations < batch_size:
+            raise ValueError('max_simulations must be at least batch_size')
+
+        seed = self._prepare_simulation(attackers, defenders, seed)
+        z = _normal_quantile((1.0 + confidence) / 2.0)
+        deadline = time.monotonic() + time_budget if time_budget is not None else None
+
+        def estimates(summaries: List[Dict[UnitKind, UnitGroupSummary]],
+                      combatants: List[Combatant]) -> List[Dict[UnitKind, Estimate]]:
+            return [{kind: _mean_interval(summary[kind], z) for kind in combatant.unit_groups}
+                    for summary, combatant in zip(summaries, combatants)]
+
+        summary = None
+        num_simulations = batch_size
+        while True:
+            batch = self.simulate_summary(attackers, defenders, seed, num_simulations, workers=workers,
+                                          first_simulation=summary.num_simulations if summary is not None else 0)
+            summary = batch if summary is None else summary.merge(batch)
+
+            win_probability = _wilson_interval(summary.attackers_wins, summary.num_simulations, z)
+            attackers_means = estimates(summary.attackers_summaries, attackers)
+            defenders_means = estimates(summary.defenders_summaries, defenders)
+
+            # The ratio of the current to the target width; CI widths shrink with the square root of simulations.
+            ratio = 0.0
+            if win_probability_width is not None:
+                ratio = max(ratio, win_probability.width / win_probability_width)
+            if remaining_units_width is not None:
+                for means in attackers_means + defenders_means:
+                    for estimate in means.values():
+                        ratio = max(ratio, estimate.width / remaining_units_width)
+
+            converged = ratio <= 1.0
+            if (converged or summary.num_simulations >= max_simulations or
+                    (deadline is not None and time.monotonic() >= deadline)):
+                return AdaptiveSimulationResult(summary.num_simulations, converged, summary, win_probability,
+                                                attackers_means, defenders_means)
+
+            needed = math.ceil(summary.num_simulations * ratio * ratio) if math.isfinite(ratio) else 0
+            num_simulations = min(max(needed - summary.num_simulations, batch_size),
+                                  max_simulations - summary.num_simulations)
+
+    def find_min_fleet(self, attackers: List[Combatant], defenders: List[Combatant], unit_groups: Dict[UnitKind, int],
+                       win_probability: float = 0.95, side: str = 'attackers', combatant: int = 0, seed: int = 0,
+                       confidence: float = 0.95, batch_size: int = 100, max_simulations: int = 10000,
+                       max_count: int = 2 ** 24, workers: int = 1) -> FleetSearchResult:
+        if not (0.0 < win_probability < 1.0):
+            raise ValueError('win_probability must be between 0 and 1')
+        if not (0.0 < confidence < 1.0):
+            raise ValueError('confidence must be between 0 and 1')
+        if side not in ('attackers', 'defenders'):
+            raise ValueError('side must be attackers or defenders')
+        combatants = attackers if side == 'attackers' else defenders
+        if not (0 <= combatant < len(combatants)):
+            raise ValueError('no combatant {} in {}'.format(combatant, side))
+        if not unit_groups or any(count <= 0 for count in unit_groups.values()):
+            raise ValueError('unit_groups must have counts greater than 0')
+        if batch_size <= 0:
+            raise ValueError('batch_size must be greater than 0')
+        if max_simulations < batch_size:
+            raise ValueError('max_simulations must be at least batch_size')
+        if max_count <= 0:
+            raise ValueError('max_count must be greater than 0')
+
+        seed = self._prepare_simulation(attackers, defenders, seed)
+        z = _normal_quantile((1.0 + confidence) / 2.0)
+        base = combatants[combatant]
+        summaries = {}
+
+        def candidate_unit_groups(count: int) -> Dict[UnitKind, int]:
+            return {kind: step * count for kind, step in unit_groups.items()}
+
+        def candidate(count: int) -> Tuple[List[Combatant], List[Combatant]]:
+            groups = dict(base.unit_groups)
+            for kind, added in candidate_unit_groups(count).items():
+                groups[kind] = groups.get(kind, 0) + added
+            candidate_combatants = list(combatants)
+            candidate_combatants[combatant] = Combatant(base.weapons_technology, base.shielding_technology,
+                                                        base.armor_technology, groups)
+            if side == 'attackers':
+                return candidate_combatants, defenders
+            return attackers, candidate_combatants
+
+        def estimate(count: int) -> Estimate:
+            summary = summaries[count]
+            wins = summary.attackers_wins if side == 'attackers' else summary.defenders_wins
+            return _wilson_interval(wins, summary.num_simulations, z)
+
+        # Every candidate runs the same simulations of the seed (common random numbers), so candidates differ only by
+        # the fleet, not by the luck of their samples. Simulations are added until the interval is on one side of the
+        # target, points evaluated again continue where they stopped.
+        def wins(count: int) -> bool:
+            while True:
+                summary = summaries.get(count)
+                if summary is not None:
+                    interval = estimate(count)
+                    if interval.low >= win_probability:
+                        return True
+                    if interval.high < win_probability:
+                        return False
+                    if summary.num_simulations >= max_simulations:
+                        return interval.value >= win_probability
+                first_simulation = summary.num_simulations if summary is not None else 0
+                num_simulations = min(max(first_simulation, batch_size), max_simulations - first_simulation)
+                candidate_attackers, candidate_defenders = candidate(count)
+                batch = self.simulate_summary(candidate_attackers, candidate_defenders, seed, num_simulations,
+                                              workers=workers, first_simulation=first_simulation)
+                summaries[count] = batch if summary is None else summary.merge(batch)
+
+        # Gallop to the first winning count, then bisect between it and the last losing one.
+        low, high = None, 0
+        while not wins(high):
+            low = high
+            if high == max_count:
+                high = None
+                break
+            high = min(max(2 * high, 1), max_count)
+
+        if high is not None and low is not None:
+            while high - low > 1:
+                middle = (low + high) // 2
+                if wins(middle):
+                    high = middle
+                else:
+                    low = middle
+
+        points = {count: estimate(count) for count in sorted(summaries)}
+        num_simulations = sum(summary.num_simulations for summary in summaries.values())
+        if high is None:
+            return FleetSearchResult(None, None, None, points, num_simulations)
+        return FleetSearchResult(high, candidate_unit_groups(high), points[high], points, num_simulations)
+
+    @staticmethod
+    def _parse_frames(out: bytes) -> List[Tuple[str, memoryview]]:
+        # Frames of the serve mode, up to the first incomplete one.
+        data = memoryview(out)
+        frames = []
+        offset = 0
+        while True:
+            end = out.find(b'\n', offset)
+            if end < 0:
+                return frames
+            status, size = bytes(data[offset:end]).decode('ascii').split()
+            frames.append((status, data[end + 1:end + 1 + int(size)]))
+            offset = end + 1 + int(size)
+
+    def simulate_many(self, battles: Sequence[Tuple[List[Combatant], List[Combatant], int, int]], timeout=None,
+                      workers: int = 1) -> List[Union[List[BattleOutcome], Exception]]:
+        if workers <= 0:
+            raise ValueError('workers must be greater than 0')
+        self._assert_process_backend('simulate_many')
+
+        results = [None] * len(battles)
+        requests = []
+        stdin = [self._make_stdin_for_units_attributes(), '\n']
+        for i, (attackers, defenders, seed, num_simulations) in enumerate(battles):
+            try:
+                seed = self._prepare_simulation(attackers, defenders, seed)
+                if num_simulations < 0:
+                    raise ValueError('num_simulations must be at least 0')
+            except ValueError as e:
+                results[i] = e
+                continue
+            stdin.append('simulate {} {}\n'.format(seed, num_simulations))
+            stdin.append(self._make_stdin_for_combatants(attackers, defenders) + '\n')
+            requests.append(i)
+
+        if not requests:
+            return results
+
+        args = [self.engine_path, '--serve', '--binary', '--threads', str(workers), *self._engine_options()]
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        try:
+            outs = p.communicate(input=''.join(stdin).encode(), timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            raise
+
+        frames = self._parse_frames(outs[0])
+        for j, i in enumerate(requests):
+            attackers, defenders, _, num_simulations = battles[i]
+            if j >= len(frames):
+                # The engine stopped early, e.g. the units attributes could not be parsed.
+                results[i] = Error(outs[1].decode('ascii') or 'engine exited unexpectedly')
+                continue
+
+            status, payload = frames[j]
+            if status != 'ok':
+                results[i] = Error(bytes(payload).decode('ascii'))
+                continue
+
+            try:
+                results[i] = self._parse_output(payload, len(attackers), len(defenders), num_simulations)
+            except Error as e:
+                results[i] = e
+
+        return results
+
+    def prepare(self, attackers: List[Combatant], defenders: List[Combatant]) -> PreparedBattle:
+        self._assert_valid_combatants('attackers', attackers)
+        self._assert_valid_combatants('defenders', defenders)
+        return PreparedBattle(self, attackers, defenders)
+
+    def simulate_sweep(self, prepared: PreparedBattle, variations: Sequence[Variation], seed: int = 0,
+                       num_simulations: int = 1, timeout=None, workers: int = 1,
+                       summary: bool = False) -> Dict[Variation, Union[List[BattleOutcome], SimulationSummary]]:
+        if workers <= 0:
+            raise ValueError('workers must be greater than 0')
+        self._assert_process_backend('simulate_sweep')
+        if prepared._engine is not self:
+            raise ValueError('prepared battle must be prepared by this engine')
+        if num_simulations < 0:
+            raise ValueError('num_simulations must be at least 0')
+        seed = self._prepare_simulation([], [], seed)
+
+        # The battle is sent once, every variation sends only its changes. All variations run the same simulations of
+        # the seed (common random numbers), so they differ only by their changes, not by the luck of their samples.
+        variations = list(dict.fromkeys(variations))
+        combatants = [prepared.combatants(variation) for variation in variations]
+        stdin = [prepared._stdin]
+        run_frames = []
+        num_requests = 1
+        for variation in variations:
+            requests = prepared._make_requests(variation)
+            stdin.extend(requests)
+            stdin.append('run {} {}\nreset\n'.format(seed, num_simulations))
+            run_frames.append(num_requests + len(requests))
+            num_requests += len(requests) + 2
+
+        args = [self.engine_path, '--serve', '--binary', '--threads', str(workers), *self._engine_options()]
+        if summary:
+            args.append('--summary')
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        try:
+            out, err = p.communicate(input=''.join(stdin).encode(), timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            raise
+
+        frames = self._parse_frames(out)
+        if len(frames) != num_requests:
+            raise Error(err.decode('ascii') or 'engine exited unexpectedly')
+        for status, payload in frames:
+            if status != 'ok':
+                raise Error(bytes(payload).decode('ascii'))
+
+        results = {}
+        for variation, (attackers, defenders), index in zip(variations, combatants, run_frames):
+            payload = frames[index][1]
+            if summary:
+                results[variation] = self._parse_summary_output(payload, attackers, defenders, num_simulations)
+            else:
+                results[variation] = self._parse_output(payload, len(attackers), len(defenders), num_simulations)
+        return results
+
+    def _assert_snapshots_supported(self):
+        self._assert_process_backend('snapshots')
+        if self.battle_threads != 0:
+            raise ValueError('snapshots cannot be used with battle threads')
+
+    def snapshot(self, attackers: List[Combatant], defenders: List[Combatant], round_no: int, seed: int = 0,
+                 simulation: int = 0, timeout=None) -> bytes:
+        # The state of the simulation after round_no rounds, an opaque value for resume().
+        self._assert_snapshots_supported()
+        if not attackers or not defenders:
+            raise ValueError('a snapshot needs attackers and defenders')
+        if not 0 <= round_no <= MAX_ROUNDS:
+            raise ValueError('round_no must be between 0 and {}'.format(MAX_ROUNDS))
+        if not 0 <= simulation <= 2 ** 32 - 1:
+            raise ValueError('simulation must be between 0 and 2**32-1')
+        seed = self._prepare_simulation(attackers, defenders, seed)
+        options = ('--snapshot', str(round_no), '--offset', str(simulation))
+        return self._run_engine(attackers, defenders, seed, 1, timeout, 1, options)
+
+    def resume(self, snapshot: bytes, seed: int = 0, num_simulations: int = 1, timeout=None, workers: int = 1,
+               same_stream: bool = False) -> List[BattleOutcome]:
+        # Continuations of a snapshot, every one with its own simulation of the seed. With same_stream, the only
+        # continuation draws the random numbers that the simulation of the snapshot would have drawn.
+        self._assert_snapshots_supported()
+        if workers <= 0:
+            raise ValueError('workers must be greater than 0')
+        if num_simulations < 0:
+            raise ValueError('num_simulations must be at least 0')
+        if same_stream and num_simulations != 1:
+            raise ValueError('same_stream requires exactly 1 simulation')
+        # A damaged snapshot is reported like the engine reports it.
+        if len(snapshot) < _SNAPSHOT_HEADER.size:
+            raise Error('snapshot is truncated')
+        magic, version, rng, num_kinds, num_attackers, num_defenders, _ = _SNAPSHOT_HEADER.unpack_from(snapshot)
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise Error('snapshot has an unsupported format')
+        if num_kinds != len(self.units_attributes) or RNGS[min(rng, len(RNGS) - 1)] != self.rng:
+            raise ValueError('snapshot was made by another engine configuration')
+        seed = self._prepare_simulation([], [], seed)
+
+        stdin = (self._make_stdin_for_units_attributes() + '\n{}\n'.format(len(snapshot))).encode() + bytes(snapshot)
+        args = [self.engine_path, '--binary', '--threads', str(workers), *self._engine_options(), '--resume']
+        if same_stream:
+            args.append('--snapshot-stream')
+        args += [str(seed), str(num_simulations)]
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        try:
+            out, err = p.communicate(input=stdin, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            raise
+
+        if p.returncode != 0:
+            raise Error(err.decode('ascii'))
+
+        return self._parse_output(out, num_attackers, num_defenders, num_simulations)
+
+    def _expected_shots(self, shooters: List[Combatant], targets: List[Combatant]) -> float:
+        targets_units = {}
+        for combatant in targets:
+            for kind, count in combatant.unit_groups.items():
+                targets_units[kind] = targets_units.get(kind, 0) + count
+        num_targets = sum(targets_units.values())
+        if num_targets == 0:
+            return 0.0
+
+        shots = 0.0
+        for combatant in shooters:
+            for kind, count in combatant.unit_groups.items():
+                # A shooter fires until it fails a rapid fire roll, 1 / (1 - 1 / rapid_fire) shots on average.
+                rapid_fire = self.units_attributes[kind].rapid_fire
+                stop = sum(units / num_targets * (1.0 / rapid_fire[target] if rapid_fire.get(target, 0) > 0 else 1.0)
+                           for target, units in targets_units.items())
+                shots += count / stop
+        return shots
+
+    def _estimate_party_memory(self, party: List[Combatant], shots: float) -> int:
+        num_blocks = sum(1 for combatant in party for count in combatant.unit_groups.values() if count != 0)
+        num_units = sum(sum(combatant.unit_groups.values()) for combatant in party)
+        # Only damaged units and units hit in a round are stored one by one, in arrays that double when they grow.
+        stored_units = min(num_units, math.ceil(MAX_ROUNDS * shots))
+        return num_blocks * (_SIZEOF_BLOCK + 8) + 8 + 2 * stored_units * _SIZEOF_UNIT
+
+    def estimate_memory(self, attackers: List[Combatant], defenders: List[Combatant], workers: int = 1) -> int:
+        self._assert_valid_combatants('attackers', attackers)
+        self._assert_valid_combatants('defenders', defenders)
+
+        if workers <= 0:
+            raise ValueError('workers must be greater than 0')
+
+        num_kinds = len(self.units_attributes)
+        num_combatants = len(attackers) + len(defenders)
+        combatants_size = num_combatants * (_SIZEOF_COMBATANT + num_kinds * 8 +
+                                            MAX_ROUNDS * num_kinds * _SIZEOF_UNIT_GROUP_STATS)
+        num_slots = 2 * workers if workers > 1 else 1
+        fight_size = (self._estimate_party_memory(attackers, self._expected_shots(defenders, attackers)) +
+                      self._estimate_party_memory(defenders, self._expected_shots(attackers, defenders)))
+        return (1 + num_slots) * combatants_size + workers * fight_size
+
+    def pool(self, size: int) -> 'BattleEnginePool':
+        self._assert_process_backend('pool')
+        return BattleEnginePool(self, size)
+
+
+class BattleEnginePool:
+    engine: BattleEngine
+    size: int
+
+    def __init__(self, engine: BattleEngine, size: int):
+        if size <= 0:
+            raise ValueError('size must be greater than 0')
+        self.engine = engine
+        self.size = size
+        self._units_attributes_stdin = (engine._make_stdin_for_units_attributes() + '\n').encode()
+        self._idle_workers = queue.Queue()
+        self._closed = False
+        for _ in range(size):
+            self._idle_workers.put(self._start_worker())
+
+    def __enter__(self) -> 'BattleEnginePool':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start_worker(self) -> subprocess.Popen:
+        args = [self.engine.engine_path, '--serve', '--binary', *self.engine._engine_options()]
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        p.stdin.write(self._units_attributes_stdin)
+        p.stdin.flush()
+        return p
+
+    @staticmethod
+    def _stop_worker(worker: subprocess.Popen):
+        try:
+            worker.stdin.close()
+        except OSError:
+            pass
+        try:
+            worker.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+            worker.wait()
+        worker.stdout.close()
+
+    @staticmethod
+    def _request(worker: subprocess.Popen, request: bytes) -> Tuple[str, bytes]:
+        try:
+            worker.stdin.write(request)
+            worker.stdin.flush()
+        except OSError:
+            raise Error('engine worker exited unexpectedly')
+
+        header = worker.stdout.readline().split()
+        if len(header) != 2:
+            raise Error('engine worker exited unexpectedly')
+
+        status, size = header[0].decode('ascii'), int(header[1])
+        payload = worker.stdout.read(size)
+        if len(payload) != size:
+            raise Error('engine worker exited unexpectedly')
+
+        return status, payload
+
+    def simulate(self, attackers: List[Combatant], defenders: List[Combatant], seed: int = 0,
+                 num_simulations: int = 1, timeout=None) -> List[BattleOutcome]:
+        if self._closed:
+            raise Error('pool is closed')
+
+        seed = self.engine._prepare_simulation(attackers, defenders, seed)
+
+        request = 'simulate {} {}\n'.format(seed, num_simulations)
+        request += self.engine._make_stdin_for_combatants(attackers, defenders) + '\n'
+
+        worker = self._idle_workers.get()
+        timed_out = threading.Event()
+        timer = None
+        if timeout is not None:
+            def kill():
+                timed_out.set()
+                worker.kill()
+
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+
+        try:
+            status, payload = self._request(worker, request.encode())
+        except Error:
+            if timed_out.is_set():
+                raise subprocess.TimeoutExpired(worker.args, timeout) from None
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+                timer.join()
+            if not timed_out.is_set() and worker.poll() is None:
+                self._idle_workers.put(worker)
+            else:
+                self._stop_worker(worker)
+                self._idle_workers.put(self._start_worker())
+
+        if status != 'ok':
+            raise Error(payload.decode('ascii'))
+
+        return self.engine._parse_output(payload, len(attackers), len(defenders), num_simulations)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in range(self.size):
+            self._stop_worker(self._idle_workers.get())
@@ -0,0 +1,246 @@
+# Copyright (C) 2020 Patryk Stefanski
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# In-process implementation of the rules of BattleEngine.c on NumPy arrays, used by the 'numpy' backend of
+# BattleEngine. All simulations of a battle are fought at once, the first axis of every array is the simulation.
+
+import subprocess
+import time
+from typing import Dict, List, Tuple
+
+import numpy
+
+from BattleEngine import MAX_ROUNDS, UNIT_GROUP_STATS_FIELDS, Combatant, UnitAttributes, UnitKind
+
+_F32 = numpy.float32
+
+_TIMES_FIRED = UNIT_GROUP_STATS_FIELDS.index('times_fired')
+_TIMES_WAS_SHOT = UNIT_GROUP_STATS_FIELDS.index('times_was_shot')
+_SHIELD_DAMAGE_DEALT = UNIT_GROUP_STATS_FIELDS.index('shield_damage_dealt')
+_HULL_DAMAGE_DEALT = UNIT_GROUP_STATS_FIELDS.index('hull_damage_dealt')
+_SHIELD_DAMAGE_TAKEN = UNIT_GROUP_STATS_FIELDS.index('shield_damage_taken')
+_HULL_DAMAGE_TAKEN = UNIT_GROUP_STATS_FIELDS.index('hull_damage_taken')
+_NUM_REMAINING_UNITS = UNIT_GROUP_STATS_FIELDS.index('num_remaining_units')
+
+
+class _Rules:
+    def __init__(self, units_attributes: Dict[UnitKind, UnitAttributes], combatants: List[Combatant]):
+        num_kinds = len(units_attributes)
+        weapons = numpy.array([units_attributes[kind].weapons for kind in range(num_kinds)], dtype=_F32)
+        shield = numpy.array([units_attributes[kind].shield for kind in range(num_kinds)], dtype=_F32)
+        armor = numpy.array([units_attributes[kind].armor for kind in range(num_kinds)], dtype=_F32)
+
+        def technology(name):
+            return numpy.array([getattr(combatant, name) for combatant in combatants], dtype=_F32)[:, numpy.newaxis]
+
+        # The same float expressions as in the engine, indexed by [combatant, kind].
+        self.damage = weapons * (_F32(1.0) + _F32(0.1) * technology('weapons_technology'))
+        self.max_shield = shield * (_F32(1.0) + _F32(0.1) * technology('shielding_technology'))
+        self.max_hull = _F32(0.1) * armor * (_F32(1.0) + _F32(0.1) * technology('armor_technology'))
+
+        self.rapid_fire = numpy.zeros((num_kinds, num_kinds), dtype=numpy.int64)
+        for kind in range(num_kinds):
+            for target, count in units_attributes[kind].rapid_fire.items():
+                self.rapid_fire[kind, target] = count
+
+        self.num_kinds = num_kinds
+        self.num_combatants = len(combatants)
+
+
+class _Party:
+    def __init__(self, rules: _Rules, combatants: List[Combatant], first_combatant: int, num_simulations: int):
+        owners = []
+        kinds = []
+        for i, combatant in enumerate(combatants):
+            # Units are in the order of combatants and kinds, the order in which they fire.
+            for kind in sorted(combatant.unit_groups):
+                count = combatant.unit_groups[kind]
+                owners.append(numpy.full(count, first_combatant + i, dtype=numpy.intp))
+                kinds.append(numpy.full(count, kind, dtype=numpy.intp))
+
+        owner = numpy.concatenate(owners) if owners else numpy.zeros(0, dtype=numpy.intp)
+        kind = numpy.concatenate(kinds) if kinds else numpy.zeros(0, dtype=numpy.intp)
+
+        self.owner = numpy.tile(owner, (num_simulations, 1))
+        self.kind = numpy.tile(kind, (num_simulations, 1))
+        self.hull = rules.max_hull[self.owner, self.kind]
+        self.shield = rules.max_shield[self.owner, self.kind]
+        self.num_alive = numpy.full(num_simulations, len(owner), dtype=numpy.intp)
+
+
+def _group_index(rules: _Rules, simulation, owner, kind):
+    return (simulation * rules.num_combatants + owner) * rules.num_kinds + kind
+
+
+def _add_stats(rules: _Rules, round_stats: numpy.ndarray, field: int, group, weights=None):
+    counts = numpy.bincount(group, weights=weights, minlength=round_stats[..., field].size)
+    round_stats[..., field] += counts.reshape(round_stats.shape[:-1]).astype(numpy.uint64)
+
+
+def _fire(rules: _Rules, rng: numpy.random.Generator, shooters: _Party, targets: _Party, fighting: numpy.ndarray,
+          round_stats: numpy.ndarray):
+    num_shooters = numpy.where(fighting, shooters.num_alive, 0)
+    total_shooters = int(num_shooters.sum())
+    if total_shooters == 0:
+        return
+
+    shooter_simulation = numpy.repeat(numpy.arange(len(num_shooters)), num_shooters)
+    shooter_index = numpy.arange(total_shooters) - numpy.repeat(numpy.cumsum(num_shooters) - num_shooters,
+                                                                num_shooters)
+    shooter_owner = shooters.owner[shooter_simulation, shooter_index]
+    shooter_kind = shooters.kind[shooter_simulation, shooter_index]
+
+    # Targets do not depend on the damage dealt, so all the shots of a round are drawn first, in waves: in every wave
+    # each shooter whose rapid fire chain goes on fires one more shot.
+    shot_shooters = []
+    shot_targets = []
+    shot_waves = []
+    firing = numpy.arange(total_shooters)
+    wave = 0
+    while len(firing) != 0:
+        simulation = shooter_simulation[firing]
+        target = rng.integers(0, targets.num_alive[simulation])
+        shot_shooters.append(firing)
+        shot_targets.append(target)
+        shot_waves.append(numpy.full(len(firing), wave))
+
+        rapid_fire = rules.rapid_fire[shooter_kind[firing], targets.kind[simulation, target]]
+        chained = rapid_fire != 0
+        chained[chained] = rng.integers(0, rapid_fire[chained]) != 0
+        firing = firing[chained]
+        wave += 1
+
+    shooter = numpy.concatenate(shot_shooters)
+    target = numpy.concatenate(shot_targets)
+    simulation = shooter_simulation[shooter]
+
+    # Shots at the same target are applied in the order the engine fires them: by shooter, then by chain position.
+    # Shots are applied in layers, the k-th layer holds the k-th shot at every target.
+    waves = numpy.concatenate(shot_waves)
+    num_targets = targets.hull.shape[1]
+    if len(num_shooters) * num_targets * total_shooters * wave < 2 ** 63:
+        key = (simulation * num_targets + target) * (total_shooters * wave) + shooter * wave + waves
+        order = numpy.argsort(key, kind='stable')
+    else:
+        order = numpy.lexsort((waves, shooter, target, simulation))
+    shooter = shooter[order]
+    target = target[order]
+    simulation = simulation[order]
+
+    num_shots = len(order)
+    first = numpy.ones(num_shots, dtype=bool)
+    first[1:] = (simulation[1:] != simulation[:-1]) | (target[1:] != target[:-1])
+    layer = numpy.arange(num_shots) - numpy.maximum.accumulate(numpy.where(first, numpy.arange(num_shots), 0))
+    by_layer = numpy.argsort(layer, kind='stable')
+    layer_ends = numpy.cumsum(numpy.bincount(layer))
+
+    shield_damage = numpy.zeros(num_shots, dtype=numpy.uint64)
+    hull_damage = numpy.zeros(num_shots, dtype=numpy.uint64)
+    damage = rules.damage[shooter_owner[shooter], shooter_kind[shooter]]
+    target_owner = targets.owner[simulation, target]
+    target_kind = targets.kind[simulation, target]
+
+    begin = 0
+    for end in layer_ends:
+        shots = by_layer[begin:end]
+        begin = end
+
+        shots = shots[targets.hull[simulation[shots], target[shots]] != _F32(0.0)]
+        s = simulation[shots]
+        t = target[shots]
+        shot_damage = damage[shots]
+        shield = targets.shield[s, t]
+        hull = targets.hull[s, t]
+        max_shield = rules.max_shield[target_owner[shots], target_kind[shots]]
+        max_hull = rules.max_hull[target_owner[shots], target_kind[shots]]
+
+        hull_hit = shot_damage - shield
+        absorbed = hull_hit < _F32(0.0)
+
+        shield_hit = _F32(0.01) * numpy.floor(_F32(100.0) * shot_damage / max_shield) * max_shield
+        shield_damage[shots] = numpy.where(absorbed, shield_hit, shield).astype(numpy.uint64)
+        hull_hit = numpy.where(absorbed, _F32(0.0), numpy.minimum(hull_hit, hull))
+        hull_damage[shots] = hull_hit.astype(numpy.uint64)
+
+        shield = numpy.where(absorbed, shield - shield_hit, _F32(0.0))
+        hull = hull - hull_hit
+
+        explodes = (hull != _F32(0.0)) & (hull < _F32(0.7) * max_hull)
+        explodes[explodes] = hull[explodes] < rng.random(int(explodes.sum()), dtype=_F32) * max_hull[explodes]
+        hull[explodes] = _F32(0.0)
+
+        targets.shield[s, t] = shield
+        targets.hull[s, t] = hull
+
+    shooter_group = _group_index(rules, simulation, shooter_owner[shooter], shooter_kind[shooter])
+    target_group = _group_index(rules, simulation, target_owner, target_kind)
+    _add_stats(rules, round_stats, _TIMES_FIRED, shooter_group)
+    _add_stats(rules, round_stats, _SHIELD_DAMAGE_DEALT, shooter_group, shield_damage)
+    _add_stats(rules, round_stats, _HULL_DAMAGE_DEALT, shooter_group, hull_damage)
+    _add_stats(rules, round_stats, _TIMES_WAS_SHOT, target_group)
+    _add_stats(rules, round_stats, _SHIELD_DAMAGE_TAKEN, target_group, shield_damage)
+    _add_stats(rules, round_stats, _HULL_DAMAGE_TAKEN, target_group, hull_damage)
+
+
+def _update_units(rules: _Rules, party: _Party, fighting: numpy.ndarray, round_stats: numpy.ndarray):
+    num_units = party.hull.shape[1]
+    alive = (numpy.arange(num_units) < party.num_alive[:, numpy.newaxis]) & (party.hull != _F32(0.0))
+
+    simulation, index = numpy.nonzero(alive & fighting[:, numpy.newaxis])
+    _add_stats(rules, round_stats, _NUM_REMAINING_UNITS,
+               _group_index(rules, simulation, party.owner[simulation, index], party.kind[simulation, index]))
+
+    # Alive units are moved to the front, keeping their order.
+    order = numpy.argsort(~alive, axis=1, kind='stable')
+    party.num_alive = alive.sum(axis=1)
+    num_units = int(party.num_alive.max(initial=0))
+    order = order[:, :num_units]
+    party.owner = numpy.take_along_axis(party.owner, order, axis=1)
+    party.kind = numpy.take_along_axis(party.kind, order, axis=1)
+    party.shield = numpy.take_along_axis(party.shield, order, axis=1)
+    party.hull = numpy.take_along_axis(party.hull, order, axis=1)
+
+
+def simulate(units_attributes: Dict[UnitKind, UnitAttributes], attackers: List[Combatant], defenders: List[Combatant],
+             seed: int, num_simulations: int, timeout=None) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    rules = _Rules(units_attributes, attackers + defenders)
+    stats = numpy.zeros((num_simulations, rules.num_combatants, MAX_ROUNDS, rules.num_kinds, 7), dtype=numpy.uint64)
+    num_rounds = numpy.zeros(num_simulations, dtype=numpy.uint64)
+
+    rng = numpy.random.default_rng(seed)
+    attackers_party = _Party(rules, attackers, 0, num_simulations)
+    defenders_party = _Party(rules, defenders, len(attackers), num_simulations)
+
+    for round_no in range(MAX_ROUNDS):
+        fighting = (attackers_party.num_alive > 0) & (defenders_party.num_alive > 0)
+        if not fighting.any():
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            raise subprocess.TimeoutExpired('numpy backend', timeout)
+
+        for party in (attackers_party, defenders_party):
+            party.shield = rules.max_shield[party.owner, party.kind]
+
+        round_stats = stats[:, :, round_no]
+        _fire(rules, rng, attackers_party, defenders_party, fighting, round_stats)
+        _fire(rules, rng, defenders_party, attackers_party, fighting, round_stats)
+        _update_units(rules, attackers_party, fighting, round_stats)
+        _update_units(rules, defenders_party, fighting, round_stats)
+
+        num_rounds += fighting
+
+    return stats, num_rounds
@@ -0,0 +1,365 @@
+# Copyright (C) 2020 Patryk Stefanski
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Deterministic approximation of the expected outcome of a battle. Units of a (combatant, kind) group are not
+# simulated one by one: a group is its expected number of undamaged units and of damaged units with their mean hull. In
+# every round the expected number of shots between groups follows from the rapid fire tables, the hits taken by a unit
+# are Poisson distributed, and shields, hull damage and explosions are applied to a unit with k hits for every likely
+# k.
+
+import math
+from typing import Dict, List, Tuple
+
+from BattleEngine import (MAX_ROUNDS, BattleEngine, BattleOutcome, Combatant, CombatantOutcome, UnitAttributes,
+                          UnitGroupStats, UnitKind)
+
+# Upper bound of hits on one unit in a round that are applied one by one.
+_MAX_HITS = 100000
+
+
+class _Group:
+    def __init__(self, side: int, combatant: int, kind: UnitKind, count: float, damage: float, max_shield: float,
+                 max_hull: float):
+        self.side = side
+        self.combatant = combatant
+        self.kind = kind
+        self.count = count
+        # Units with the full hull, the other units have the mean hull.
+        self.undamaged = count
+        self.hull = max_hull
+        # The state at the end of the current round, the units fire at the state at its start.
+        self.next_count = count
+        self.next_undamaged = count
+        self.next_hull = max_hull
+        self.damage = damage
+        self.max_shield = max_shield
+        self.max_hull = max_hull
+        self.times_fired = 0.0
+        self.times_was_shot = 0.0
+        self.shield_damage_dealt = 0.0
+        self.hull_damage_dealt = 0.0
+        self.shield_damage_taken = 0.0
+        self.hull_damage_taken = 0.0
+
+
+def _hits(num_hits: float, damage: float, shield: float, max_shield: float, hull: float,
+          max_hull: float) -> Tuple[float, float, float, float, float, float]:
+    # Applies Poisson(num_hits) shots of the given damage to a unit. Returns the probability that the unit survives,
+    # the expected shield and hull of the unit if it survives, the expected shield and hull damage taken and the
+    # probability that no shot reached the hull.
+    if num_hits <= 0.0:
+        return 1.0, shield, hull, 0.0, 0.0, 1.0
+
+    alive = 1.0
+    shield_damage = 0.0
+    hull_damage = 0.0
+    log_num_hits = math.log(num_hits)
+    max_hits = min(num_hits + 10.0 * math.sqrt(num_hits) + 10.0, _MAX_HITS)
+
+    cdf = 0.0
+    expected = [0.0, 0.0, 0.0]
+    intact = 0.0
+    penetrated = False
+    k = 0
+    while True:
+        p = math.exp(k * log_num_hits - num_hits - math.lgamma(k + 1))
+        cdf += p
+        expected[0] += p * alive
+        expected[1] += p * alive * shield
+        expected[2] += p * alive * hull
+        if not penetrated:
+            intact += p
+        reach = 1.0 - cdf
+        if alive == 0.0 or k >= max_hits or reach <= 0.0:
+            break
+
+        # The (k + 1)-th shot, applied as in fire_shooter() if the unit is still alive.
+        k += 1
+        if damage < shield:
+            absorbed = 0.01 * math.floor(100.0 * damage / max_shield) * max_shield
+            penetrating = 0.0
+        else:
+            absorbed = shield
+            penetrating = min(damage - shield, hull)
+        shield -= absorbed
+        hull -= penetrating
+        penetrated = penetrated or penetrating != 0.0
+        shield_damage += reach * alive * absorbed
+        hull_damage += reach * alive * penetrating
+
+        # Every shot at a unit with less than 70% of hull may make it explode, even if it bounces off.
+        if hull <= 0.0:
+            hull = 0.0
+            alive = 0.0
+        elif hull < 0.7 * max_hull:
+            alive *= hull / max_hull
+        elif absorbed == 0.0 and penetrating == 0.0:
+            # More shots would not change anything.
+            break
+
+    # Units with more hits than applied are in the last state: nothing changes, the unit is destroyed or the
+    # probability is negligible.
+    tail = max(1.0 - cdf, 0.0)
+    expected[0] += tail * alive
+    expected[1] += tail * alive * shield
+    expected[2] += tail * alive * hull
+    if not penetrated:
+        intact += tail
+
+    survival = min(expected[0], 1.0)
+    intact = min(intact, survival)
+    if expected[0] <= 0.0:
+        return 0.0, 0.0, 0.0, shield_damage, hull_damage, 0.0
+    return survival, expected[1] / expected[0], expected[2] / expected[0], shield_damage, hull_damage, intact
+
+
+def _hit_unit(volleys: Dict[float, list], max_shield: float, max_hull: float,
+              hull: float) -> Tuple[float, float, float, List[Tuple[float, float]]]:
+    # Volleys hit the unit one after another. Between volleys, the unit is merged again into one state: the survival
+    # probability and the mean shield and hull if it survives. Returns the probability that the unit survives, that it
+    # is not hit in the hull, its mean hull if it survives and the expected shield and hull damage of every volley.
+    alive = 1.0
+    intact = 1.0
+    shield = max_shield
+    damages = []
+    for damage, (num_hits, _) in volleys.items():
+        if alive <= 0.0:
+            damages.append((0.0, 0.0))
+            continue
+        survival, shield, hull, shield_damage, hull_damage, volley_intact = _hits(num_hits, damage, shield, max_shield,
+                                                                                  hull, max_hull)
+        damages.append((alive * shield_damage, alive * hull_damage))
+        intact *= volley_intact
+        alive *= survival
+    return alive, min(intact, alive), hull, damages
+
+
+class BattleEstimator:
+    units_attributes: Dict[UnitKind, UnitAttributes]
+
+    def __init__(self, units_attributes: Dict[UnitKind, UnitAttributes]):
+        self.units_attributes = units_attributes
+
+    def _make_groups(self, side: int, combatants: List[Combatant]) -> List[_Group]:
+        groups = []
+        for i, combatant in enumerate(combatants):
+            for kind, count in sorted(combatant.unit_groups.items()):
+                if count == 0:
+                    continue
+                if kind not in self.units_attributes:
+                    raise ValueError('no UnitKind({}) found in units_attributes'.format(kind))
+                attrs = self.units_attributes[kind]
+                damage = attrs.weapons * (1.0 + 0.1 * combatant.weapons_technology)
+                max_shield = attrs.shield * (1.0 + 0.1 * combatant.shielding_technology)
+                max_hull = 0.1 * attrs.armor * (1.0 + 0.1 * combatant.armor_technology)
+                groups.append(_Group(side, i, kind, float(count), damage, max_shield, max_hull))
+        return groups
+
+    def _fire(self, shooters: List[_Group], targets: List[_Group]):
+        num_targets = sum(target.count for target in targets)
+        if num_targets <= 0.0:
+            return
+
+        # A shooter fires again at a target of kind k with probability 1 - 1 / rapid_fire[k], so a chain has
+        # 1 / (1 - q) shots, where q is the probability of firing again at a random target.
+        target_shares = {}
+        for target in targets:
+            target_shares[target.kind] = target_shares.get(target.kind, 0.0) + target.count / num_targets
+        shots_per_shooter = {}
+        for shooter in shooters:
+            if shooter.kind not in shots_per_shooter:
+                rapid_fire = self.units_attributes[shooter.kind].rapid_fire
+                q = sum(share * (1.0 - 1.0 / rapid_fire[kind]) for kind, share in target_shares.items()
+                        if rapid_fire.get(kind, 0) > 0)
+                shots_per_shooter[shooter.kind] = 1.0 / (1.0 - q)
+
+        for shooter in shooters:
+            shooter.times_fired += shooter.count * shots_per_shooter[shooter.kind]
+
+        # Every unit of the targets gets the same number of hits on average. Shots of the same damage are merged into
+        # a volley, which fires at the position of its first shooter.
+        volleys = {}
+        for shooter in shooters:
+            num_hits = shooter.count * shots_per_shooter[shooter.kind] / num_targets
+            if num_hits > 0.0:
+                volley = volleys.setdefault(shooter.damage, [0.0, []])
+                volley[0] += num_hits
+                volley[1].append((shooter, num_hits))
+        num_hits = sum(volley[0] for volley in volleys.values())
+
+        # Units with the same shield and hull fare the same, whatever their combatant.
+        results = {}
+        dealt = [[0.0, 0.0] for _ in volleys]
+
+        def hit_units(target: _Group, hull: float, num_units: float) -> Tuple[float, float, float]:
+            key = (target.max_shield, target.max_hull, round(hull / target.max_hull, 9))
+            result = results.get(key)
+            if result is None:
+                result = _hit_unit(volleys, target.max_shield, target.max_hull, hull)
+                results[key] = result
+            alive, intact, hull, damages = result
+            for volley_dealt, (shield_damage, hull_damage) in zip(dealt, damages):
+                target.shield_damage_taken += num_units * shield_damage
+                target.hull_damage_taken += num_units * hull_damage
+                volley_dealt[0] += num_units * shield_damage
+                volley_dealt[1] += num_units * hull_damage
+            return alive, intact, hull
+
+        for target in targets:
+            if target.count <= 0.0:
+                continue
+            target.times_was_shot += num_hits * target.count
+
+            num_damaged = target.count - target.undamaged
+            undamaged, undamaged_intact, undamaged_hull = hit_units(target, target.max_hull, target.undamaged)
+            damaged, _, damaged_hull = hit_units(target, target.hull, num_damaged)
+
+            # Undamaged units that were not hit in the hull stay undamaged, the others join the damaged units.
+            num_undamaged = target.undamaged * undamaged_intact
+            hit = target.undamaged * max(undamaged - undamaged_intact, 0.0)
+            hit_hull = target.max_hull
+            if hit > 0.0:
+                hit_hull = (target.undamaged * undamaged * undamaged_hull - num_undamaged * target.max_hull) / hit
+                hit_hull = min(max(hit_hull, 0.0), target.max_hull)
+            num_damaged *= damaged
+            target.next_count = num_undamaged + hit + num_damaged
+            target.next_undamaged = num_undamaged
+            target.next_hull = target.max_hull
+            if hit + num_damaged > 0.0:
+                target.next_hull = (hit * hit_hull + num_damaged * damaged_hull) / (hit + num_damaged)
+
+        # Damage dealt by a volley is split by the hits of its shooters.
+        for (volley_hits, volley_shooters), (shield_damage, hull_damage) in zip(volleys.values(), dealt):
+            for shooter, shooter_hits in volley_shooters:
+                shooter.shield_damage_dealt += shield_damage * shooter_hits / volley_hits
+                shooter.hull_damage_dealt += hull_damage * shooter_hits / volley_hits
+
+    @staticmethod
+    def _round_stats(groups: List[_Group], num_combatants: int,
+                     num_kinds: int) -> List[Dict[UnitKind, UnitGroupStats]]:
+        stats = [{UnitKind(kind): UnitGroupStats(0, 0, 0, 0, 0, 0, 0) for kind in range(num_kinds)}
+                 for _ in range(num_combatants)]
+        for group in groups:
+            stats[group.combatant][group.kind] = UnitGroupStats(
+                round(group.times_fired), round(group.times_was_shot), round(group.shield_damage_dealt),
+                round(group.hull_damage_dealt), round(group.shield_damage_taken), round(group.hull_damage_taken),
+                round(group.count))
+        return stats
+
+    def estimate(self, attackers: List[Combatant], defenders: List[Combatant]) -> BattleOutcome:
+        num_kinds = len(self.units_attributes)
+        attackers_groups = self._make_groups(0, attackers)
+        defenders_groups = self._make_groups(1, defenders)
+        groups = attackers_groups + defenders_groups
+
+        attackers_rounds = []
+        defenders_rounds = []
+
+        def alive(side_groups: List[_Group]) -> bool:
+            return sum(group.count for group in side_groups) >= 0.5
+
+        num_rounds = 0
+        while num_rounds < MAX_ROUNDS and alive(attackers_groups) and alive(defenders_groups):
+            for group in groups:
+                group.times_fired = group.times_was_shot = 0.0
+                group.shield_damage_dealt = group.hull_damage_dealt = 0.0
+                group.shield_damage_taken = group.hull_damage_taken = 0.0
+                group.next_count, group.next_undamaged, group.next_hull = group.count, group.undamaged, group.hull
+
+            # Both sides fire at the units alive at the start of the round.
+            self._fire(attackers_groups, defenders_groups)
+            self._fire(defenders_groups, attackers_groups)
+            for group in groups:
+                group.count, group.undamaged, group.hull = group.next_count, group.next_undamaged, group.next_hull
+
+            attackers_rounds.append(self._round_stats(attackers_groups, len(attackers), num_kinds))
+            defenders_rounds.append(self._round_stats(defenders_groups, len(defenders), num_kinds))
+            num_rounds += 1
+
+        def outcomes(rounds: List[List[Dict[UnitKind, UnitGroupStats]]], num_combatants: int):
+            return [CombatantOutcome([round_stats[i] for round_stats in rounds]) for i in range(num_combatants)]
+
+        return BattleOutcome(num_rounds, outcomes(attackers_rounds, len(attackers)),
+                             outcomes(defenders_rounds, len(defenders)))
+
+    def calibrate(self, engine: BattleEngine, attackers: List[Combatant], defenders: List[Combatant],
+                  num_simulations: int = 1000, seed: int = 0, workers: int = 1) -> 'EstimatorCalibration':
+        outcome = self.estimate(attackers, defenders)
+        summary = engine.simulate_summary(attackers, defenders, seed, num_simulations, workers=workers)
+
+        groups = []
+        for side, combatants, estimated_outcomes, summaries in (
+                ('attackers', attackers, outcome.attackers_outcomes, summary.attackers_summaries),
+                ('defenders', defenders, outcome.defenders_outcomes, summary.defenders_summaries)):
+            for i, combatant in enumerate(combatants):
+                for kind, count in sorted(combatant.unit_groups.items()):
+                    if count == 0:
+                        continue
+                    if outcome.num_rounds != 0:
+                        estimated = estimated_outcomes[i].round_stats(outcome.num_rounds - 1)[kind].num_remaining_units
+                    else:
+                        estimated = count
+                    group_summary = summaries[i][kind]
+                    groups.append(GroupCalibration(side, i, kind, count, estimated, group_summary.mean,
+                                                   group_summary.stdev))
+
+        return EstimatorCalibration(num_simulations, outcome.num_rounds, summary.mean_rounds, groups)
+
+
+class GroupCalibration:
+    side: str
+    combatant: int
+    kind: UnitKind
+    num_units: int
+    estimated: int
+    mean: float
+    stdev: float
+
+    def __init__(self, side: str, combatant: int, kind: UnitKind, num_units: int, estimated: int, mean: float,
+                 stdev: float):
+        self.side = side
+        self.combatant = combatant
+        self.kind = kind
+        self.num_units = num_units
+        self.estimated = estimated
+        self.mean = mean
+        self.stdev = stdev
+
+    @property
+    def error(self) -> float:
+        return self.estimated - self.mean
+
+    @property
+    def relative_error(self) -> float:
+        # Relative to the initial number of units, so that groups that are wiped out do not dominate.
+        return abs(self.error) / self.num_units
+
+
+class EstimatorCalibration:
+    num_simulations: int
+    estimated_rounds: int
+    mean_rounds: float
+    groups: List[GroupCalibration]
+
+    def __init__(self, num_simulations: int, estimated_rounds: int, mean_rounds: float,
+                 groups: List[GroupCalibration]):
+        self.num_simulations = num_simulations
+        self.estimated_rounds = estimated_rounds
+        self.mean_rounds = mean_rounds
+        self.groups = groups
+
+    @property
+    def max_relative_error(self) -> float:
+        return max((group.relative_error for group in self.groups), default=0.0)
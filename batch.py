@@ -0,0 +1,302 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import OG
+from BattleEngine import (RNGS, UNIT_GROUP_STATS_FIELDS, BattleEngine, BattleEnginePool, BattleOutcome, Combatant,
+                          CombatantOutcome, Error, SimulationSummary, UnitGroupSummary, UnitKind)
+
+Battle = Tuple[List[Combatant], List[Combatant], int, int]
+
+COMBATANT_FIELDS = ('weapons_technology', 'shielding_technology', 'armor_technology')
+
+
+def parse_unit_kind(name: str) -> UnitKind:
+    # JSON object keys are strings, kinds are given by number ("5") or by name in OG ("Battleship").
+    if name.isdigit():
+        kind = UnitKind(int(name))
+    else:
+        kind = getattr(OG, name, None)
+        if not isinstance(kind, int) or name.startswith('_'):
+            raise ValueError('unknown unit kind {!r}'.format(name))
+    if kind not in OG.units_attributes:
+        raise ValueError('unknown unit kind {!r}'.format(name))
+    return kind
+
+
+def parse_combatant(data: dict) -> Combatant:
+    technologies = [data.get(field, 0) for field in COMBATANT_FIELDS]
+    if not all(isinstance(level, int) and level >= 0 for level in technologies):
+        raise ValueError('technologies must be non-negative integers')
+    unit_groups = {}
+    for name, count in data.get('unit_groups', {}).items():
+        if not isinstance(count, int) or count < 0:
+            raise ValueError('unit counts must be non-negative integers')
+        unit_groups[parse_unit_kind(name)] = count
+    return Combatant(*technologies, unit_groups)
+
+
+def parse_battle(line: str) -> Tuple[dict, Battle]:
+    data = json.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError('battle must be an object')
+    attackers = [parse_combatant(combatant) for combatant in data.get('attackers', [])]
+    defenders = [parse_combatant(combatant) for combatant in data.get('defenders', [])]
+    seed = data.get('seed', 0)
+    num_simulations = data.get('simulations', 1)
+    if not isinstance(seed, int) or not (0 <= seed <= 2 ** 32 - 1):
+        raise ValueError('seed must be between 0 and 2**32-1')
+    if not isinstance(num_simulations, int) or not (1 <= num_simulations <= 2 ** 32 - 1):
+        raise ValueError('simulations must be between 1 and 2**32-1')
+    # A random seed is picked here instead of in the engine, so that it can be recorded.
+    if seed == 0:
+        seed = random.randint(1, 1000000000)
+    return data, (attackers, defenders, seed, num_simulations)
+
+
+def stats_record(stats, fields: List[str]) -> dict:
+    return {field: getattr(stats, field) for field in fields}
+
+
+def combatants_outcomes_record(num_rounds: int, combatants: List[Combatant],
+                               outcomes: List[CombatantOutcome], fields: List[str]) -> List[dict]:
+    # Only the stats after the last round of kinds that the combatant has.
+    records = []
+    for combatant, outcome in zip(combatants, outcomes):
+        round_stats = outcome.round_stats(num_rounds - 1) if num_rounds != 0 else {}
+        records.append({str(kind): stats_record(round_stats[kind], fields)
+                        for kind, count in combatant.unit_groups.items() if count != 0 and kind in round_stats})
+    return records
+
+
+def outcome_record(outcome: BattleOutcome, attackers: List[Combatant], defenders: List[Combatant],
+                   fields: List[str]) -> dict:
+    return {
+        'num_rounds': outcome.num_rounds,
+        'attackers': combatants_outcomes_record(outcome.num_rounds, attackers, outcome.attackers_outcomes, fields),
+        'defenders': combatants_outcomes_record(outcome.num_rounds, defenders, outcome.defenders_outcomes, fields),
+    }
+
+
+def unit_group_summary_record(summary: UnitGroupSummary) -> dict:
+    return {'mean': summary.mean, 'stdev': summary.stdev, 'min': summary.min, 'max': summary.max,
+            'p5': summary.percentile(5.0), 'p95': summary.percentile(95.0)}
+
+
+def summary_record(summary: SimulationSummary, attackers: List[Combatant], defenders: List[Combatant]) -> dict:
+    def combatants_records(combatants: List[Combatant], summaries: List[Dict[UnitKind, UnitGroupSummary]]):
+        return [{str(kind): unit_group_summary_record(combatant_summaries[kind])
+                 for kind, count in combatant.unit_groups.items() if count != 0 and kind in combatant_summaries}
+                for combatant, combatant_summaries in zip(combatants, summaries)]
+
+    return {
+        'attackers_win_rate': summary.attackers_win_rate,
+        'defenders_win_rate': summary.defenders_win_rate,
+        'draw_rate': summary.draw_rate,
+        'mean_rounds': summary.mean_rounds,
+        'attackers': combatants_records(attackers, summary.attackers_summaries),
+        'defenders': combatants_records(defenders, summary.defenders_summaries),
+    }
+
+
+class BatchRunner:
+    engine: BattleEngine
+    workers: int
+    summary: bool
+    fields: List[str]
+    timeout: Optional[float]
+
+    def __init__(self, engine: BattleEngine, workers: int, summary: bool, fields: List[str], timeout: float = None):
+        self.engine = engine
+        self.workers = workers
+        self.summary = summary
+        self.fields = fields
+        self.timeout = timeout
+        self._pool = None
+
+    def __enter__(self) -> 'BatchRunner':
+        # Summaries are computed by the engine, one process per battle. Outcomes reuse long-lived engine processes.
+        if not self.summary:
+            self._pool = BattleEnginePool(self.engine, self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._pool is not None:
+            self._pool.close()
+
+    def run_battle(self, battle: Battle) -> dict:
+        attackers, defenders, seed, num_simulations = battle
+        if self.summary:
+            summary = self.engine.simulate_summary(attackers, defenders, seed, num_simulations, self.timeout)
+            return summary_record(summary, attackers, defenders)
+        outcomes = self._pool.simulate(attackers, defenders, seed, num_simulations, self.timeout)
+        return {'outcomes': [outcome_record(outcome, attackers, defenders, self.fields) for outcome in outcomes]}
+
+
+def read_checkpoint(path: str) -> Set[int]:
+    # The output is the checkpoint: a battle is done when its record is in the output. A record cut short by an
+    # interruption is removed, so that the output stays valid JSONL.
+    done = set()
+    try:
+        f = open(path, 'r+b')
+    except FileNotFoundError:
+        return done
+    with f:
+        valid_size = 0
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b'\n'):
+                break
+            done.add(record['line'])
+            valid_size += len(line)
+        f.truncate(valid_size)
+    return done
+
+
+def read_battles(path: str, done: Set[int]) -> Iterator[Tuple[int, str]]:
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            if line.strip() and line_no not in done:
+                yield line_no, line
+
+
+def count_battles(path: str) -> int:
+    with open(path) as f:
+        return sum(1 for line in f if line.strip())
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Progress:
+    total: int
+    done: int
+    interval: float
+
+    def __init__(self, total: int, done: int, interval: float):
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self._num_battles = 0
+        self._num_simulations = 0
+        self._start = time.monotonic()
+        self._last_report = self._start
+
+    def update(self, num_simulations: int):
+        self.done += 1
+        self._num_battles += 1
+        self._num_simulations += num_simulations
+        if self.interval > 0.0 and time.monotonic() - self._last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        now = time.monotonic()
+        self._last_report = now
+        elapsed = max(now - self._start, 1e-9)
+        rate = self._num_battles / elapsed
+        eta = format_duration((self.total - self.done) / rate) if rate > 0.0 else '?'
+        print('{}/{} battles, {:.1f} battles/s, {:.0f} simulations/s, ETA {}'.format(
+            self.done, self.total, rate, self._num_simulations / elapsed, eta), file=sys.stderr)
+
+
+def run_batch(runner: BatchRunner, input_path: str, output_path: str, progress_interval: float):
+    done = read_checkpoint(output_path)
+    progress = Progress(count_battles(input_path), len(done), progress_interval)
+    if done:
+        print('Resuming, {} battles already done'.format(len(done)), file=sys.stderr)
+
+    with open(output_path, 'a') as output, \
+            concurrent.futures.ThreadPoolExecutor(runner.workers) as executor:
+        def write(record: dict):
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+
+        def run(line_no: int, data: dict, battle: Battle) -> dict:
+            record = {'line': line_no}
+            if 'id' in data:
+                record['id'] = data['id']
+            record['seed'] = battle[2]
+            record['simulations'] = battle[3]
+            try:
+                record.update(runner.run_battle(battle))
+            except (Error, ValueError, subprocess.TimeoutExpired) as e:
+                record['error'] = str(e).strip()
+            return record
+
+        def collect(futures):
+            for future in futures:
+                record = future.result()
+                write(record)
+                progress.update(record['simulations'] if 'error' not in record else 0)
+
+        # Only a few battles are queued at a time, so that memory does not grow with the size of the input.
+        pending = set()
+        try:
+            for line_no, line in read_battles(input_path, done):
+                try:
+                    data, battle = parse_battle(line)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    write({'line': line_no, 'error': 'invalid battle: {}'.format(e)})
+                    progress.update(0)
+                    continue
+                if len(pending) >= 2 * runner.workers:
+                    finished, pending = concurrent.futures.wait(pending,
+                                                                return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(finished)
+                pending.add(executor.submit(run, line_no, data, battle))
+            collect(concurrent.futures.as_completed(pending))
+        except KeyboardInterrupt:
+            for future in pending:
+                future.cancel()
+            print('Interrupted, run the same command again to resume', file=sys.stderr)
+            raise
+
+    progress.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate battles from a JSONL file. Every line is a battle: '
+                                                 '{"id": ..., "attackers": [...], "defenders": [...], "seed": S, '
+                                                 '"simulations": N}, combatants have the fields of Combatant.')
+    parser.add_argument('input', help='JSONL file with battles')
+    parser.add_argument('output', help='JSONL file to append results to, also used to resume an interrupted run')
+    parser.add_argument('--engine', default='./build/BattleEngine', help='path to the engine executable')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of engine processes (default: number of CPUs)')
+    parser.add_argument('--summary', action='store_true', help='write summaries instead of outcomes')
+    parser.add_argument('--fields', default='num_remaining_units',
+                        help='comma-separated stats fields of outcomes (default: num_remaining_units)')
+    parser.add_argument('--rng', default='lehmer', choices=RNGS, help='random number generator (default: lehmer)')
+    parser.add_argument('--timeout', type=float, help='timeout of a battle in seconds')
+    parser.add_argument('--progress', type=float, default=10.0,
+                        help='seconds between progress reports, 0 to disable (default: 10)')
+    args = parser.parse_args()
+
+    if args.workers <= 0:
+        parser.error('--workers must be greater than 0')
+    fields = args.fields.split(',')
+    for field in fields:
+        if field not in UNIT_GROUP_STATS_FIELDS:
+            parser.error('unknown field {!r}'.format(field))
+
+    engine = BattleEngine(args.engine, OG.units_attributes, rng=args.rng)
+    with BatchRunner(engine, args.workers, args.summary, fields, args.timeout) as runner:
+        try:
+            run_batch(runner, args.input, args.output, args.progress)
+        except KeyboardInterrupt:
+            sys.exit(130)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+import OG
+from BattleEngine import MAX_ROUNDS, RNGS, BattleEngine, BattleOutcome, Combatant, SimulationTiming, UnitKind
+
+Scenario = Tuple[List[Combatant], List[Combatant], int]
+
+CMAKE_OPTIONS = ('CMAKE_BUILD_TYPE', 'FAST_MATH', 'ARCH_NATIVE', 'OPENMP')
+
+
+def fleet(unit_groups: Dict[UnitKind, int], technology: int = 10) -> Combatant:
+    return Combatant(weapons_technology=technology, shielding_technology=technology, armor_technology=technology,
+                     unit_groups=unit_groups)
+
+
+def probe_swarm() -> Scenario:
+    attackers = [fleet({OG.EspionageProbe: 100000})]
+    defenders = [fleet({OG.RocketLauncher: 2000, OG.LightLaser: 500, OG.SmallShieldDome: 1})]
+    return attackers, defenders, 20
+
+
+def deathstar_vs_mixed_fleet() -> Scenario:
+    # The battle of example-simulator.py.
+    attackers = [
+        fleet({OG.Battleship: 25000}),
+        fleet({OG.LightFighter: 25000, OG.HeavyFighter: 25000, OG.Cruiser: 25000}),
+    ]
+    defenders = [fleet({OG.DeathStar: 250})]
+    return attackers, defenders, 10
+
+
+def defence_heavy_planet() -> Scenario:
+    attackers = [fleet({OG.Battleship: 5000, OG.Battlecruiser: 3000, OG.Bomber: 2000, OG.Destroyer: 1000}, 14)]
+    defenders = [fleet({OG.RocketLauncher: 100000, OG.LightLaser: 50000, OG.HeavyLaser: 10000, OG.GaussCannon: 2000,
+                        OG.IonCannon: 2000, OG.PlasmaTurret: 500, OG.SmallShieldDome: 1, OG.LargeShieldDome: 1}, 12)]
+    return attackers, defenders, 10
+
+
+def acs_battle() -> Scenario:
+    # The engine allows at most 256 combatants per side.
+    attackers = [fleet({OG.Cruiser: 100 + i, OG.LightFighter: 200, OG.Battleship: 20}, 8 + i % 8) for i in range(256)]
+    defenders = [fleet({OG.HeavyFighter: 150, OG.Battlecruiser: 10 + i % 5, OG.RocketLauncher: 100}, 8 + i % 8)
+                 for i in range(256)]
+    return attackers, defenders, 10
+
+
+def multi_million_fleet() -> Scenario:
+    attackers = [fleet({OG.LightFighter: 3000000, OG.HeavyFighter: 1000000, OG.Cruiser: 500000})]
+    defenders = [fleet({OG.RocketLauncher: 4000000, OG.LightLaser: 1000000, OG.Battleship: 100000})]
+    return attackers, defenders, 1
+
+
+SCENARIOS: Dict[str, Callable[[], Scenario]] = {
+    'probe-swarm': probe_swarm,
+    'deathstar-vs-mixed-fleet': deathstar_vs_mixed_fleet,
+    'defence-heavy-planet': defence_heavy_planet,
+    'acs-256-vs-256': acs_battle,
+    'multi-million-fleet': multi_million_fleet,
+}
+
+
+def count_units_rounds(attackers: List[Combatant], defenders: List[Combatant], outcomes: List[BattleOutcome]) -> int:
+    # Units alive at the start of every round fought.
+    initial_units = sum(sum(combatant.unit_groups.values()) for combatant in attackers + defenders)
+    units_rounds = 0
+    for outcome in outcomes:
+        combatants_outcomes = outcome.attackers_outcomes + outcome.defenders_outcomes
+        for round_no in range(outcome.num_rounds):
+            if round_no == 0:
+                units_rounds += initial_units
+            else:
+                units_rounds += sum(stats.num_remaining_units for combatant_outcome in combatants_outcomes
+                                    for stats in combatant_outcome.round_stats(round_no - 1).values())
+    return units_rounds
+
+
+def children_cpu_time() -> float:
+    # resource is not available on Windows, where os.times() does not count children either and CPU time stays 0.
+    try:
+        import resource
+    except ImportError:
+        times = os.times()
+        return times.children_user + times.children_system
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def benchmark_scenario(engine: BattleEngine, records: List[SimulationTiming], scenario: Scenario, seed: int,
+                       repeat: int, workers: int) -> dict:
+    # records receives the SimulationTiming of every call of the engine, see BattleEngine.on_timing.
+    attackers, defenders, num_simulations = scenario
+    timings = {'serialize': [], 'spawn': [], 'engine': [], 'engine_cpu': [], 'parse': [], 'total': []}
+    for _ in range(repeat):
+        records.clear()
+        cpu = children_cpu_time()
+        outcomes = engine.simulate(attackers, defenders, seed, num_simulations, workers=workers)
+        timings['engine_cpu'].append(children_cpu_time() - cpu)
+        timing, = records
+        for name in ('serialize', 'spawn', 'engine', 'parse', 'total'):
+            timings[name].append(getattr(timing, name))
+
+    units_rounds = count_units_rounds(attackers, defenders, outcomes)
+    engine_time = statistics.median(timings['engine'])
+
+    return {
+        'num_attackers': len(attackers),
+        'num_defenders': len(defenders),
+        'num_units': sum(sum(combatant.unit_groups.values()) for combatant in attackers + defenders),
+        'num_simulations': num_simulations,
+        'mean_rounds': statistics.mean(outcome.num_rounds for outcome in outcomes),
+        'output_bytes': timing.bytes_out,
+        'timings': {name: {'median': statistics.median(values), 'min': min(values)}
+                    for name, values in timings.items()},
+        'simulations_per_second': num_simulations / engine_time if engine_time > 0.0 else None,
+        'units_rounds_per_second': units_rounds / engine_time if engine_time > 0.0 else None,
+    }
+
+
+def read_build_options(engine_path: str) -> Dict[str, str]:
+    # The CMake cache is next to the executable in a CMake build directory.
+    options = {}
+    path = os.path.join(os.path.dirname(os.path.abspath(engine_path)), 'CMakeCache.txt')
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, value = line.strip().partition('=')
+                name = name.partition(':')[0]
+                if name in CMAKE_OPTIONS:
+                    options[name] = value
+    except FileNotFoundError:
+        pass
+    return options
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the battle engine on typical battles.')
+    parser.add_argument('--engine', default='./build/BattleEngine', help='path to the engine executable')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, can be repeated (default: all)')
+    parser.add_argument('--simulations', type=int, help='number of simulations, overrides the scenario default')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of every scenario (default: 3)')
+    parser.add_argument('--workers', type=int, default=1, help='number of engine threads (default: 1)')
+    parser.add_argument('--seed', type=int, default=1, help='seed (default: 1)')
+    parser.add_argument('--rng', default='lehmer', choices=RNGS, help='random number generator (default: lehmer)')
+    parser.add_argument('--battle-threads', type=int, default=0,
+                        help='number of threads of every battle, 0 to fight battles in one thread (default: 0)')
+    parser.add_argument('--label', default='', help='label of the build, e.g. fast-math')
+    parser.add_argument('--output', help='JSON file to write results to (default: stdout)')
+    args = parser.parse_args()
+
+    if args.repeat <= 0:
+        parser.error('--repeat must be greater than 0')
+
+    records = []
+    engine = BattleEngine(args.engine, OG.units_attributes, on_timing=records.append, rng=args.rng,
+                          battle_threads=args.battle_threads)
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        attackers, defenders, num_simulations = SCENARIOS[name]()
+        if args.simulations is not None:
+            num_simulations = args.simulations
+        print('Running {}...'.format(name), file=sys.stderr)
+        results[name] = benchmark_scenario(engine, records, (attackers, defenders, num_simulations), args.seed,
+                                           args.repeat, args.workers)
+
+    report = {
+        'label': args.label,
+        'engine': args.engine,
+        'build': read_build_options(args.engine),
+        'workers': args.workers,
+        'rng': args.rng,
+        'battle_threads': args.battle_threads,
+        'max_rounds': MAX_ROUNDS,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'scenarios': results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+import asyncio
+import os
+import stat
+import statistics
+import tempfile
+import unittest
+
+import OG
+from BattleEngine import (MAX_APPROXIMATE_BUCKETS, RNGS, UNIT_GROUP_STATS_FIELDS, BattleEngine, BattleOutcome,
+                          BattleOutcomeStore, Combatant, Error, OutputProjection, Variation)
+from BattleEstimator import BattleEstimator
+
+# The engine built as in the README, another one can be given with BATTLE_ENGINE.
+ENGINE_PATH = os.environ.get('BATTLE_ENGINE', os.path.join(os.path.dirname(__file__), '..', 'build', 'BattleEngine'))
+# The shared library built next to the engine, another one can be given with BATTLE_ENGINE_LIBRARY.
+LIBRARY_PATH = os.environ.get('BATTLE_ENGINE_LIBRARY', next(
+    (path for path in (os.path.join(os.path.dirname(ENGINE_PATH), name)
+                       for name in ('libBattleEngine.so', 'libBattleEngine.dylib', 'BattleEngine.dll'))
+     if os.path.exists(path)), ''))
+# Tests of battles that take seconds run only if BATTLE_ENGINE_SLOW_TESTS is set.
+SLOW_TESTS = bool(os.environ.get('BATTLE_ENGINE_SLOW_TESTS'))
+
+
+def fleet(unit_groups, technology: int = 10) -> Combatant:
+    return Combatant(weapons_technology=technology, shielding_technology=technology, armor_technology=technology,
+                     unit_groups=unit_groups)
+
+
+def outcome_key(outcome: BattleOutcome) -> tuple:
+    # Outcomes and stats do not compare by value. Rounds left out by a projection are None.
+    return (outcome.num_rounds,
+            [[sorted((kind, tuple(getattr(stats, field) for field in UNIT_GROUP_STATS_FIELDS))
+                     for kind, stats in round_stats.items()) if round_stats is not None else None
+              for round_stats in combatant_outcome.rounds_stats]
+             for combatant_outcome in outcome.attackers_outcomes + outcome.defenders_outcomes])
+
+
+def record_key(record: tuple) -> tuple:
+    *key, stats = record
+    return (*key, tuple(getattr(stats, field) for field in UNIT_GROUP_STATS_FIELDS))
+
+
+@unittest.skipUnless(os.path.exists(ENGINE_PATH) or os.path.exists(ENGINE_PATH + '.exe'),
+                     'battle engine is not built')
+class BattleEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = BattleEngine(ENGINE_PATH, OG.units_attributes)
+        self.attackers = [fleet({OG.Cruiser: 30, OG.LightFighter: 50})]
+        self.defenders = [fleet({OG.RocketLauncher: 100, OG.LightLaser: 20}, 8)]
+
+    def test_zero_simulations(self):
+        engine = self.engine
+        for attackers, defenders in [(self.attackers, self.defenders), ([], self.defenders)]:
+            self.assertEqual(engine.simulate(attackers, defenders, seed=1, num_simulations=0), [])
+            self.assertEqual(engine.simulate(attackers, defenders, seed=1, num_simulations=0, workers=2), [])
+            self.assertEqual(engine.simulate(attackers, defenders, seed=1, num_simulations=0, approximate=True), [])
+            self.assertEqual(engine.simulate(attackers, defenders, seed=1, num_simulations=0,
+                                             projection=OutputProjection(last_round=True)), [])
+            self.assertEqual(engine.simulate_summary(attackers, defenders, seed=1, num_simulations=0).num_simulations,
+                             0)
+            self.assertEqual(asyncio.run(engine.simulate_async(attackers, defenders, seed=1, num_simulations=0)), [])
+            with engine.pool(1) as pool:
+                self.assertEqual(pool.simulate(attackers, defenders, seed=1, num_simulations=0), [])
+            prepared = engine.prepare(attackers, defenders)
+            self.assertEqual(engine.simulate_sweep(prepared, [Variation()], seed=1, num_simulations=0),
+                             {Variation(): []})
+
+    def test_simulate_until_without_target(self):
+        with self.assertRaises(ValueError):
+            self.engine.simulate_until(self.attackers, self.defenders, seed=1)
+        result = self.engine.simulate_until(self.attackers, self.defenders, seed=1, win_probability_width=0.5)
+        self.assertTrue(result.converged)
+
+    @unittest.skipUnless(SLOW_TESTS, 'slow test')
+    def test_targets_beyond_random_max(self):
+        # A Lehmer number is below 2^31, targets after the first 2^31-1 units of a side must still be hit.
+        attackers = [fleet({OG.LightFighter: 100000}, 0)]
+        defenders = [fleet({OG.RocketLauncher: 2 ** 31 - 1}, 0), fleet({OG.RocketLauncher: 1000000}, 0)]
+        outcome = self.engine.simulate(attackers, defenders, seed=1)[0]
+        self.assertGreater(outcome.defenders_outcomes[1].round_stats(0)[OG.RocketLauncher].times_was_shot, 0)
+
+    def test_workers(self):
+        # Every simulation has its own random stream, so results depend neither on the number of threads nor on the
+        # number of simulations.
+        outcomes = [outcome_key(outcome) for outcome in self.engine.simulate(self.attackers, self.defenders, seed=1,
+                                                                              num_simulations=10)]
+        for workers in (2, 3):
+            self.assertEqual([outcome_key(outcome) for outcome in self.engine.simulate(
+                self.attackers, self.defenders, seed=1, num_simulations=10, workers=workers)], outcomes)
+        self.assertEqual([outcome_key(outcome) for outcome in self.engine.simulate(
+            self.attackers, self.defenders, seed=1, num_simulations=4)], outcomes[:4])
+
+    def test_battle_threads_workers(self):
+        engine = BattleEngine(ENGINE_PATH, OG.units_attributes, battle_threads=2)
+        outcomes = [outcome_key(outcome) for outcome in engine.simulate(self.attackers, self.defenders, seed=1,
+                                                                         num_simulations=10)]
+        for workers in (2, 3):
+            self.assertEqual([outcome_key(outcome) for outcome in engine.simulate(
+                self.attackers, self.defenders, seed=1, num_simulations=10, workers=workers)], outcomes)
+
+    def test_snapshot_same_stream(self):
+        # Resumed on its own stream, a snapshot continues the simulation exactly.
+        for simulation in (0, 3):
+            outcome = self.engine.simulate(self.attackers, self.defenders, seed=1, num_simulations=5)[simulation]
+            for round_no in range(outcome.num_rounds + 1):
+                snapshot = self.engine.snapshot(self.attackers, self.defenders, round_no, seed=1, simulation=simulation)
+                resumed, = self.engine.resume(snapshot, seed=1, same_stream=True)
+                self.assertEqual(outcome_key(resumed), outcome_key(outcome))
+
+    def test_damaged_snapshot(self):
+        snapshot = self.engine.snapshot(self.attackers, self.defenders, 1, seed=1)
+        for size in (0, 10, 24, len(snapshot) // 2, len(snapshot) - 1):
+            with self.assertRaises(Error):
+                self.engine.resume(snapshot[:size], seed=1)
+        # The magic and the number of attackers.
+        for offset in (0, 12):
+            corrupt = bytearray(snapshot)
+            corrupt[offset] ^= 0xff
+            with self.assertRaises(Error):
+                self.engine.resume(bytes(corrupt), seed=1)
+
+    def test_snapshot_rng(self):
+        for rng, other_rng in zip(RNGS, reversed(RNGS)):
+            snapshot = BattleEngine(ENGINE_PATH, OG.units_attributes, rng=rng).snapshot(self.attackers, self.defenders,
+                                                                                        1, seed=1)
+            with self.assertRaises(ValueError):
+                BattleEngine(ENGINE_PATH, OG.units_attributes, rng=other_rng).resume(snapshot, seed=1)
+
+    def test_outcome_store_recovery(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'outcomes.ogbo')
+            with BattleOutcomeStore(path, 'a') as store, BattleOutcomeStore(path) as reader:
+                self.engine.simulate(self.attackers, self.defenders, seed=1, num_simulations=3, store=store)
+                store.flush()
+                reader.refresh()
+                committed = [record_key(record) for record in reader]
+                self.assertEqual(reader.num_simulations, 3)
+
+                # Appended records are seen by readers only once they are committed.
+                store.append(3, self.engine.simulate(self.attackers, self.defenders, seed=2)[0],
+                             self.attackers + self.defenders)
+                reader.refresh()
+                self.assertEqual(len(reader), len(committed))
+                store.flush()
+                reader.refresh()
+                self.assertEqual(reader.num_simulations, 4)
+                self.assertEqual([record_key(record) for record in reader][:len(committed)], committed)
+                committed = [record_key(record) for record in reader]
+            size = os.path.getsize(path)
+
+            # An interrupted writer leaves records that the header does not count.
+            with open(path, 'ab') as f:
+                f.write(b'\xff' * 100)
+            with BattleOutcomeStore(path, 'a') as store:
+                self.assertEqual(os.path.getsize(path), size)
+                self.assertEqual([record_key(record) for record in store], committed)
+                self.assertEqual([record_key(record) for record in store.simulation_records(1)],
+                                 [key for key in committed if key[0] == 1])
+
+    def test_iter_simulate(self):
+        outcomes = self.engine.simulate(self.attackers, self.defenders, seed=1, num_simulations=5)
+        self.assertEqual([outcome_key(outcome) for outcome in self.engine.iter_simulate(
+            self.attackers, self.defenders, seed=1, num_simulations=5)], [outcome_key(outcome) for outcome in outcomes])
+
+    def test_estimator_calibration(self):
+        estimator = BattleEstimator(OG.units_attributes)
+        for attackers, defenders in [(self.attackers, self.defenders),
+                                     ([fleet({OG.HeavyFighter: 500})], [fleet({OG.LightFighter: 1500})])]:
+            calibration = estimator.calibrate(self.engine, attackers, defenders, num_simulations=1000, seed=1)
+            self.assertLess(calibration.max_relative_error, 0.03)
+
+    def test_approximate(self):
+        # The approximate mode is statistically equivalent to the engine, the mean remaining units of every group must
+        # be close to the exact ones.
+        attackers = [fleet({OG.Battleship: 2000, OG.Destroyer: 200})]
+        defenders = [fleet({OG.PlasmaTurret: 500, OG.GaussCannon: 1000, OG.HeavyLaser: 3000})]
+        exact = self.engine.simulate(attackers, defenders, seed=1, num_simulations=100)
+        approximate = self.engine.simulate(attackers, defenders, seed=1, num_simulations=100, approximate=True)
+        for side, combatants in (('attackers_outcomes', attackers), ('defenders_outcomes', defenders)):
+            for i, combatant in enumerate(combatants):
+                for kind, count in combatant.unit_groups.items():
+                    means = [statistics.mean(
+                        getattr(outcome, side)[i].round_stats(outcome.num_rounds - 1)[kind].num_remaining_units
+                        for outcome in outcomes) for outcomes in (exact, approximate)]
+                    self.assertLess(abs(means[0] - means[1]), 0.02 * count)
+
+    def test_approximate_buckets(self):
+        for buckets in (0, MAX_APPROXIMATE_BUCKETS + 1):
+            with self.assertRaises(ValueError):
+                self.engine.simulate(self.attackers, self.defenders, seed=1, approximate=True, buckets=buckets)
+        self.engine.simulate(self.attackers, self.defenders, seed=1, approximate=True, buckets=MAX_APPROXIMATE_BUCKETS)
+
+    def test_zero_simulations_batch(self):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        batch = self.engine.simulate_batch(self.attackers, self.defenders, seed=1, num_simulations=0)
+        self.assertEqual(len(batch), 0)
+
+
+@unittest.skipUnless(os.path.exists(LIBRARY_PATH), 'battle engine library is not built')
+class LibraryTest(unittest.TestCase):
+    def setUp(self):
+        self.timings = []
+        self.engine = BattleEngine(ENGINE_PATH, OG.units_attributes, library_path=LIBRARY_PATH,
+                                   on_timing=self.timings.append)
+        self.executable = BattleEngine(ENGINE_PATH, OG.units_attributes)
+        self.attackers = [fleet({OG.Cruiser: 30, OG.LightFighter: 50}), fleet({OG.Battleship: 10}, 12)]
+        self.defenders = [fleet({OG.RocketLauncher: 100, OG.LightLaser: 20}, 8)]
+
+    def used_library(self) -> bool:
+        # The library writes no output to parse.
+        timing, = self.timings
+        self.timings.clear()
+        return timing.bytes_out == 0
+
+    def test_simulate(self):
+        for workers in (1, 2):
+            outcomes = self.engine.simulate(self.attackers, self.defenders, seed=1, num_simulations=10, workers=workers)
+            self.assertTrue(self.used_library())
+            self.assertEqual([outcome_key(outcome) for outcome in outcomes],
+                             [outcome_key(outcome) for outcome in self.executable.simulate(
+                                 self.attackers, self.defenders, seed=1, num_simulations=10, workers=workers)])
+
+    def test_simulate_batch(self):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        batch = self.engine.simulate_batch(self.attackers, self.defenders, seed=1, num_simulations=10)
+        self.assertTrue(self.used_library())
+        self.assertEqual([outcome_key(outcome) for outcome in batch],
+                         [outcome_key(outcome) for outcome in self.executable.simulate_batch(
+                             self.attackers, self.defenders, seed=1, num_simulations=10)])
+
+    def test_unsupported_options(self):
+        for options in ({'approximate': True}, {'projection': OutputProjection(last_round=True)}, {'timeout': 60}):
+            outcomes = self.engine.simulate(self.attackers, self.defenders, seed=1, num_simulations=3, **options)
+            self.assertFalse(self.used_library())
+            self.assertEqual([outcome_key(outcome) for outcome in outcomes],
+                             [outcome_key(outcome) for outcome in self.executable.simulate(
+                                 self.attackers, self.defenders, seed=1, num_simulations=3, **options)])
+
+
+class IterSimulateTest(unittest.TestCase):
+    def test_invalid_arguments(self):
+        # Raised by the call, not by the first next().
+        engine = BattleEngine(ENGINE_PATH, OG.units_attributes)
+        with self.assertRaises(ValueError):
+            engine.iter_simulate([fleet({OG.Cruiser: 1})] * 257, [fleet({OG.Cruiser: 1})])
+
+    @unittest.skipUnless(os.name == 'posix', 'needs a shell script')
+    def test_engine_exits_before_reading_input(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'engine')
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\necho invalid input >&2\nexit 1\n')
+            os.chmod(path, stat.S_IRWXU)
+            engine = BattleEngine(path, OG.units_attributes)
+            # More input than a pipe buffers, so writing it fails.
+            combatants = [fleet({kind: 10 ** 15 for kind in range(14)}) for _ in range(256)]
+            with self.assertRaisesRegex(Error, 'invalid input'):
+                list(engine.iter_simulate(combatants, combatants, seed=1))
+
+
+if __name__ == '__main__':
+    unittest.main()